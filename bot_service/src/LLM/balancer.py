@@ -0,0 +1,160 @@
+"""Implements the load balancing of the LLM calls across the equivalent endpoints of a provider"""
+
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator
+
+import httpx
+
+from common.base import Main
+from common.data_model import LLMEndpointPoolConfiguration, LLMEndpointSelection
+from common.metrics import MetricsRegistry
+
+
+class LLMEndpoint:
+    """One endpoint of a pool with its load, quota and health"""
+
+    def __init__(self, provider: str, name: str, settings: dict):
+        self.provider = provider
+        self.name = name
+        # The settings a service handle is bound to for calls on this endpoint
+        self.settings = settings
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        # Reported by the provider in the rate limit headers of the last response, None until then
+        self.remaining_requests = None
+        self.remaining_tokens = None
+
+    def available(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def stats(self, now: float) -> dict:
+        return {
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "ejected_seconds": round(max(0.0, self.ejected_until - now), 1),
+            "remaining_requests": self.remaining_requests,
+            "remaining_tokens": self.remaining_tokens,
+        }
+
+
+_current_endpoint: ContextVar[LLMEndpoint | None] = ContextVar("llm_endpoint", default=None)
+
+
+class LLMEndpointBalancer:
+    """Spreads the calls of a provider over its pool of equivalent endpoints.
+
+    Several Azure deployments or OpenAI keys serving the same model each have their own quota, so
+    the aggregate throughput grows with the pool. Every call leases the endpoint with the fewest
+    outstanding requests, or the most remaining quota per outstanding request. Endpoints that keep
+    failing, or answer with 429, are ejected for a backoff that doubles with every ejection in a row.
+    """
+
+    # Failed requests that say nothing about the health of the endpoint
+    REQUEST_ERROR_STATUSES = (400, 413, 422)
+
+    def __init__(self, pool_configuration: LLMEndpointPoolConfiguration, registry: MetricsRegistry):
+        self._pool_configuration = pool_configuration
+        self._pools = {}
+        self._requests = registry.counter("llm_endpoint_requests_total", "LLM calls by pooled endpoint", ("provider", "endpoint"))
+        self._ejections = registry.counter("llm_endpoint_ejections_total", "Ejections of unhealthy pooled endpoints", ("provider", "endpoint"))
+
+    def register(self, provider: str, endpoints: list[LLMEndpoint]) -> None:
+        """Registers the pool of the provider, the first endpoint is the configured one"""
+        if not self._pool_configuration.enabled or len(endpoints) < 2:
+            return
+        self._pools[provider] = endpoints
+        Main.logger().info(f"Balancing {provider} calls across {', '.join(endpoint.name for endpoint in endpoints)}")
+
+    def select(self, provider: str, settings: dict) -> LLMEndpoint | None:
+        """Returns the endpoint for the next call, None when calls with these settings are not pooled"""
+        endpoints = self._pools.get(provider)
+        # Handles bound to another deployment or key than the configured one keep it
+        if not endpoints or settings != endpoints[0].settings:
+            return None
+        now = time.monotonic()
+        candidates = [endpoint for endpoint in endpoints if endpoint.available(now)]
+        if not candidates:
+            # Calls still go out while every endpoint is ejected, to the one that recovers first
+            return min(endpoints, key=lambda endpoint: endpoint.ejected_until)
+        if self._pool_configuration.selection == LLMEndpointSelection.remaining_quota.value:
+            return max(candidates, key=lambda endpoint: (self._quota_score(endpoint), -endpoint.requests))
+        return min(candidates, key=lambda endpoint: (endpoint.outstanding, endpoint.requests))
+
+    @staticmethod
+    def _quota_score(endpoint: LLMEndpoint) -> float:
+        if endpoint.remaining_tokens is None:
+            # Endpoints without a response yet are tried first to learn their quota
+            return float("inf")
+        return endpoint.remaining_tokens / (endpoint.outstanding + 1)
+
+    @asynccontextmanager
+    async def lease(self, provider: str, settings: dict) -> AsyncIterator[LLMEndpoint | None]:
+        """Holds the selected endpoint for the duration of a call and records its outcome"""
+        endpoint = self.select(provider, settings)
+        if endpoint is None:
+            yield None
+            return
+        endpoint.outstanding += 1
+        endpoint.requests += 1
+        self._requests.inc(provider=provider, endpoint=endpoint.name)
+        context_token = _current_endpoint.set(endpoint)
+        try:
+            yield endpoint
+        except Exception as e:
+            # Invalid responses (ValueError, as the aborted JSON streams) came from a healthy endpoint
+            if getattr(e, "status_code", None) not in self.REQUEST_ERROR_STATUSES and not isinstance(e, ValueError):
+                self._record_failure(endpoint)
+            raise
+        else:
+            endpoint.failures = 0
+            endpoint.ejections = 0
+        finally:
+            endpoint.outstanding -= 1
+            _current_endpoint.reset(context_token)
+
+    def _record_failure(self, endpoint: LLMEndpoint, retry_after: float = None) -> None:
+        endpoint.failures += 1
+        if retry_after is None and endpoint.failures < self._pool_configuration.failure_threshold:
+            return
+        configuration = self._pool_configuration
+        backoff = retry_after or min(configuration.ejection_seconds * 2 ** endpoint.ejections, configuration.max_ejection_seconds)
+        endpoint.ejected_until = max(endpoint.ejected_until, time.monotonic() + backoff)
+        endpoint.ejections += 1
+        endpoint.failures = 0
+        self._ejections.inc(provider=endpoint.provider, endpoint=endpoint.name)
+        Main.logger().warning(f"Ejected {endpoint.provider} endpoint {endpoint.name} for {backoff:.1f}s")
+
+    async def observe_response(self, response: httpx.Response) -> None:
+        """Reads the remaining quota from the rate limit headers of a response of the leased endpoint"""
+        endpoint = _current_endpoint.get()
+        if endpoint is None:
+            return
+        headers = response.headers
+        if "x-ratelimit-remaining-tokens" in headers:
+            endpoint.remaining_tokens = _header_number(headers["x-ratelimit-remaining-tokens"])
+        if "x-ratelimit-remaining-requests" in headers:
+            endpoint.remaining_requests = _header_number(headers["x-ratelimit-remaining-requests"])
+        if response.status_code == 429:
+            endpoint.remaining_tokens = 0
+            retry_after = _header_number(headers.get("retry-after-ms", "")) / 1000 or _header_number(headers.get("retry-after", ""))
+            self._record_failure(endpoint, retry_after=retry_after or self._pool_configuration.ejection_seconds)
+
+    def stats(self) -> dict:
+        """Returns the load, quota and health of every pooled endpoint by provider"""
+        now = time.monotonic()
+        return {
+            provider: {endpoint.name: endpoint.stats(now) for endpoint in endpoints}
+            for provider, endpoints in self._pools.items()
+        }
+
+
+def _header_number(value: str) -> float:
+    try:
+        return float(value)
+    except ValueError:
+        return 0.0
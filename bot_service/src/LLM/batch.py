@@ -0,0 +1,87 @@
+"""Implements the batch execution of independent LLM prompts"""
+
+import asyncio
+import time
+from typing import Any
+
+from common.base import Main
+from common.data_model import LLMBatchConfiguration, LLMBatchRequest, LLMBatchResult, LLMStage, Roles
+from common.request_context import current_request_context
+from LLM.log_sink import LLMLogSink
+
+
+class LLMBatchExecutor:
+    """Runs many independent prompts against one LLM service.
+
+    Large enough batches go through the batch API of the provider, which is cheaper and does not
+    count against the interactive rate limits. Small batches, providers without a batch API (or an
+    SDK too old to have one), the fake provider and batches the provider does not finish in time
+    run through a local queue of bounded concurrency instead. Every result is sent to the LLM log sink.
+    """
+
+    def __init__(self, batch_configuration: LLMBatchConfiguration, log_sink: LLMLogSink):
+        self._batch_configuration = batch_configuration
+        self._log_sink = log_sink
+
+    async def run(self, service: Any, requests: list[LLMBatchRequest], role: str = Roles.admin.value,
+                  stage: str = LLMStage.other.value) -> dict[str, LLMBatchResult]:
+        """Returns the result of every request by its custom id"""
+        configuration = self._batch_configuration
+        results = {}
+        if configuration.provider_batch_enabled and len(requests) >= configuration.provider_batch_min_requests:
+            try:
+                results = await asyncio.wait_for(
+                    self._provider_batch(service, requests, stage), configuration.provider_batch_timeout_seconds)
+            except NotImplementedError:
+                Main.logger().info(f"{service.provider} has no batch API, running {len(requests)} prompts locally")
+            except asyncio.TimeoutError:
+                Main.logger().warning(f"{service.provider} batch did not finish in time, running the rest locally")
+            except Exception as e:
+                Main.logger().warning(f"{service.provider} batch failed, running {len(requests)} prompts locally: {e}")
+
+        remaining = [request for request in requests if request.custom_id not in results]
+        if remaining:
+            results.update(await self._local_batch(service, remaining, role, stage))
+        return results
+
+    async def _provider_batch(self, service: Any, requests: list[LLMBatchRequest], stage: str) -> dict[str, LLMBatchResult]:
+        started = time.monotonic()
+        results = await service.run_batch(requests, self._batch_configuration.poll_interval_seconds)
+        Main.logger().info(f"{service.provider} batch of {len(requests)} prompts finished in {time.monotonic() - started:.0f}s")
+        for request in requests:
+            if request.custom_id in results:
+                self._log(service, request, results[request.custom_id], stage, mode="provider_batch")
+        return results
+
+    async def _local_batch(self, service: Any, requests: list[LLMBatchRequest], role: str, stage: str) -> dict[str, LLMBatchResult]:
+        semaphore = asyncio.Semaphore(self._batch_configuration.max_concurrency)
+
+        async def complete(request: LLMBatchRequest) -> LLMBatchResult:
+            async with semaphore:
+                try:
+                    response = await service.completion(
+                        request.prompt, role=role, system_message=request.system_message, stage=stage, **request.params)
+                    result = LLMBatchResult(custom_id=request.custom_id, response=response)
+                except Exception as e:
+                    Main.logger().warning(f"Batch prompt {request.custom_id} failed: {e!r}")
+                    result = LLMBatchResult(custom_id=request.custom_id, error=repr(e))
+            if role != Roles.Developer.value:
+                # Developer completions are already logged by the LLM service
+                self._log(service, request, result, stage, mode="local")
+            return result
+
+        results = await asyncio.gather(*(complete(request) for request in requests))
+        return {result.custom_id: result for result in results}
+
+    def _log(self, service: Any, request: LLMBatchRequest, result: LLMBatchResult, stage: str, mode: str) -> None:
+        self._log_sink.submit({
+            "request_id": current_request_context().request_id,
+            "batch_id": request.custom_id,
+            "batch_mode": mode,
+            "provider": service.provider,
+            "model": service.request_model(),
+            "stage": stage,
+            "prompt": request.prompt,
+            "response": result.response or "",
+            "error": result.error,
+        })
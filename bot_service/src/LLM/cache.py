@@ -0,0 +1,137 @@
+"""Implements the exact and semantic response cache for LLM completions"""
+
+import asyncio
+import hashlib
+import json
+import math
+import time
+from collections import OrderedDict
+from typing import Any
+
+from common.base import Main
+from common.data_model import LLMResponseCacheConfiguration
+
+
+class LLMResponseCache:
+    """LRU/TTL cache of LLM responses keyed on provider, model, system message, prompt and sampling kwargs.
+
+    The optional semantic tier embeds short prompts and serves a cached response when a prompt
+    sent with the same provider, model, system message and kwargs is similar enough.
+    """
+
+    def __init__(self, cache_configuration: LLMResponseCacheConfiguration):
+        self._cache_configuration = cache_configuration
+        # key -> (expires_at, response)
+        self._entries = OrderedDict()
+        # key -> (partition, embedding)
+        self._embeddings = {}
+        self._embedding_function = None
+        self._stats = {"hits": 0, "semantic_hits": 0, "misses": 0, "evictions": 0}
+
+    def set_embedding_function(self, embedding_function: Any) -> None:
+        """Enables the semantic tier with a langchain embeddings object"""
+        self._embedding_function = embedding_function
+
+    def enabled(self) -> bool:
+        return self._cache_configuration.enabled
+
+    @staticmethod
+    def partition(provider: str, model_name: str, system_message: str, sampling_kwargs: dict) -> str:
+        """Returns the part of the cache key every semantic match must share"""
+        return json.dumps([provider, model_name, system_message, sampling_kwargs], sort_keys=True, default=str)
+
+    @staticmethod
+    def key(partition: str, prompt: str) -> str:
+        return hashlib.sha256(f"{partition}\n{prompt}".encode()).hexdigest()
+
+    async def get(self, partition: str, prompt: str) -> str | None:
+        """Returns the cached response for the prompt, trying the exact tier before the semantic one"""
+        if not self.enabled():
+            return None
+        key = self.key(partition, prompt)
+        response = self._lookup(key)
+        if response is not None:
+            self._stats["hits"] += 1
+            return response
+
+        response = await self._semantic_lookup(partition, prompt)
+        if response is not None:
+            self._stats["semantic_hits"] += 1
+            return response
+
+        self._stats["misses"] += 1
+        return None
+
+    async def set(self, partition: str, prompt: str, response: str) -> None:
+        """Caches the response for the prompt"""
+        if not self.enabled() or not response:
+            return
+        key = self.key(partition, prompt)
+        self._entries[key] = (time.monotonic() + self._cache_configuration.ttl_seconds, response)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._cache_configuration.max_entries:
+            evicted_key, _ = self._entries.popitem(last=False)
+            self._embeddings.pop(evicted_key, None)
+            self._stats["evictions"] += 1
+
+        embedding = await self._embed(prompt)
+        if embedding is not None:
+            self._embeddings[key] = (partition, embedding)
+
+    @staticmethod
+    async def replay(response: str, stream_response: Any) -> None:
+        """Streams a cached response to the caller the same way a live completion would"""
+        await stream_response(response)
+
+    def stats(self) -> dict:
+        """Returns the hit/miss counters and the current size of the cache"""
+        lookups = self._stats["hits"] + self._stats["semantic_hits"] + self._stats["misses"]
+        hit_ratio = (self._stats["hits"] + self._stats["semantic_hits"]) / lookups if lookups else 0.0
+        return {**self._stats, "size": len(self._entries), "hit_ratio": round(hit_ratio, 3)}
+
+    def _lookup(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, response = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self._embeddings.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return response
+
+    async def _semantic_lookup(self, partition: str, prompt: str) -> str | None:
+        candidates = [(key, embedding) for key, (key_partition, embedding) in self._embeddings.items()
+                      if key_partition == partition]
+        if not candidates:
+            return None
+        embedding = await self._embed(prompt)
+        if embedding is None:
+            return None
+
+        best_key, best_similarity = None, self._cache_configuration.semantic_threshold
+        for key, candidate in candidates:
+            similarity = self._cosine_similarity(embedding, candidate)
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        if best_key is None:
+            return None
+        Main.logger().info(f"Semantic cache hit with similarity {best_similarity:.4f}")
+        return self._lookup(best_key)
+
+    async def _embed(self, prompt: str) -> list[float] | None:
+        if (self._embedding_function is None or not self._cache_configuration.semantic_enabled
+                or len(prompt) > self._cache_configuration.semantic_max_prompt_chars):
+            return None
+        try:
+            return await asyncio.to_thread(self._embedding_function.embed_query, prompt)
+        except Exception as e:
+            Main.logger().warning(f"Skipping semantic cache, embedding the prompt failed: {e}")
+            return None
+
+    @staticmethod
+    def _cosine_similarity(a: list[float], b: list[float]) -> float:
+        dot = sum(x * y for x, y in zip(a, b))
+        norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+        return dot / norm if norm else 0.0
@@ -0,0 +1,42 @@
+"""Implements the model cascades of the retried LLM stages"""
+
+from typing import Any
+
+from common.metrics import MetricsRegistry
+
+
+class LLMCascade:
+    """Escalates the attempts of a stage from fast models to stronger ones.
+
+    Every tier gets its number of attempts before the next tier takes over, the last tier takes
+    every remaining attempt. The outcome of each attempt is counted per model, so the success rate
+    of the cheap tier shows how many tasks finish on it.
+    """
+
+    def __init__(self, stage: str, tiers: list[tuple[Any, int]], registry: MetricsRegistry):
+        self.stage = stage
+        self._tiers = tiers
+        self._outcomes = {}
+        self._attempts = registry.counter("llm_cascade_attempts_total", "Attempts of the cascaded stages by model and outcome", ("stage", "model", "outcome"))
+
+    def service(self, attempt: int) -> Any:
+        """Returns the LLM service of the attempt, counted from 0"""
+        for service, attempts in self._tiers:
+            if attempt < attempts:
+                return service
+            attempt -= attempts
+        return self._tiers[-1][0]
+
+    def record(self, service: Any, outcome: str) -> None:
+        """Records the outcome of an attempt, "success" or the kind of failure"""
+        model_name = service.request_model()
+        self._attempts.inc(stage=self.stage, model=model_name, outcome=outcome)
+        outcomes = self._outcomes.setdefault(model_name, {})
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+
+    def stats(self) -> dict:
+        """Returns the outcomes and success rate of the attempts per model"""
+        return {
+            model_name: {**outcomes, "success_rate": round(outcomes.get("success", 0) / sum(outcomes.values()), 3)}
+            for model_name, outcomes in self._outcomes.items()
+        }
@@ -0,0 +1,112 @@
+"""Implements the pooled, keep-alive HTTP clients shared by the LLM services"""
+
+import asyncio
+
+import httpx
+from anthropic import AsyncClient as AnthropicAsyncClient
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+
+from common.base import Main
+from common.data_model import LLMClientPoolConfiguration, LLMProvider
+
+
+class LLMClientPool:
+    """Owns one long-lived async client per provider endpoint.
+
+    Every client is backed by its own ``httpx.AsyncClient`` so TCP/TLS connections are kept
+    alive and reused across calls. httpx connections are bound to the event loop that opened
+    them, so clients are keyed by the running loop as well; the application initializes its
+    services on one loop and serves Chainlit/FastAPI on another. Clients of a loop that is no
+    longer running are dropped once a client is created on the serving loop. The SDK clients do
+    not retry on their own, the LLM retry policy retries their calls within its budgets.
+    """
+
+    def __init__(self, pool_configuration: LLMClientPoolConfiguration):
+        self._pool_configuration = pool_configuration
+        # (provider, endpoint key, loop) -> (sdk client, httpx client, base url)
+        self._clients = {}
+        self._response_hooks = []
+
+    def add_response_hook(self, hook) -> None:
+        """Registers an async hook called with every provider response, clients created afterwards call it"""
+        self._response_hooks.append(hook)
+
+    def _http_client(self) -> httpx.AsyncClient:
+        """Builds a keep-alive httpx client with the configured pool limits"""
+        configuration = self._pool_configuration
+        return httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=configuration.max_connections,
+                max_keepalive_connections=configuration.max_keepalive_connections,
+                keepalive_expiry=configuration.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(configuration.read_timeout, connect=configuration.connect_timeout),
+            event_hooks={"response": list(self._response_hooks)},
+        )
+
+    def _get_or_create(self, provider: str, endpoint_key: tuple, factory):
+        loop = asyncio.get_event_loop()
+        key = (provider, endpoint_key, loop)
+        if key not in self._clients:
+            self._discard_stopped_loops(loop)
+            http_client = self._http_client()
+            client = factory(http_client)
+            self._clients[key] = (client, http_client, str(client.base_url))
+            Main.logger().info(f"Created pooled {provider} client for {client.base_url}")
+        return self._clients[key][0]
+
+    def _discard_stopped_loops(self, loop: asyncio.AbstractEventLoop):
+        """Forgets clients of other loops that are stopped or closed, their connections are unusable from this loop"""
+        for key in [key for key in self._clients if key[2] is not loop and not key[2].is_running()]:
+            del self._clients[key]
+
+    def openai_client(self, api_key: str, base_url: str = None, provider: str = LLMProvider.openai.value) -> AsyncOpenAI:
+        """Returns the pooled OpenAI compatible client for the given key and base url"""
+        return self._get_or_create(
+            provider, (api_key, base_url),
+            lambda http_client: AsyncOpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0),
+        )
+
+    def azure_openai_client(self, api_key: str, azure_endpoint: str, api_version: str) -> AsyncAzureOpenAI:
+        """Returns the pooled Azure OpenAI client for the given deployment endpoint"""
+        return self._get_or_create(
+            LLMProvider.azure_openai.value, (api_key, azure_endpoint, api_version),
+            lambda http_client: AsyncAzureOpenAI(
+                api_key=api_key, azure_endpoint=azure_endpoint, api_version=api_version, http_client=http_client, max_retries=0),
+        )
+
+    def anthropic_client(self, api_key: str) -> AnthropicAsyncClient:
+        """Returns the pooled Anthropic client for the given key"""
+        return self._get_or_create(
+            LLMProvider.anthropic_ai.value, (api_key,),
+            lambda http_client: AnthropicAsyncClient(api_key=api_key, http_client=http_client, max_retries=0),
+        )
+
+    async def warm_up(self):
+        """Opens a connection to every pooled endpoint on the running loop so the first call skips the TLS handshake"""
+        loop = asyncio.get_running_loop()
+        warm_ups = [
+            self._warm_up_endpoint(provider, http_client, base_url)
+            for (provider, _, client_loop), (_, http_client, base_url) in self._clients.items()
+            if client_loop is loop
+        ]
+        await asyncio.gather(*warm_ups)
+
+    async def _warm_up_endpoint(self, provider: str, http_client: httpx.AsyncClient, base_url: str):
+        try:
+            await http_client.head(base_url, timeout=self._pool_configuration.connect_timeout)
+            Main.logger().info(f"Warmed up {provider} connection to {base_url}")
+        except httpx.HTTPError as e:
+            Main.logger().warning(f"Could not warm up {provider} connection to {base_url}: {e}")
+
+    async def aclose(self):
+        """Closes all pooled connections"""
+        clients, self._clients = self._clients, {}
+        for (provider, _, loop), (_, http_client, base_url) in clients.items():
+            if loop.is_closed():
+                continue
+            try:
+                await http_client.aclose()
+            except RuntimeError as e:
+                # Connections opened on another (still running) loop cannot be closed from this one
+                Main.logger().debug(f"Could not close {provider} connection to {base_url}: {e}")
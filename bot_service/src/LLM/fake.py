@@ -0,0 +1,104 @@
+"""Implements the offline responses, latency profile and embeddings of the fake LLM provider"""
+
+import hashlib
+import json
+import math
+import random
+import re
+
+from langchain_core.embeddings import Embeddings
+
+from common.data_model import FakeLLMConfiguration
+
+
+class FakeLLMError(RuntimeError):
+    """Injected provider failure"""
+
+
+class HashEmbeddings(Embeddings):
+    """Deterministic embeddings built from the hashes of the words of a text, similar texts get similar vectors"""
+
+    def __init__(self, dimensions: int):
+        self.dimensions = dimensions
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        vector = [0.0] * self.dimensions
+        for word in re.findall(r"\w+", text.lower()):
+            digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[index] += 1.0 if digest[4] % 2 else -1.0
+        norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+        return [value / norm for value in vector]
+
+
+class FakeResponder:
+    """Produces the responses and timings of the fake provider.
+
+    Scripted responses are matched first, by a substring of the prompt. Otherwise the prompt is
+    recognised as a planner, endpoint generator or other prompt and answered from a template, so
+    the planner and executor can run end to end. Latency and failures are drawn from a seeded
+    random generator, a run with the same seed and requests behaves the same.
+    """
+
+    def __init__(self, fake_configuration: FakeLLMConfiguration):
+        self._fake_configuration = fake_configuration
+        self._random = random.Random(fake_configuration.seed)
+        self._scripted_responses = []
+        if fake_configuration.responses_file:
+            with open(fake_configuration.responses_file, "r") as f:
+                self._scripted_responses = json.load(f)
+
+    def respond(self, prompt: str) -> str:
+        for scripted_response in self._scripted_responses:
+            if scripted_response.get("match", "") in prompt:
+                return scripted_response.get("response", "")
+        if prompt.rstrip().endswith("Plan:"):
+            return self._plan(prompt)
+        if '"OpenAPI spec"' in prompt:
+            return self._endpoint(prompt)
+        return self._summary(prompt)
+
+    def time_to_first_token(self) -> float:
+        return self._jittered(self._fake_configuration.ttft_seconds)
+
+    def token_interval(self) -> float:
+        return self._jittered(1 / self._fake_configuration.tokens_per_second)
+
+    def maybe_fail(self) -> None:
+        if self._random.random() < self._fake_configuration.error_rate:
+            raise FakeLLMError("Injected fake LLM failure")
+
+    @staticmethod
+    def tokens(response: str) -> list[str]:
+        """Splits the response into stream tokens, words with their trailing whitespace"""
+        return re.findall(r"\S+\s*|\s+", response)
+
+    def _jittered(self, seconds: float) -> float:
+        jitter = self._fake_configuration.jitter_ratio
+        return max(0.0, seconds * self._random.uniform(1 - jitter, 1 + jitter))
+
+    def _plan(self, prompt: str) -> str:
+        # The query is the last section of the planner prompts
+        query = " ".join(prompt.rsplit("User query:", 1)[-1].rsplit("Plan:", 1)[0].split()) or "the question"
+        plan = (
+            f"1. [Search] {query}\n"
+            f"2. [Summarization] Consider the above data points to answer the user's question: {query}"
+        )
+        return json.dumps({"plan": plan})
+
+    def _endpoint(self, prompt: str) -> str:
+        # The first path of the OpenAPI spec found for the task
+        match = re.search(r"['\"](/[^'\"\s]+)['\"]", prompt)
+        return json.dumps([{"url": match.group(1) if match else "/fake", "method": "GET", "data": {}}])
+
+    def _summary(self, prompt: str) -> str:
+        words = re.findall(r"[A-Za-z]{4,}", prompt) or ["summary"]
+        seed = int.from_bytes(hashlib.blake2b(prompt.encode("utf-8"), digest_size=8).digest(), "little")
+        prompt_random = random.Random(seed)
+        sentences = []
+        for _ in range(max(1, self._fake_configuration.summary_tokens // 12)):
+            sentences.append(" ".join(prompt_random.choice(words) for _ in range(11)).capitalize() + ".")
+        return "\n".join(f"- {sentence}" for sentence in sentences)
@@ -0,0 +1,67 @@
+"""Implements the incremental validation of streamed JSON responses"""
+
+
+class JSONStreamError(ValueError):
+    """The streamed response can no longer be the JSON of its response schema"""
+
+
+class JSONStreamValidator:
+    """Follows the structure of a streamed JSON response token by token.
+
+    The stream is invalid as soon as it starts with anything but the top level type of the response
+    schema (prose, a code fence or the wrong brackets), has a character outside a string that JSON does
+    not allow, or closes a bracket it did not open. It is complete when the top level value is closed,
+    anything the model streams after that is dropped.
+    """
+
+    CLOSERS = {"{": "}", "[": "]"}
+    # Numbers, true, false and null
+    SCALAR_CHARACTERS = frozenset("0123456789+-.eEtruefalsn")
+
+    def __init__(self, response_schema: dict):
+        self._openers = {"object": "{", "array": "["}.get(response_schema.get("type"), "{[")
+        self._stack = []
+        self._in_string = False
+        self._escaped = False
+        self._started = False
+        self._consumed = 0
+        self.complete = False
+
+    def feed(self, token: str) -> str:
+        """Returns the part of the token up to the end of the JSON, raises JSONStreamError once it cannot be valid"""
+        for index, character in enumerate(token):
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif character == "\\":
+                    self._escaped = True
+                elif character == '"':
+                    self._in_string = False
+                continue
+            if character.isspace():
+                continue
+            if not self._started:
+                if character not in self._openers:
+                    raise JSONStreamError(f"Response starts with {token[index:index + 40]!r} instead of {' or '.join(self._openers)}")
+                self._started = True
+
+            if character == '"':
+                self._in_string = True
+            elif character in self.CLOSERS:
+                self._stack.append(self.CLOSERS[character])
+            elif character in "}]":
+                if not self._stack or self._stack.pop() != character:
+                    raise JSONStreamError(f"Unbalanced {character!r} at character {self._consumed + index}")
+                if not self._stack:
+                    self.complete = True
+                    self._consumed += index + 1
+                    return token[:index + 1]
+            elif character not in ",:" and character not in self.SCALAR_CHARACTERS:
+                raise JSONStreamError(f"Unexpected {character!r} outside a string at character {self._consumed + index}")
+        self._consumed += len(token)
+        return token
+
+    def finish(self) -> None:
+        """Raises JSONStreamError when the stream ended before the JSON was complete"""
+        if not self.complete:
+            raise JSONStreamError(f"Response ended after {self._consumed} characters before its JSON was complete")
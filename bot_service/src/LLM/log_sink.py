@@ -0,0 +1,100 @@
+"""Implements the background sink writing LLM prompt/response records to disk"""
+
+import asyncio
+import json
+from datetime import datetime
+from pathlib import Path
+
+from common.base import Main
+from common.data_model import LLMLogSinkConfiguration
+from LLM.tokenizer import TokenizerService
+
+
+class LLMLogSink:
+    """Collects LLM log records through a bounded queue and appends them in batches to daily JSONL files.
+
+    Callers never wait for disk I/O: records are dropped when the queue is full and the files are
+    written from a worker thread. A day's file rolls over to ``.1``, ``.2``... once it reaches the
+    configured size. Token counts missing from a record are filled in by the writer thread. The writer
+    runs on the loop that submits records and is started on first use.
+    """
+
+    def __init__(self, log_sink_configuration: LLMLogSinkConfiguration, log_dir: str, tokenizer: TokenizerService):
+        self._log_sink_configuration = log_sink_configuration
+        self._log_dir = Path(log_dir)
+        self._tokenizer = tokenizer
+        self._queue = asyncio.Queue(maxsize=log_sink_configuration.max_queue_size)
+        self._writer = None
+        self._batch = []
+        self._dropped = 0
+
+    def submit(self, record: dict) -> None:
+        """Queues a record without waiting, it is dropped if the queue is full"""
+        self._ensure_writer()
+        record.setdefault("timestamp", datetime.now().isoformat(timespec="milliseconds"))
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self._dropped += 1
+            if self._dropped % 100 == 1:
+                Main.logger().warning(f"LLM log queue is full, {self._dropped} records dropped so far")
+
+    async def aclose(self) -> None:
+        """Writes every queued record, used on shutdown"""
+        if self._writer and not self._writer.done() and not self._writer.get_loop().is_closed():
+            self._writer.cancel()
+        while not self._queue.empty():
+            self._batch.append(self._queue.get_nowait())
+        if self._batch:
+            batch, self._batch = self._batch, []
+            await asyncio.to_thread(self._write, batch)
+
+    def stats(self) -> dict:
+        return {"queued": self._queue.qsize(), "dropped": self._dropped}
+
+    def _ensure_writer(self):
+        loop = asyncio.get_running_loop()
+        if self._writer is None or self._writer.done() or self._writer.get_loop() is not loop:
+            self._writer = loop.create_task(self._write_batches())
+
+    async def _write_batches(self):
+        configuration = self._log_sink_configuration
+        while True:
+            self._batch.append(await self._queue.get())
+            # Give a burst of records the flush interval to arrive so they are written together
+            deadline = asyncio.get_running_loop().time() + configuration.flush_interval_seconds
+            while len(self._batch) < configuration.batch_size:
+                timeout = deadline - asyncio.get_running_loop().time()
+                if timeout <= 0:
+                    break
+                try:
+                    self._batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            batch, self._batch = self._batch, []
+            try:
+                await asyncio.to_thread(self._write, batch)
+            except OSError as e:
+                Main.logger().error(f"Could not write {len(batch)} LLM log records: {e}")
+
+    def _write(self, batch: list[dict]):
+        for record in batch:
+            if record.get("prompt_tokens") is None:
+                record["prompt_tokens"] = self._tokenizer.count_sync(record.get("prompt", ""), record.get("model"))
+            if record.get("completion_tokens") is None:
+                record["completion_tokens"] = self._tokenizer.count_sync(record.get("response", ""), record.get("model"))
+
+        self._log_dir.mkdir(parents=True, exist_ok=True)
+        file_path = self._file_path()
+        with open(file_path, "a", encoding="utf-8") as write_object:
+            write_object.writelines(json.dumps(record, default=str) + "\n" for record in batch)
+
+    def _file_path(self) -> Path:
+        current_date = datetime.now().strftime("%Y-%m-%d")
+        file_path = self._log_dir / f"llm_logs_{current_date}.jsonl"
+        part = 0
+        while file_path.exists() and file_path.stat().st_size >= self._log_sink_configuration.max_file_bytes:
+            part += 1
+            file_path = self._log_dir / f"llm_logs_{current_date}.{part}.jsonl"
+        return file_path
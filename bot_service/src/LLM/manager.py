@@ -1,91 +1,393 @@
 from common.service_management import ServiceManager, Service
 from langchain_openai import OpenAIEmbeddings, AzureOpenAIEmbeddings, ChatOpenAI, AzureChatOpenAI
-from openai import AsyncAzureOpenAI, AsyncOpenAI, OpenAI, AzureOpenAI
-from anthropic import Anthropic, AsyncClient as AnthropicAsyncClient , types as AnthropicTypes
+from openai import AsyncAzureOpenAI, AsyncOpenAI
+from anthropic import AsyncClient as AnthropicAsyncClient , types as AnthropicTypes
 from common.base import Main
-from common.data_model import Roles, LLMProvider
-import os
-import tiktoken
-from typing import Any
-from datetime import datetime
-import csv
-from store.prompts import PromptStore
-from pathlib import Path
+from common.data_model import Roles, LLMProvider, LLMStage, LLMTokenUsage, LLMBatchRequest, LLMBatchResult
+import asyncio
+import copy
+from contextlib import aclosing, asynccontextmanager
+import json
+from typing import Any, AsyncIterator
+from urllib.parse import urlparse
+from store.prompts import PromptStore, SegmentedPrompt
+from common.request_context import current_request_context
+from common.metrics import metrics_registry
+from common.retry import retry_policy
+from LLM.client_pool import LLMClientPool
+from LLM.balancer import LLMEndpoint, LLMEndpointBalancer
+from LLM.cache import LLMResponseCache
+from LLM.tokenizer import TokenizerService
+from LLM.router import LLMRouter, RoutedLLMService
+from LLM.scheduler import LLMScheduler
+from LLM.log_sink import LLMLogSink
+from LLM.prompt_budget import PromptBudgetAllocator
+from LLM.streaming import TokenStreamer
+from LLM.usage import UsageTracker
+from LLM.telemetry import LLMCall, LLMTelemetry, current_llm_call
+from LLM.fake import FakeResponder, HashEmbeddings
+from LLM.batch import LLMBatchExecutor
+from LLM.cascade import LLMCascade
+from LLM.structured import ResponseTool
+from LLM.shadow import ShadowTraffic
+from LLM.json_stream import JSONStreamValidator
 
 class MyCustomPrompt():
     def __init__(self, my_custom_value):
         self.text = f"Custom prompt {my_custom_value}"
 
 
-class AzureOpenAIService(Service):
-    
-    def __init__(self):
-        super().__init__() 
-        self.api_type = Main.configuration().azureai_configuration.type
-        self.api_key = Main.configuration().azureai_configuration.api_key
-        self.api_base = Main.configuration().azureai_configuration.base
-        self.api_version = Main.configuration().azureai_configuration.version
-        self.deployment_name = Main.configuration().azureai_configuration.deployment_name
-        self.model_name = Main.configuration().azureai_configuration.model_name
-        self.embedding_deployment_name = Main.configuration().azureai_configuration.embedding_deployment_name
+class LLMService(Service):
+    """Implements the provider independent part of a completion, each provider implements the request itself"""
+
+    provider: str = None
+    default_system_message: str = "You are a helpful ai assistent"
+    # Set once the pooled client could be created, unconfigured services are skipped as fallbacks
+    configured: bool = False
+
+    def __init__(self, client_pool: LLMClientPool, response_cache: LLMResponseCache, tokenizer: TokenizerService, scheduler: LLMScheduler, log_sink: LLMLogSink, streamer: TokenStreamer, usage_tracker: UsageTracker, telemetry: LLMTelemetry, balancer: LLMEndpointBalancer):
+        super().__init__()
+        self.client_pool = client_pool
+        self.response_cache = response_cache
+        self.tokenizer = tokenizer
+        self.scheduler = scheduler
+        self.log_sink = log_sink
+        self.streamer = streamer
+        self.usage_tracker = usage_tracker
+        self.telemetry = telemetry
+        self.balancer = balancer
         self.prompts = PromptStore()
 
-    def set_client_by_model(self, **kwargs):
-        self.api_type = kwargs.get("api_type")
-        self.api_key = kwargs.get("api_key")
-        self.api_base = kwargs.get("api_base")
-        self.api_version = kwargs.get("api_version")
-        self.deployment_name = kwargs.get("deployment_name")
-        self.model_name = kwargs.get("model_name")
-        self.embedding_deployment_name = kwargs.get("embedding_deployment_name")
+    def __setattr__(self, name: str, value: Any):
+        if self.__dict__.get("_bound"):
+            raise AttributeError(f"{self.__class__.__name__} handles are immutable, bind a new handle for another model")
+        super().__setattr__(name, value)
+
+    def bind(self, model_name: str, **kwargs) -> "LLMService":
+        """Returns an immutable handle on the service bound to the model.
+
+        The handle shares the pooled clients, caches and schedulers of the service but none of its
+        model settings, so requests using different models can run concurrently.
+        """
+        handle = copy.copy(self)
+        handle.__dict__.pop("_bound", None)
+        handle._bind_model(model_name, **kwargs)
+        handle._bound = True
+        return handle
+
+    def _bind_model(self, model_name: str, **kwargs):
+        self.model_name = model_name
+
+    def request_model(self) -> str:
+        """Returns the model (or deployment) name sent to the provider"""
+        return self.model_name
 
-    async def token_counter(self,response: str) -> int:
-        enc = tiktoken.encoding_for_model(self.model_name)
-        return len(enc.encode(response))
+    def endpoint_settings(self) -> dict:
+        """Returns the settings that select the provider endpoint, empty for providers with a single one"""
+        return {}
+
+    def endpoints(self) -> list[LLMEndpoint]:
+        """Returns the pool of equivalent endpoints the calls are balanced across, the configured one first"""
+        return []
+
+    @asynccontextmanager
+    async def endpoint(self) -> AsyncIterator["LLMService"]:
+        """Leases an endpoint of the pool for a call, yielding the handle bound to it"""
+        async with self.balancer.lease(self.provider, self.endpoint_settings()) as endpoint:
+            yield self if endpoint is None else self.bind(self.model_name, **endpoint.settings)
+
+    async def token_counter(self, response: str, estimate: bool = False) -> int:
+        """Returns the number of tokens of the text for this model, or a cheap estimate of it"""
+        if estimate:
+            return self.tokenizer.estimate(response, self.model_name)
+        return await self.tokenizer.count(response, self.model_name)
+
+    def request_tokens(self, prompt: str, system_message: str, kwargs: dict) -> int:
+        """Returns the estimated tokens a request is charged by the scheduler"""
+        prompt_tokens = self.tokenizer.estimate(system_message + prompt, self.model_name)
+        return self.scheduler.estimate_tokens(prompt_tokens, kwargs.get("max_tokens"))
+
+    def refund_tokens(self, request_tokens: int, llm_call: LLMCall) -> None:
+        """Refunds the scheduler the tokens the call was charged over the usage the provider reported"""
+        if llm_call.usage is not None:
+            self.scheduler.refund(self.provider, self.request_model(), request_tokens, llm_call.usage.input_tokens + llm_call.usage.output_tokens)
 
     async def acompletion(
         self,
         prompt: str,
         stream_response: Any,
         role: str = Roles.admin.value,
-        system_message: str = "You are a helpful ai assistent",
+        system_message: str = None,
+        stage: str = LLMStage.other.value,
+        response_schema: dict = None,
+        use_cache: bool = True,
         **kwargs
     ):
-        tokens = []
-        client = AsyncAzureOpenAI(
+        system_message = system_message or self.default_system_message
+        validator = self.stream_validator(response_schema)
+        response_schema = self.structured_output(response_schema)
+        with self.telemetry.call(self.provider, self.request_model(), stage, streaming=True) as llm_call:
+            cache_partition = self.response_cache.partition(self.provider, self.request_model(), system_message, {**kwargs, "response_schema": response_schema})
+            # Callers retrying a rejected response skip the lookup, the fresh response replaces the cached one
+            llm_response = await self.cached_response(cache_partition, prompt) if use_cache else None
+            llm_call.cached = llm_response is not None
+
+            if llm_call.cached:
+                await self.response_cache.replay(llm_response, stream_response)
+            else:
+                tokens = []
+                request_tokens = self.request_tokens(prompt, system_message, kwargs)
+                async with self.scheduler.slot(self.provider, self.request_model(), request_tokens) as queue_seconds:
+                    llm_call.queue_seconds = queue_seconds
+                    async with self.streamer.stream(stream_response) as stream, aclosing(
+                            self._validated_stream(prompt, system_message, validator, llm_call, response_schema=response_schema, **kwargs)) as validated_tokens:
+                        async for token in validated_tokens:
+                            tokens.append(token)
+                            await stream.push(token)
+                self.refund_tokens(request_tokens, llm_call)
+                llm_response = "".join(tokens)
+                await self.cache_response(cache_partition, prompt, llm_response)
+            self.estimate_call_tokens(llm_call, system_message + prompt, llm_response)
+        self.mirror(stage, prompt, system_message, response_schema, kwargs, llm_response, llm_call)
+
+        if role == Roles.Developer.value:
+            await self.log_llm_responses(prompt, llm_response, llm_call)
+
+        return llm_response
+
+    async def completion(self, prompt: str, role: str, system_message: str = None, stage: str = LLMStage.other.value, response_schema: dict = None, use_cache: bool = True, **kwargs):
+        system_message = system_message or self.default_system_message
+        validator = self.stream_validator(response_schema)
+        response_schema = self.structured_output(response_schema)
+        with self.telemetry.call(self.provider, self.request_model(), stage, streaming=False) as llm_call:
+            cache_partition = self.response_cache.partition(self.provider, self.request_model(), system_message, {**kwargs, "response_schema": response_schema})
+            # Callers retrying a rejected response skip the lookup, the fresh response replaces the cached one
+            llm_response = await self.cached_response(cache_partition, prompt) if use_cache else None
+            llm_call.cached = llm_response is not None
+
+            if not llm_call.cached:
+                request_tokens = self.request_tokens(prompt, system_message, kwargs)
+                async with self.scheduler.slot(self.provider, self.request_model(), request_tokens) as queue_seconds:
+                    llm_call.queue_seconds = queue_seconds
+                    if validator is None:
+                        llm_response = await retry_policy("llm").call(
+                            self._endpoint_completion, prompt, system_message, response_schema=response_schema, **kwargs)
+                    else:
+                        # Streamed, so a response that cannot be valid is aborted instead of paid for in full
+                        async with aclosing(self._validated_stream(prompt, system_message, validator, llm_call, response_schema=response_schema, **kwargs)) as validated_tokens:
+                            llm_response = "".join([token async for token in validated_tokens]).strip()
+                self.refund_tokens(request_tokens, llm_call)
+                await self.cache_response(cache_partition, prompt, llm_response)
+            self.estimate_call_tokens(llm_call, system_message + prompt, llm_response)
+        self.mirror(stage, prompt, system_message, response_schema, kwargs, llm_response, llm_call)
+        Main.logger().info(f"*** Response from {self.__class__.__name__} *** {llm_response} ")
+
+        if role == Roles.Developer.value:
+            await self.log_llm_responses(prompt, llm_response, llm_call)
+        return llm_response
+
+    async def cached_response(self, cache_partition: str, prompt: str) -> str | None:
+        """Returns the cached response of the prompt, shadow calls are always made to measure the shadow model"""
+        if current_request_context().mirrored_request_id:
+            return None
+        return await self.response_cache.get(cache_partition, prompt)
+
+    async def cache_response(self, cache_partition: str, prompt: str, response: str) -> None:
+        if not current_request_context().mirrored_request_id:
+            await self.response_cache.set(cache_partition, prompt, response)
+
+    def mirror(self, stage: str, prompt: str, system_message: str, response_schema: dict | None, kwargs: dict, response: str, llm_call: LLMCall) -> None:
+        """Mirrors the live call to the shadow model of its stage when the request is sampled for shadow traffic"""
+        shadow = current_request_context().shadow
+        if shadow is not None and not llm_call.cached:
+            shadow.mirror(stage, prompt, system_message, response_schema, kwargs, response, llm_call)
+
+    async def _endpoint_completion(self, prompt: str, system_message: str, **kwargs) -> str:
+        """Returns the full completion from an endpoint of the pool"""
+        async with self.endpoint() as service:
+            return await service._completion(prompt, system_message, **kwargs)
+
+    async def _validated_stream(self, prompt: str, system_message: str, validator: JSONStreamValidator | None, llm_call: LLMCall, **kwargs) -> AsyncIterator[str]:
+        """Streams the completion tokens, aborting a JSON response as soon as it cannot be valid.
+
+        Closing the provider stream drops its connection, so the provider stops generating the rest. Once
+        the JSON is complete the rest of the stream is drained without being yielded, it carries the usage.
+        Transient failures are retried until the first token is yielded, the caller cannot take it back.
+        """
+        policy = retry_policy("llm")
+        policy.record_call()
+        attempt, streamed = 1, False
+        while True:
+            try:
+                async with self.endpoint() as service, aclosing(service._stream_completion(prompt, system_message, **kwargs)) as tokens:
+                    async for token in tokens:
+                        llm_call.token()
+                        if validator is not None:
+                            if validator.complete:
+                                continue
+                            token = validator.feed(token)
+                        if token:
+                            streamed = True
+                            yield token
+                break
+            except Exception as e:
+                delay = None if streamed else policy.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                Main.logger().info(f"Retrying {self.provider} stream in {delay:.2f}s after attempt {attempt} failed with {e!r}")
+                await asyncio.sleep(delay)
+                attempt += 1
+        if validator is not None:
+            validator.finish()
+
+    def stream_validator(self, response_schema: dict | None) -> JSONStreamValidator | None:
+        """Returns the validator of a streamed response of the schema, None when early abort is disabled"""
+        if response_schema is None or not Main.configuration().llm_structured_output_configuration.early_abort_enabled:
+            return None
+        return JSONStreamValidator(response_schema)
+
+    def structured_output(self, response_schema: dict | None) -> dict | None:
+        """Returns the JSON schema the response is constrained to, None when structured output is disabled"""
+        if not Main.configuration().llm_structured_output_configuration.enabled:
+            return None
+        return response_schema
+
+    def estimate_call_tokens(self, llm_call: LLMCall, prompt: str, response: str) -> None:
+        """Falls back to tokenizer estimates for providers that did not report the usage of the call"""
+        if llm_call.usage is None and not llm_call.cached:
+            llm_call.estimated_prompt_tokens = self.tokenizer.estimate(prompt, self.request_model())
+            llm_call.estimated_completion_tokens = self.tokenizer.estimate(response, self.request_model())
+
+    async def _stream_completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> AsyncIterator[str]:
+        """Streams the completion tokens from the provider, the JSON of the response schema when one is given"""
+        raise NotImplementedError
+        yield
+
+    async def _completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> str:
+        """Returns the full completion from the provider, the JSON of the response schema when one is given"""
+        raise NotImplementedError
+
+    async def run_batch(self, requests: list[LLMBatchRequest], poll_interval_seconds: float) -> dict[str, LLMBatchResult]:
+        """Runs the requests through the batch API of the provider, waiting for it to finish"""
+        raise NotImplementedError
+
+    def record_usage(self, usage: LLMTokenUsage) -> None:
+        """Records the token usage the provider reported for the call being made"""
+        self.usage_tracker.record(self.provider, self.request_model(), usage)
+        llm_call = current_llm_call()
+        if llm_call is not None:
+            llm_call.usage = usage
+
+    async def log_llm_responses(self, prompt: str, response: str, llm_call: LLMCall):
+        """Queues the prompt/response pair for the LLM log sink"""
+        self.log_sink.submit({
+            "request_id": current_request_context().request_id,
+            "provider": self.provider,
+            "model": self.request_model(),
+            "stage": llm_call.stage,
+            "prompt": prompt,
+            "response": response,
+            "latency_seconds": round(llm_call.latency(), 3),
+            "cached": llm_call.cached,
+            # Left empty without provider usage, the log sink counts them with the tokenizer
+            "prompt_tokens": llm_call.usage.input_tokens if llm_call.usage else None,
+            "completion_tokens": llm_call.usage.output_tokens if llm_call.usage else None,
+        })
+
+
+class AzureOpenAIService(LLMService):
+
+    provider = LLMProvider.azure_openai.value
+    
+    def __init__(self, client_pool: LLMClientPool, response_cache: LLMResponseCache, tokenizer: TokenizerService, scheduler: LLMScheduler, log_sink: LLMLogSink, streamer: TokenStreamer, usage_tracker: UsageTracker, telemetry: LLMTelemetry, balancer: LLMEndpointBalancer):
+        super().__init__(client_pool, response_cache, tokenizer, scheduler, log_sink, streamer, usage_tracker, telemetry, balancer)
+        self.api_type = Main.configuration().azureai_configuration.type
+        self.api_key = Main.configuration().azureai_configuration.api_key
+        self.api_base = Main.configuration().azureai_configuration.base
+        self.api_version = Main.configuration().azureai_configuration.version
+        self.deployment_name = Main.configuration().azureai_configuration.deployment_name
+        self.model_name = Main.configuration().azureai_configuration.model_name
+        self.embedding_deployment_name = Main.configuration().azureai_configuration.embedding_deployment_name
+
+    def _bind_model(self, model_name: str, **kwargs):
+        """Deployment settings that are not given keep their configured values"""
+        self.model_name = model_name
+        self.api_type = kwargs.get("api_type", self.api_type)
+        self.api_key = kwargs.get("api_key", self.api_key)
+        self.api_base = kwargs.get("api_base", self.api_base)
+        self.api_version = kwargs.get("api_version", self.api_version)
+        self.deployment_name = kwargs.get("deployment_name", self.deployment_name)
+        self.embedding_deployment_name = kwargs.get("embedding_deployment_name", self.embedding_deployment_name)
+
+    def client(self) -> AsyncAzureOpenAI:
+        """Returns the pooled client for the current deployment"""
+        return self.client_pool.azure_openai_client(
             api_key=self.api_key,
             azure_endpoint=self.api_base,
             api_version=self.api_version,
         )
-        async for stream_resp in await client.chat.completions.create(
+
+    def request_model(self) -> str:
+        return self.deployment_name
+
+    def endpoint_settings(self) -> dict:
+        return {"api_key": self.api_key, "api_base": self.api_base, "api_version": self.api_version, "deployment_name": self.deployment_name}
+
+    def endpoints(self) -> list[LLMEndpoint]:
+        deployments = Main.configuration().azureai_configuration.deployments
+        if not deployments:
+            return []
+        configured = self.endpoint_settings()
+        pool = [configured] + [
+            {
+                "api_key": deployment.api_key or configured["api_key"],
+                "api_base": deployment.base or configured["api_base"],
+                "api_version": deployment.version or configured["api_version"],
+                "deployment_name": deployment.deployment_name or configured["deployment_name"],
+            }
+            for deployment in deployments
+        ]
+        return [
+            LLMEndpoint(self.provider, f"{urlparse(settings['api_base'] or '').hostname}/{settings['deployment_name']}", settings)
+            for settings in pool
+        ]
+
+    async def _stream_completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> AsyncIterator[str]:
+        response_tool = ResponseTool(response_schema) if response_schema else None
+        arguments = []
+        async with await self.client().chat.completions.create(
             model=self.deployment_name,
             temperature = 0,
             stream=True,
+            # The last chunk carries the usage, including the prompt tokens served from the cache
+            stream_options={"include_usage": True},
             messages=[
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": prompt},
             ],
+            **(response_tool.openai_kwargs() if response_tool else {}),
             **kwargs
-        ):
-            if stream_resp.choices and stream_resp.choices[0].delta.content:
-                token = stream_resp.choices[0].delta.content
-                model_name = self.model_name
-                tokens.append(token)
-                await stream_response(token)
-                
-        if role == Roles.Developer.value:
-            await self.log_llm_responses(prompt, "".join(tokens), self.model_name)
-
-        return "".join(tokens)
+        ) as stream:
+            async for stream_resp in stream:
+                if stream_resp.usage:
+                    self.record_usage(OpenAIService._usage(stream_resp.usage))
+                if not stream_resp.choices:
+                    continue
+                delta = stream_resp.choices[0].delta
+                if delta.content:
+                    yield delta.content
+                elif response_tool and delta.tool_calls and delta.tool_calls[0].function.arguments:
+                    # Wrapped responses can only be unwrapped once complete
+                    if response_tool.wrapped:
+                        arguments.append(delta.tool_calls[0].function.arguments)
+                    else:
+                        yield delta.tool_calls[0].function.arguments
+        if arguments:
+            yield response_tool.response("".join(arguments))
    
-    async def completion(self, prompt:str, role:str, system_message:str = "You are a helpful ai assistent",**kwargs):
-        client = AzureOpenAI(
-            api_key=self.api_key,
-            azure_endpoint=self.api_base,
-            api_version=self.api_version,
-        )
-
-        response = client.chat.completions.create(
+    async def _completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> str:
+        response_tool = ResponseTool(response_schema) if response_schema else None
+        response = await self.client().chat.completions.create(
             # engine = self.deployment_name,
             temperature=0,
             model=self.deployment_name,
@@ -93,33 +395,15 @@ class AzureOpenAIService(Service):
                 {"role": "system","content": system_message},
                 {"role": "user", "content": prompt },
                 ],
+                **(response_tool.openai_kwargs() if response_tool else {}),
                 **kwargs) 
 
-        llm_response = response.choices[0].message.content.strip()
-        Main.logger().info(f"*** Response from openAI *** {llm_response} ")
-
-        if role == Roles.Developer.value:
-            await self.log_llm_responses(prompt, llm_response, self.model_name)
-        return llm_response
-
-    async def log_llm_responses(self, prompt: str, response: str, model_name: str):
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        
-        llm_log_dir = Path(Main.configuration().common_configuration.llm_logs_dir)
-        llm_log_dir.mkdir(exist_ok=True)
-
-
-        file_name = "llm_logs_"+current_date+".csv"
-        file_path = llm_log_dir / file_name
-
-        row = [prompt, response, model_name]
-        if (os.path.isfile(file_path)):
-            with open(file_path, "a") as write_object:
-                csv.writer(write_object).writerow(row)
-        else:
-            with open(file_path, "a") as write_object:
-                init_row=["Prompt", "Response", "Model Name", "\n"]
-                write_object.write(','.join(map(str, init_row)))
+        if response.usage:
+            self.record_usage(OpenAIService._usage(response.usage))
+        message = response.choices[0].message
+        if response_tool and message.tool_calls:
+            return response_tool.response(message.tool_calls[0].function.arguments)
+        return message.content.strip()
 
     async def get_llm(self):
         llm = AzureChatOpenAI(
@@ -143,66 +427,152 @@ class AzureOpenAIService(Service):
         
         return embedding_function
 
-class OpenAIService(Service):
-    def __init__(self):
-        super().__init__() 
+class OpenAIService(LLMService):
+
+    provider = LLMProvider.openai.value
+
+    def __init__(self, client_pool: LLMClientPool, response_cache: LLMResponseCache, tokenizer: TokenizerService, scheduler: LLMScheduler, log_sink: LLMLogSink, streamer: TokenStreamer, usage_tracker: UsageTracker, telemetry: LLMTelemetry, balancer: LLMEndpointBalancer):
+        super().__init__(client_pool, response_cache, tokenizer, scheduler, log_sink, streamer, usage_tracker, telemetry, balancer)
         self.api_key = Main.configuration().openai_configuration.api_key
         self.model_name = Main.configuration().openai_configuration.model_name
-        self.prompts = PromptStore()
 
-    def set_client_by_model(self, model_name: str, **kwargs):
+
+    def client(self) -> AsyncOpenAI:
+        """Returns the pooled OpenAI client"""
+        return self.client_pool.openai_client(api_key=self.api_key)
+
+    def _bind_model(self, model_name: str, **kwargs):
         self.model_name = model_name
+        self.api_key = kwargs.get("api_key", self.api_key)
+
+    def endpoint_settings(self) -> dict:
+        return {"api_key": self.api_key}
+
+    def endpoints(self) -> list[LLMEndpoint]:
+        api_keys = Main.configuration().openai_configuration.api_keys
+        if not api_keys:
+            return []
+        # Named by position, the keys themselves stay out of the logs and metrics
+        return [
+            LLMEndpoint(self.provider, f"key-{index}", {"api_key": api_key})
+            for index, api_key in enumerate([self.api_key] + api_keys)
+        ]
     
-    async def acompletion(
-        self,
-        prompt: str,
-        stream_response: Any,
-        role: str,
-        system_message: str = "You are a helpful ai assistent", **kwargs
-    ):
-        tokens = []
-        client = AsyncOpenAI(
-            api_key=self.api_key,
-        )
-        async for stream_resp in await client.chat.completions.create(
+    async def _stream_completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> AsyncIterator[str]:
+        response_tool = ResponseTool(response_schema) if response_schema else None
+        arguments = []
+        async with await self.client().chat.completions.create(
             model=self.model_name,
             temperature = 0,
             stream=True,
+            # The last chunk carries the usage, including the prompt tokens served from the cache
+            stream_options={"include_usage": True},
             messages=[
                 {"role": "system", "content": system_message},
                 {"role": "user", "content": prompt},
             ],
+            **(response_tool.openai_kwargs() if response_tool else {}),
             **kwargs
-        ):
-            if stream_resp.choices and stream_resp.choices[0].delta.content:
-                token = stream_resp.choices[0].delta.content
-                model_name = self.model_name 
-                tokens.append(token)
-                await stream_response(token)
-
-        if role == Roles.Developer.value:
-            await self.log_llm_responses(prompt, "".join(tokens), self.model_name)
-
-        return "".join(tokens)
-
-    async def completion(self, prompt:str,role: str,system_message:str = "You are a helpful ai assistent",**kwargs):
-
-        client = OpenAI(api_key=self.api_key)
-        response = client.chat.completions.create(
+        ) as stream:
+            async for stream_resp in stream:
+                if stream_resp.usage:
+                    self.record_usage(self._usage(stream_resp.usage))
+                if not stream_resp.choices:
+                    continue
+                delta = stream_resp.choices[0].delta
+                if delta.content:
+                    yield delta.content
+                elif response_tool and delta.tool_calls and delta.tool_calls[0].function.arguments:
+                    # Wrapped responses can only be unwrapped once complete
+                    if response_tool.wrapped:
+                        arguments.append(delta.tool_calls[0].function.arguments)
+                    else:
+                        yield delta.tool_calls[0].function.arguments
+        if arguments:
+            yield response_tool.response("".join(arguments))
+
+    async def _completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> str:
+        response_tool = ResponseTool(response_schema) if response_schema else None
+        response = await self.client().chat.completions.create(
             model=self.model_name,
             messages =  [
                 {"role": "system","content": system_message},
                 {"role": "user", "content": prompt },
                 ]
                 ,temperature=0,
+                **(response_tool.openai_kwargs() if response_tool else {}),
                 **kwargs) 
 
-        llm_response = response.choices[0].message.content.strip()
-        Main.logger().info(f"*** Response from openAI *** {llm_response} ")
-        
-        if role == Roles.Developer.value:
-            await self.log_llm_responses(prompt, llm_response, self.model_name)
-        return llm_response
+        if response.usage:
+            self.record_usage(self._usage(response.usage))
+        message = response.choices[0].message
+        if response_tool and message.tool_calls:
+            return response_tool.response(message.tool_calls[0].function.arguments)
+        return message.content.strip()
+
+    async def run_batch(self, requests: list[LLMBatchRequest], poll_interval_seconds: float) -> dict[str, LLMBatchResult]:
+        lines = [
+            json.dumps({
+                "custom_id": request.custom_id,
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": self.model_name,
+                    "temperature": 0,
+                    "messages": [
+                        {"role": "system", "content": request.system_message or self.default_system_message},
+                        {"role": "user", "content": request.prompt},
+                    ],
+                    **request.params,
+                },
+            })
+            for request in requests
+        ]
+        client = self.client()
+        batch_file = await client.files.create(file=("batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+        batch = await client.batches.create(input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+        try:
+            while batch.status not in ("completed", "failed", "expired", "cancelled"):
+                await asyncio.sleep(poll_interval_seconds)
+                batch = await client.batches.retrieve(batch.id)
+        except asyncio.CancelledError:
+            await asyncio.shield(client.batches.cancel(batch.id))
+            raise
+
+        results = {}
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await client.files.content(file_id)
+            for line in content.text.splitlines():
+                output = json.loads(line)
+                response = output.get("response") or {}
+                if response.get("status_code") == 200:
+                    body = response["body"]
+                    self.usage_tracker.record(self.provider, self.model_name, self._usage_from_dict(body.get("usage") or {}))
+                    results[output["custom_id"]] = LLMBatchResult(
+                        custom_id=output["custom_id"], response=body["choices"][0]["message"]["content"].strip())
+                else:
+                    results[output["custom_id"]] = LLMBatchResult(
+                        custom_id=output["custom_id"], error=json.dumps(output.get("error") or response.get("body")))
+        return results
+
+    def _usage_from_dict(self, usage: dict) -> LLMTokenUsage:
+        return LLMTokenUsage(
+            input_tokens=usage.get("prompt_tokens", 0),
+            output_tokens=usage.get("completion_tokens", 0),
+            cache_read_tokens=(usage.get("prompt_tokens_details") or {}).get("cached_tokens", 0),
+        )
+
+    @staticmethod
+    def _usage(usage: Any) -> LLMTokenUsage:
+        """OpenAI caches long prompt prefixes on its own, it only reports the cached part of the prompt"""
+        prompt_tokens_details = getattr(usage, "prompt_tokens_details", None)
+        return LLMTokenUsage(
+            input_tokens=usage.prompt_tokens,
+            output_tokens=usage.completion_tokens,
+            cache_read_tokens=getattr(prompt_tokens_details, "cached_tokens", None) or 0,
+        )
     
     async def get_llm(self):
         llm = ChatOpenAI(
@@ -219,50 +589,27 @@ class OpenAIService(Service):
         
         return embedding_function
 
-    async def token_counter(self,response: str) -> int:
-        enc = tiktoken.encoding_for_model(self.model_name)
-        return len(enc.encode(response))
-    
-    async def log_llm_responses(self, prompt: str, response: str, model_name: str):
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        
-        llm_log_dir = Path(Main.configuration().common_configuration.llm_logs_dir)
-        llm_log_dir.mkdir(exist_ok=True)
-
-
-        file_name = "llm_logs_"+current_date+".csv"
-        file_path = llm_log_dir / file_name
+class PreplexityAIService(LLMService):
 
-        row = [prompt, response, model_name]
-        if (os.path.isfile(file_path)):
-            with open(file_path, "a") as write_object:
-                csv.writer(write_object).writerow(row)
-        else:
-            with open(file_path, "a") as write_object:
-                init_row=["Prompt", "Response", "Model Name", "\n"]
-                write_object.write(','.join(map(str, init_row)))
+    provider = LLMProvider.perplexity_ai.value
+    default_system_message = "You are a very helpful ai assistant"
 
-class PreplexityAIService(Service):
-    def __init__(self):
-        super().__init__() 
+    def __init__(self, client_pool: LLMClientPool, response_cache: LLMResponseCache, tokenizer: TokenizerService, scheduler: LLMScheduler, log_sink: LLMLogSink, streamer: TokenStreamer, usage_tracker: UsageTracker, telemetry: LLMTelemetry, balancer: LLMEndpointBalancer):
+        super().__init__(client_pool, response_cache, tokenizer, scheduler, log_sink, streamer, usage_tracker, telemetry, balancer)
         self.api_key = Main.configuration().perplexityai_configuration.api_key 
         self.model_name = Main.configuration().perplexityai_configuration.model_name
-        self.prompts = PromptStore()
 
-    async def acompletion(
-        self,
-        prompt: str,
-        stream_response: Any,
-        role: str,
-        system_message: str = "You are a very helpful ai assistant", **kwargs
-    ):
-        tokens = []
-        client = AsyncOpenAI(
+    def client(self) -> AsyncOpenAI:
+        """Returns the pooled Perplexity client, Perplexity exposes an OpenAI compatible API"""
+        return self.client_pool.openai_client(
             api_key=self.api_key,
-            base_url = Main.configuration().perplexityai_configuration.api_base,
+            base_url=Main.configuration().perplexityai_configuration.api_base,
+            provider=LLMProvider.perplexity_ai.value,
         )
 
-        async for stream_resp in await client.chat.completions.create(
+    # Perplexity has no tool calling, schema constrained responses rely on the JSON instructions of the prompt
+    async def _stream_completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> AsyncIterator[str]:
+        async with await self.client().chat.completions.create(
             model=self.model_name,
             temperature = 0,
             stream=True,
@@ -270,26 +617,13 @@ class PreplexityAIService(Service):
                 {"role": "user", "content": prompt},
             ],
             **kwargs
-        ):
-            if stream_resp.choices and stream_resp.choices[0].delta.content:
-                token = stream_resp.choices[0].delta.content
-                model_name = self.model_name 
-                tokens.append(token)
-                await stream_response(token)
+        ) as stream:
+            async for stream_resp in stream:
+                if stream_resp.choices and stream_resp.choices[0].delta.content:
+                    yield stream_resp.choices[0].delta.content
 
-        if role == Roles.Developer.value:
-            await self.log_llm_responses(prompt, "".join(tokens), self.model_name)
-
-        return "".join(tokens)
-
-    async def completion(self, prompt:str,role: str,system_message:str = "You are a very helpful ai assistent",**kwargs):
-
-        client = OpenAI(
-            base_url = Main.configuration().perplexityai_configuration.api_base,
-            api_key=self.api_key
-        )
-        
-        response = client.chat.completions.create(
+    async def _completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> str:
+        response = await self.client().chat.completions.create(
             model=self.model_name,
             messages =  [
                 {"role": "user", "content": prompt },
@@ -297,150 +631,347 @@ class PreplexityAIService(Service):
                 ,temperature=0,
                 **kwargs) 
 
-        llm_response = response.choices[0].message.content.strip()
-        Main.logger().info(f"*** Response from Perplexity *** {llm_response} ")
-        
-        if role == Roles.Developer.value:
-            await self.log_llm_responses(prompt, llm_response, self.model_name)
-        return llm_response
+        return response.choices[0].message.content.strip()
 
-    def set_client_by_model(self, model_name: str, **kwargs):
-        self.model_name = model_name
-    
-    async def token_counter(self,response: str) -> int:
-        enc = tiktoken.encoding_for_model("gpt-4")
-        return len(enc.encode(response))
-    
-    async def log_llm_responses(self, prompt: str, response: str, model_name: str):
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        
-        llm_log_dir = Path(Main.configuration().common_configuration.llm_logs_dir)
-        llm_log_dir.mkdir(exist_ok=True)
 
+class AnthropicAIService(LLMService):
 
-        file_name = "llm_logs_"+current_date+".csv"
-        file_path = llm_log_dir / file_name
-
-        row = [prompt, response, model_name]
-        if (os.path.isfile(file_path)):
-            with open(file_path, "a") as write_object:
-                csv.writer(write_object).writerow(row)
-        else:
-            with open(file_path, "a") as write_object:
-                init_row=["Prompt", "Response", "Model Name", "\n"]
-                write_object.write(','.join(map(str, init_row)))
-
-class AnthropicAIService(Service):
+    provider = LLMProvider.anthropic_ai.value
+    default_system_message = "You are a very helpful ai assistent"
+    # Enables cache_control blocks on SDK versions where prompt caching is still in beta
+    PROMPT_CACHING_HEADERS = {"anthropic-beta": "prompt-caching-2024-07-31"}
     
-    def __init__(self) -> None:
-        super().__init__()
+    def __init__(self, client_pool: LLMClientPool, response_cache: LLMResponseCache, tokenizer: TokenizerService, scheduler: LLMScheduler, log_sink: LLMLogSink, streamer: TokenStreamer, usage_tracker: UsageTracker, telemetry: LLMTelemetry, balancer: LLMEndpointBalancer) -> None:
+        super().__init__(client_pool, response_cache, tokenizer, scheduler, log_sink, streamer, usage_tracker, telemetry, balancer)
         self.api_key = Main.configuration().anthropicai_configuration.api_key
-        self.model_completion = Main.configuration().anthropicai_configuration.model_name
+        self.model_name = Main.configuration().anthropicai_configuration.model_name
         self.headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
 
-    async def log_llm_responses(self, prompt: str, response: str, model_name: str):
-        current_date = datetime.now().strftime("%Y-%m-%d")
-        
-        llm_log_dir = Path(Main.configuration().common_configuration.llm_logs_dir)
-        llm_log_dir.mkdir(exist_ok=True)
-
-
-        file_name = "llm_logs_"+current_date+".csv"
-        file_path = llm_log_dir / file_name
-
-        row = [prompt, response, model_name]
-        if (os.path.isfile(file_path)):
-            with open(file_path, "a") as write_object:
-                csv.writer(write_object).writerow(row)
-        else:
-            with open(file_path, "a") as write_object:
-                init_row=["Prompt", "Response", "Model Name", "\n"]
-                write_object.write(','.join(map(str, init_row)))
+    def client(self) -> AnthropicAsyncClient:
+        """Returns the pooled Anthropic client"""
+        return self.client_pool.anthropic_client(api_key=self.api_key)
+
+    def _extra_headers(self) -> dict:
+        """Opts into the prompt caching beta only when prompt caching is enabled"""
+        return self.PROMPT_CACHING_HEADERS if Main.configuration().llm_prompt_cache_configuration.enabled else {}
+
+    def _user_content(self, prompt: str) -> list[dict]:
+        """Sends the static prefix of a segmented prompt as its own block, marked for the prompt cache"""
+        if not isinstance(prompt, SegmentedPrompt) or not prompt.prefix or not Main.configuration().llm_prompt_cache_configuration.enabled:
+            return [{"type": "text", "text": prompt}]
+        content = [{"type": "text", "text": prompt.prefix, "cache_control": {"type": "ephemeral"}}]
+        if prompt.suffix:
+            content.append({"type": "text", "text": prompt.suffix})
+        return content
+
+    async def run_batch(self, requests: list[LLMBatchRequest], poll_interval_seconds: float) -> dict[str, LLMBatchResult]:
+        client = self.client()
+        # Message batches are generally available on recent SDKs and in beta on older ones
+        batches = getattr(client.messages, "batches", None) or getattr(getattr(client.beta, "messages", None), "batches", None)
+        if batches is None:
+            raise NotImplementedError
+        batch = await batches.create(requests=[
+            {
+                "custom_id": request.custom_id,
+                "params": {
+                    "model": self.model_name,
+                    "temperature": 0,
+                    "system": request.system_message or self.default_system_message,
+                    "messages": [{"role": "user", "content": self._user_content(request.prompt)}],
+                    "max_tokens": 4096,
+                    **request.params,
+                },
+            }
+            for request in requests
+        ])
+        try:
+            while batch.processing_status != "ended":
+                await asyncio.sleep(poll_interval_seconds)
+                batch = await batches.retrieve(batch.id)
+        except asyncio.CancelledError:
+            await asyncio.shield(batches.cancel(batch.id))
+            raise
+
+        results = {}
+        async for entry in await batches.results(batch.id):
+            if entry.result.type == "succeeded":
+                message = entry.result.message
+                self.usage_tracker.record(self.provider, self.model_name, self._usage(message.usage))
+                results[entry.custom_id] = LLMBatchResult(custom_id=entry.custom_id, response=message.content[0].text.strip())
+            else:
+                results[entry.custom_id] = LLMBatchResult(
+                    custom_id=entry.custom_id, error=str(getattr(entry.result, "error", None) or entry.result.type))
+        return results
+
+    @staticmethod
+    def _usage(usage: Any, output_tokens: int = None) -> LLMTokenUsage:
+        """Anthropic reports cache reads and writes apart from the uncached input tokens"""
+        cache_read_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+        cache_write_tokens = getattr(usage, "cache_creation_input_tokens", None) or 0
+        return LLMTokenUsage(
+            input_tokens=usage.input_tokens + cache_read_tokens + cache_write_tokens,
+            output_tokens=usage.output_tokens if output_tokens is None else output_tokens,
+            cache_read_tokens=cache_read_tokens,
+            cache_write_tokens=cache_write_tokens,
+        )
                 
-    async def completion(self, prompt:str,role: str,system_message:str = "You are a very helpful ai assistent",**kwargs):
-        
-        client = Anthropic(api_key=self.api_key)
-        
-        response = client.messages.create(
-            model=self.model_completion,
+    async def _completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> str:
+        response_tool = ResponseTool(response_schema) if response_schema else None
+        response = await self.client().messages.create(
+            model=self.model_name,
             temperature=0,
             system=system_message,
             # stream=True,
             messages=[
                 {
                     "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ]
+                    "content": self._user_content(prompt)
                 }
             ],
+            extra_headers=self._extra_headers(),
+            **(response_tool.anthropic_kwargs() if response_tool else {}),
             **kwargs
         )
 
-        llm_response = response.content[0].text.strip()
-        Main.logger().info(f"*** Response from Anthropic *** {llm_response} ")
-        
-        if role == Roles.Developer.value:
-            await self.log_llm_responses(prompt, llm_response, self.model_name)
-        return llm_response
-
-    async def acompletion(self,prompt: str,stream_response: Any,role: str,system_message: str = "You are a very helpful ai assistent", **kwargs):
-        
-        tokens = []
-        client = AnthropicAsyncClient(api_key=self.api_key)
+        self.record_usage(self._usage(response.usage))
+        for content_block in response.content:
+            if response_tool and content_block.type == "tool_use":
+                return response_tool.response(content_block.input)
+        return response.content[0].text.strip()
 
-        async for stream_resp in await client.messages.create(
-            model=self.model_completion,
+    async def _stream_completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> AsyncIterator[str]:
+        response_tool = ResponseTool(response_schema) if response_schema else None
+        start_usage, arguments = None, []
+        async with await self.client().messages.create(
+            model=self.model_name,
             temperature=0,
             system=system_message,
             stream=True,
             messages=[
                 {
                     "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        }
-                    ]
+                    "content": self._user_content(prompt)
                 }
             ],
+            extra_headers=self._extra_headers(),
+            **(response_tool.anthropic_kwargs() if response_tool else {}),
             **kwargs
-        ):
-            if isinstance(stream_resp, AnthropicTypes.content_block_delta_event.ContentBlockDeltaEvent) and stream_resp.delta.text:
-                token = stream_resp.delta.text
-                model_name = self.model_name 
-                tokens.append(token)
-                await stream_response(token)
-
-        if role == Roles.Developer.value:
-            await self.log_llm_responses(prompt, "".join(tokens), self.model_name)
-
-        return "".join(tokens)
-      
+        ) as stream:
+            async for stream_resp in stream:
+                if isinstance(stream_resp, AnthropicTypes.content_block_delta_event.ContentBlockDeltaEvent):
+                    if getattr(stream_resp.delta, "text", None):
+                        yield stream_resp.delta.text
+                    elif getattr(stream_resp.delta, "partial_json", None):
+                        # Wrapped responses can only be unwrapped once complete
+                        if response_tool.wrapped:
+                            arguments.append(stream_resp.delta.partial_json)
+                        else:
+                            yield stream_resp.delta.partial_json
+                elif stream_resp.type == "message_start":
+                    # The input and cache usage come first, the output tokens with the final message delta
+                    start_usage = stream_resp.message.usage
+                elif stream_resp.type == "message_delta" and start_usage is not None:
+                    self.record_usage(self._usage(start_usage, stream_resp.usage.output_tokens))
+        if arguments:
+            yield response_tool.response("".join(arguments))
     
-    def set_client_by_model(self, model_name: str, **kwargs):
-        self.model_name = model_name
+
+class FakeLLMService(LLMService):
+    """Offline provider answering from templates with a configurable latency profile, for load tests and benchmarks"""
+
+    provider = LLMProvider.fake.value
+    default_system_message = "You are a very helpful ai assistant"
+
+    def __init__(self, client_pool: LLMClientPool, response_cache: LLMResponseCache, tokenizer: TokenizerService, scheduler: LLMScheduler, log_sink: LLMLogSink, streamer: TokenStreamer, usage_tracker: UsageTracker, telemetry: LLMTelemetry, balancer: LLMEndpointBalancer):
+        super().__init__(client_pool, response_cache, tokenizer, scheduler, log_sink, streamer, usage_tracker, telemetry, balancer)
+        self.model_name = Main.configuration().fake_llm_configuration.model_name
+        self.responder = FakeResponder(Main.configuration().fake_llm_configuration)
+
+    def client(self) -> None:
+        """The fake provider needs no client"""
+        return None
+
+
+    async def token_counter(self, response: str, estimate: bool = False) -> int:
+        return self.tokenizer.estimate(response, self.model_name)
+
+    # The templated responses of the planner and endpoint generator prompts already follow their schemas
+    async def _stream_completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> AsyncIterator[str]:
+        response = self.responder.respond(prompt)
+        await asyncio.sleep(self.responder.time_to_first_token())
+        self.responder.maybe_fail()
+        tokens = self.responder.tokens(response)
+        for index, token in enumerate(tokens):
+            if index:
+                await asyncio.sleep(self.responder.token_interval())
+            yield token
+        self.record_usage(self._usage(system_message + prompt, tokens))
+
+    async def _completion(self, prompt: str, system_message: str, response_schema: dict = None, **kwargs) -> str:
+        response = self.responder.respond(prompt)
+        tokens = self.responder.tokens(response)
+        await asyncio.sleep(self.responder.time_to_first_token() + self.responder.token_interval() * len(tokens))
+        self.responder.maybe_fail()
+        self.record_usage(self._usage(system_message + prompt, tokens))
+        return response.strip()
+
+    def _usage(self, prompt: str, tokens: list[str]) -> LLMTokenUsage:
+        return LLMTokenUsage(input_tokens=self.tokenizer.estimate(prompt, self.model_name), output_tokens=len(tokens))
+
+    async def get_embeddings(self, **kwargs):
+        Main.logger().info(f"Getting embeddings using {self.__class__.__name__}")
+        return HashEmbeddings(Main.configuration().fake_llm_configuration.embedding_dimensions)
 
 class LLMServiceManager(ServiceManager):
 
     def __init__(self):
         super().__init__()
-        self._azure_openai_service= AzureOpenAIService()
-        self._openai_service = OpenAIService()
-        self._perplexity_service = PreplexityAIService()
-        self._anthropic_service = AnthropicAIService()
+        self._client_pool = LLMClientPool(Main.configuration().llm_client_pool_configuration)
+        self._warm_loop = None
+        self._response_cache = LLMResponseCache(Main.configuration().llm_response_cache_configuration)
+        self._tokenizer = TokenizerService(Main.configuration().tokenizer_configuration)
+        self._scheduler = LLMScheduler(Main.configuration().llm_scheduler_configuration)
+        self._log_sink = LLMLogSink(
+            Main.configuration().llm_log_sink_configuration, Main.configuration().common_configuration.llm_logs_dir, self._tokenizer)
+        self._streamer = TokenStreamer(Main.configuration().llm_streaming_configuration)
+        self._usage_tracker = UsageTracker()
+        self._telemetry = LLMTelemetry(Main.configuration().request_ledger_configuration, metrics_registry())
+        self._balancer = LLMEndpointBalancer(Main.configuration().llm_endpoint_pool_configuration, metrics_registry())
+        self._client_pool.add_response_hook(self._balancer.observe_response)
+        shared = (self._client_pool, self._response_cache, self._tokenizer, self._scheduler, self._log_sink, self._streamer, self._usage_tracker, self._telemetry, self._balancer)
+        self._azure_openai_service= AzureOpenAIService(*shared)
+        self._openai_service = OpenAIService(*shared)
+        self._perplexity_service = PreplexityAIService(*shared)
+        self._anthropic_service = AnthropicAIService(*shared)
+        self._fake_service = FakeLLMService(*shared)
+        for service in self.services():
+            self._balancer.register(service.provider, service.endpoints())
+        self._router = LLMRouter(Main.configuration().llm_router_configuration)
+        self._batch_executor = LLMBatchExecutor(Main.configuration().llm_batch_configuration, self._log_sink)
+        self._cascades = {}
+        self._shadow_traffic = ShadowTraffic(
+            Main.configuration().shadow_traffic_configuration, self.get_service, self._scheduler, self._log_sink, metrics_registry())
+        self._prompt_budget = PromptBudgetAllocator(Main.configuration().prompt_budget_configuration, self._tokenizer, metrics_registry())
+
+    def services(self) -> list[Service]:
+        """Returns all provider services"""
+        return [self._azure_openai_service, self._openai_service, self._perplexity_service, self._anthropic_service, self._fake_service]
+
+    async def prepare(self):
+        """Creates the pooled provider clients and loads the tokenizers"""
+        await self._tokenizer.prepare()
+        for service in self.services():
+            try:
+                service.client()
+                service.configured = True
+            except Exception as e:
+                Main.logger().warning(f"Skipping pooled client for {service.__class__.__name__}, it is not configured: {e}")
+
+        if Main.configuration().llm_response_cache_configuration.semantic_enabled:
+            self._response_cache.set_embedding_function(await self.openai_service().get_embeddings())
+
+    async def start(self):
+        """Closes the provider clients created while preparing, the serving loop creates and warms its own"""
+        await self._client_pool.aclose()
+
+    async def warm_up(self):
+        """Creates the pooled provider clients on the running (serving) loop and pre-warms their connections, once per loop"""
+        loop = asyncio.get_running_loop()
+        if not Main.configuration().llm_client_pool_configuration.prewarm or loop is self._warm_loop:
+            return
+        self._warm_loop = loop
+        for service in self.services():
+            if service.configured:
+                service.client()
+        await self._client_pool.warm_up()
+
+    async def destroy(self):
+        """Flushes the LLM logs and closes the pooled provider connections"""
+        await self._shadow_traffic.aclose()
+        await self._log_sink.aclose()
+        await self._client_pool.aclose()
+        self._tokenizer.shutdown()
+
+    def client_pool(self) -> LLMClientPool:
+        return self._client_pool
+
+    def response_cache(self) -> LLMResponseCache:
+        return self._response_cache
+
+    def tokenizer(self) -> TokenizerService:
+        return self._tokenizer
+
+    def router(self) -> LLMRouter:
+        return self._router
+
+    def balancer(self) -> LLMEndpointBalancer:
+        return self._balancer
+
+    def shadow_traffic(self) -> ShadowTraffic:
+        return self._shadow_traffic
+
+    def scheduler(self) -> LLMScheduler:
+        return self._scheduler
+
+    def log_sink(self) -> LLMLogSink:
+        return self._log_sink
+
+    def batch_executor(self) -> LLMBatchExecutor:
+        return self._batch_executor
+
+    def prompt_budget(self) -> PromptBudgetAllocator:
+        return self._prompt_budget
+
+    def usage_stats(self) -> dict:
+        """Returns the provider reported token usage, including prompt cache reads and writes"""
+        return self._usage_tracker.stats()
+
+    def streaming_stats(self) -> dict:
+        """Returns the streamed token and frame counters and the callback overhead"""
+        return self._streamer.stats()
+
+    def routed(self, service: LLMService) -> RoutedLLMService:
+        """Wraps the service so its calls fail over to the configured equivalent providers.
+
+        A provider of the route is only a fallback when its configured model is the model of the service,
+        it keeps its own endpoint settings.
+        """
+        failover_routes = Main.configuration().llm_router_configuration.failover_routes
+        services_by_provider = {fallback.provider: fallback for fallback in self.services()}
+        fallbacks = [
+            services_by_provider[provider] for provider in failover_routes.get(service.provider, [])
+            if provider in services_by_provider and services_by_provider[provider].model_name == service.model_name
+        ]
+        return RoutedLLMService(self._router, service, fallbacks)
+
+    def cascade(self, stage: str, default_service: RoutedLLMService) -> LLMCascade:
+        """Returns the model cascade of the stage, only the default service when the stage has none configured"""
+        if stage not in self._cascades:
+            cascade_configuration = Main.configuration().llm_cascade_configuration
+            tiers = [
+                (self.get_service(llm_provider=tier.provider, model_name=tier.model_name), tier.attempts)
+                for tier in cascade_configuration.cascades.get(stage, [])
+            ] if cascade_configuration.enabled else []
+            self._cascades[stage] = LLMCascade(stage, tiers or [(default_service, 1)], metrics_registry())
+        return self._cascades[stage]
+
+    def cascade_stats(self) -> dict:
+        """Returns the success rate of every model of the cascades by stage"""
+        return {stage: cascade.stats() for stage, cascade in self._cascades.items()}
+
+    def cache_stats(self) -> dict:
+        """Returns the response cache hit/miss counters"""
+        return self._response_cache.stats()
 
     def azure_openai_service(self):
         return self._azure_openai_service
 
     def openai_service(self):
+        if Main.configuration().fake_llm_configuration.replace_providers:
+            return self._fake_service
         return self._openai_service
     
     def perplexity_service(self):
@@ -449,23 +980,17 @@ class LLMServiceManager(ServiceManager):
     def anthropic_service(self):
         return self._anthropic_service
 
+    def fake_service(self):
+        return self._fake_service
+
     def get_service(self,llm_provider: LLMProvider, model_name: str, **kwargs ):
-        match llm_provider:
-            
-            case LLMProvider.openai.value:
-                self._openai_service.set_client_by_model(model_name=model_name, **kwargs)
-                return self._openai_service
-            
-            case LLMProvider.azure_openai.value:
-                self._azure_openai_service.set_client_by_model(model_name=model_name, **kwargs)
-                return self._azure_openai_service
-            
-            case LLMProvider.perplexity_ai.value:
-                self._perplexity_service.set_client_by_model(model_name=model_name, **kwargs)
-                return self._perplexity_service
-            
-            case LLMProvider.anthropic_ai.value:
-                self._anthropic_service.set_client_by_model(model_name=model_name, **kwargs)
-                return self._anthropic_service
+        if Main.configuration().fake_llm_configuration.replace_providers:
+            # Load tests and benchmarks run the whole pipeline against the fake provider
+            llm_provider = LLMProvider.fake.value
+
+        services_by_provider = {service.provider: service for service in self.services()}
+        if llm_provider not in services_by_provider:
+            raise ValueError(f"Unknown LLM provider {llm_provider}")
+        return self.routed(services_by_provider[llm_provider].bind(model_name, **kwargs))
             
             
\ No newline at end of file
@@ -0,0 +1,84 @@
+"""Implements the allocation of the context window of a model across the values of a prompt"""
+
+from collections import defaultdict
+
+from common.base import Main
+from common.data_model import PromptAllocation, PromptBudgetConfiguration, PromptSlot
+from common.metrics import MetricsRegistry
+from LLM.tokenizer import TokenizerService
+
+TRIM_MARKER = "\n[... trimmed to fit the context window ...]\n"
+
+
+class PromptBudgetAllocator:
+    """Fits the values of a prompt template into the context window of a model.
+
+    The budget is the context window less the tokens reserved for the output, a safety margin and
+    the static text of the template. When the values do not fit, the slots of the lowest priority
+    are trimmed first, keeping the head or the tail of their text, and required slots are never
+    trimmed. What was trimmed is logged and counted per prompt and slot.
+    """
+
+    def __init__(self, budget_configuration: PromptBudgetConfiguration, tokenizer: TokenizerService, registry: MetricsRegistry):
+        self._budget_configuration = budget_configuration
+        self._tokenizer = tokenizer
+        self._trimmed_tokens = registry.counter(
+            "prompt_budget_trimmed_tokens_total", "Tokens trimmed from prompt values to fit the context window", ("prompt", "slot"))
+        self._overflows = registry.counter(
+            "prompt_budget_overflows_total", "Prompts whose required values alone exceed the context window", ("prompt",))
+
+    def context_window(self, model_name: str) -> int:
+        """Returns the context window of the model, by the longest matching model name prefix"""
+        prefixes = [prefix for prefix in self._budget_configuration.context_windows if (model_name or "").startswith(prefix)]
+        if not prefixes:
+            return self._budget_configuration.default_context_window
+        return self._budget_configuration.context_windows[max(prefixes, key=len)]
+
+    async def allocate(self, template: str, slots: list[PromptSlot], model_name: str,
+                       reserved_output_tokens: int = None, prompt_name: str = "prompt") -> PromptAllocation:
+        """Returns the slot values trimmed to the budget of the model, the template is formatted with them by the caller"""
+        if reserved_output_tokens is None:
+            reserved_output_tokens = self._budget_configuration.default_reserved_output_tokens
+        static_tokens = await self._tokenizer.count(template.format_map(defaultdict(str)), model_name)
+        budget_tokens = (self.context_window(model_name) - reserved_output_tokens
+                         - self._budget_configuration.safety_margin_tokens - static_tokens)
+
+        values, tokens, dropped = {}, {}, {}
+        for slot in slots:
+            values[slot.name] = slot.text
+            tokens[slot.name] = await self._tokenizer.count(slot.text, model_name)
+            if slot.max_tokens is not None and tokens[slot.name] > slot.max_tokens:
+                await self._trim(slot, slot.max_tokens, model_name, values, tokens, dropped)
+
+        excess_tokens = sum(tokens.values()) - budget_tokens
+        for slot in sorted((slot for slot in slots if not slot.required), key=lambda slot: slot.priority):
+            if excess_tokens <= 0:
+                break
+            slot_tokens = tokens[slot.name]
+            await self._trim(slot, slot_tokens - excess_tokens, model_name, values, tokens, dropped)
+            excess_tokens -= slot_tokens - tokens[slot.name]
+
+        allocation = PromptAllocation(
+            values=values, budget_tokens=budget_tokens, prompt_tokens=static_tokens + sum(tokens.values()),
+            dropped=dropped, fits=excess_tokens <= 0)
+        for slot_name, dropped_tokens in dropped.items():
+            self._trimmed_tokens.inc(dropped_tokens, prompt=prompt_name, slot=slot_name)
+        if dropped:
+            Main.logger().warning(f"Trimmed {prompt_name} prompt for {model_name} to {allocation.prompt_tokens} tokens, dropped tokens by slot: {dropped}")
+        if not allocation.fits:
+            self._overflows.inc(prompt=prompt_name)
+            Main.logger().warning(f"Required values of the {prompt_name} prompt exceed the budget of {model_name} by {excess_tokens} tokens")
+        return allocation
+
+    async def _trim(self, slot: PromptSlot, max_tokens: int, model_name: str, values: dict, tokens: dict, dropped: dict) -> None:
+        """Trims the slot to max_tokens, including the marker telling the model the text was cut"""
+        marker_tokens = self._tokenizer.estimate(TRIM_MARKER, model_name)
+        if max_tokens <= marker_tokens:
+            text = ""
+        else:
+            text = await self._tokenizer.truncate(values[slot.name], max_tokens - marker_tokens, model_name, slot.keep)
+            text = text + TRIM_MARKER if slot.keep == "head" else TRIM_MARKER + text
+        trimmed_tokens = await self._tokenizer.count(text, model_name)
+        dropped[slot.name] = dropped.get(slot.name, 0) + tokens[slot.name] - trimmed_tokens
+        values[slot.name] = text
+        tokens[slot.name] = trimmed_tokens
@@ -0,0 +1,218 @@
+"""Implements latency-aware routing, failover and hedging across equivalent LLM services"""
+
+import asyncio
+import math
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from common.base import Main
+from common.data_model import LLMRouterConfiguration, LLMStage, Roles
+from LLM.json_stream import JSONStreamError
+
+
+class ProviderStats:
+    """Rolling latency and outcome window of one provider model"""
+
+    def __init__(self, window_size: int):
+        self.latencies = deque(maxlen=window_size)
+        self.outcomes = deque(maxlen=window_size)
+
+    def record(self, latency: float | None, success: bool) -> None:
+        if latency is not None:
+            self.latencies.append(latency)
+        self.outcomes.append(success)
+
+    def percentile(self, percentile: float) -> float | None:
+        if not self.latencies:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, math.ceil(percentile * len(latencies)) - 1)]
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def summary(self) -> dict:
+        return {
+            "samples": len(self.outcomes),
+            "error_rate": round(self.error_rate(), 3),
+            "p50_seconds": self.percentile(0.5),
+            "p95_seconds": self.percentile(0.95),
+        }
+
+
+class LLMRouter:
+    """Routes a call across equivalent services, failing over on errors and optionally hedging slow calls.
+
+    Latency is the full duration of a completion and the time to the first token of a streamed one.
+    A hedged request is sent to the next service once the first one exceeds its p95 latency, the first
+    response (or first streamed token) wins and the other request is cancelled.
+    """
+
+    def __init__(self, router_configuration: LLMRouterConfiguration):
+        self._router_configuration = router_configuration
+        self._stats = {}
+
+    def stats_for(self, service: Any, streaming: bool) -> ProviderStats:
+        key = (service.provider, service.request_model(), streaming)
+        if key not in self._stats:
+            self._stats[key] = ProviderStats(self._router_configuration.window_size)
+        return self._stats[key]
+
+    def stats(self) -> dict:
+        """Returns the rolling latency and error rate per provider model"""
+        return {
+            f"{provider}/{model}/{'stream' if streaming else 'completion'}": provider_stats.summary()
+            for (provider, model, streaming), provider_stats in self._stats.items()
+        }
+
+    def order(self, services: list, streaming: bool) -> list:
+        """Orders the services by health, keeping the primary first unless it is failing or much slower"""
+        configuration = self._router_configuration
+
+        def rank(indexed_service):
+            index, service = indexed_service
+            provider_stats = self.stats_for(service, streaming)
+            has_samples = len(provider_stats.outcomes) >= configuration.min_samples
+            unhealthy = has_samples and provider_stats.error_rate() >= configuration.error_rate_threshold
+            return unhealthy, index
+
+        ordered = [service for _, service in sorted(enumerate(services), key=rank)]
+        if len(ordered) > 1 and self._much_slower(ordered[0], ordered[1], streaming):
+            ordered[0], ordered[1] = ordered[1], ordered[0]
+        return ordered
+
+    def _much_slower(self, service: Any, alternative: Any, streaming: bool) -> bool:
+        service_stats, alternative_stats = self.stats_for(service, streaming), self.stats_for(alternative, streaming)
+        if min(len(service_stats.latencies), len(alternative_stats.latencies)) < self._router_configuration.min_samples:
+            return False
+        return service_stats.percentile(0.5) > alternative_stats.percentile(0.5) * self._router_configuration.latency_failover_ratio
+
+    def hedge_delay(self, service: Any, streaming: bool) -> float | None:
+        """Returns how long to wait for the service before hedging, None disables hedging"""
+        configuration = self._router_configuration
+        provider_stats = self.stats_for(service, streaming)
+        if not configuration.hedging_enabled or len(provider_stats.latencies) < configuration.min_samples:
+            return None
+        return max(provider_stats.percentile(0.95), configuration.hedge_min_delay_seconds)
+
+    async def route(self, services: list, call: Callable[[Any, Any], Awaitable[str]], stream_response: Any = None) -> str:
+        """Calls ``call(service, stream_response)`` on the best service, failing over and hedging as configured"""
+        streaming = stream_response is not None
+        candidates = self.order(services, streaming)
+        pending, errors = {}, []
+        committed = None
+
+        def launch():
+            service = candidates.pop(0)
+            attempt = {}
+            task = asyncio.create_task(self._attempt(service, call, gated_stream(attempt), streaming))
+            attempt["task"] = task
+            pending[task] = service
+
+        def gated_stream(attempt: dict):
+            if not streaming:
+                return None
+
+            async def stream(token):
+                nonlocal committed
+                # Bound to the attempt rather than the current task, tokens may be sent from a helper task
+                task = attempt["task"]
+                if committed is None:
+                    # The first attempt to produce a token wins, the others are cancelled
+                    committed = task
+                    for other in pending:
+                        if other is not task:
+                            other.cancel()
+                if committed is task:
+                    await stream_response(token)
+            return stream
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if candidates and committed is None and len(pending) == 1:
+                    timeout = self.hedge_delay(next(iter(pending.values())), streaming)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    Main.logger().info(f"Hedging slow {next(iter(pending.values())).provider} request to {candidates[0].provider}")
+                    launch()
+                    continue
+
+                for task in done:
+                    service = pending.pop(task)
+                    if task.cancelled():
+                        continue
+                    if task.exception() is None:
+                        return task.result()
+                    errors.append(task.exception())
+                    if task is committed or isinstance(task.exception(), JSONStreamError):
+                        # Tokens were already streamed to the caller, or the model itself produced an invalid
+                        # response, the call cannot move elsewhere
+                        raise task.exception()
+                    Main.logger().warning(f"{service.provider} request failed with {task.exception()!r}")
+                    if not pending and candidates:
+                        Main.logger().info(f"Failing over to {candidates[0].provider}")
+                        launch()
+            raise errors[-1] if errors else asyncio.CancelledError()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _attempt(self, service: Any, call: Callable, stream_response: Any, streaming: bool) -> str:
+        provider_stats = self.stats_for(service, streaming)
+        started = time.monotonic()
+        first_token = None
+
+        async def timed_stream(token):
+            nonlocal first_token
+            if first_token is None:
+                first_token = time.monotonic()
+            await stream_response(token)
+
+        try:
+            response = await call(service, timed_stream if streaming else None)
+        except asyncio.CancelledError:
+            if first_token is None:
+                # A hedged away request took at least this long, keep it as a lower bound of its latency
+                provider_stats.latencies.append(time.monotonic() - started)
+            raise
+        except JSONStreamError:
+            # The provider answered, the response was aborted for its content
+            provider_stats.record(time.monotonic() - started, success=True)
+            raise
+        except Exception:
+            provider_stats.record(None, success=False)
+            raise
+        finished = time.monotonic()
+        provider_stats.record((first_token or finished) - started, success=True)
+        return response
+
+
+class RoutedLLMService:
+    """LLM service facade that sends each completion through the router across equivalent services"""
+
+    def __init__(self, router: LLMRouter, primary: Any, fallbacks: list):
+        self._router = router
+        self._primary = primary
+        self._fallbacks = fallbacks
+
+    def __getattr__(self, name: str):
+        return getattr(self._primary, name)
+
+    def services(self) -> list:
+        """Returns the primary service followed by the fallbacks whose client could be configured, bound to its model"""
+        return [self._primary, *[fallback.bind(self._primary.model_name) for fallback in self._fallbacks if fallback.configured]]
+
+    async def acompletion(self, prompt: str, stream_response: Any, role: str = Roles.admin.value, system_message: str = None, stage: str = LLMStage.other.value, **kwargs):
+        async def call(service, stream):
+            return await service.acompletion(prompt, stream, role=role, system_message=system_message, stage=stage, **kwargs)
+        return await self._router.route(self.services(), call, stream_response)
+
+    async def completion(self, prompt: str, role: str, system_message: str = None, stage: str = LLMStage.other.value, **kwargs):
+        async def call(service, _):
+            return await service.completion(prompt, role=role, system_message=system_message, stage=stage, **kwargs)
+        return await self._router.route(self.services(), call)
@@ -0,0 +1,177 @@
+"""Implements the token bucket scheduler every LLM request is submitted through"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+from common.base import Main
+from common.data_model import LLMSchedulerConfiguration
+from common.request_context import current_request_context
+
+
+class TokenBucket:
+    """Refills ``per_minute`` units evenly over a minute, up to a minute worth of burst"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = per_minute
+        self._rate = per_minute / 60.0
+        self._available = float(per_minute)
+        self._updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._available = min(self.capacity, self._available + (now - self._updated) * self._rate)
+        self._updated = now
+
+    def wait_time(self, cost: float) -> float:
+        """Returns the seconds until ``cost`` units are available"""
+        self._refill()
+        return max(0.0, (cost - self._available) / self._rate)
+
+    def consume(self, cost: float):
+        self._refill()
+        self._available -= cost
+
+    def refund(self, units: float):
+        self._refill()
+        self._available = min(self.capacity, self._available + units)
+
+
+class RateLimiter:
+    """Queues requests for one provider model until they fit its RPM, TPM and concurrency budgets.
+
+    Waiters are served strictly by priority, then in arrival order.
+    """
+
+    def __init__(self, name: str, rpm: int = None, tpm: int = None, max_concurrency: int = None):
+        self.name = name
+        self._requests = TokenBucket(rpm) if rpm else None
+        self._tokens = TokenBucket(tpm) if tpm else None
+        self._max_concurrency = max_concurrency
+        self._in_flight = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._wakeup = None
+
+    def queued(self) -> int:
+        return sum(1 for *_, future in self._waiters if not future.done())
+
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    async def acquire(self, tokens: int, priority: int) -> None:
+        if self._tokens:
+            # A request larger than the whole budget would otherwise wait forever
+            tokens = min(tokens, self._tokens.capacity)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), tokens, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release()
+            else:
+                self._dispatch()
+            raise
+
+    def release(self) -> None:
+        self._in_flight -= 1
+        self._dispatch()
+
+    def refund(self, tokens: int, used_tokens: int) -> None:
+        """Gives back the tokens a request was charged but did not use, waking the waiters they now fit"""
+        if not self._tokens:
+            return
+        unused_tokens = min(tokens, self._tokens.capacity) - used_tokens
+        if unused_tokens > 0:
+            self._tokens.refund(unused_tokens)
+            self._dispatch()
+
+    def _dispatch(self):
+        if self._wakeup:
+            self._wakeup.cancel()
+            self._wakeup = None
+
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                heapq.heappop(self._waiters)
+                continue
+            if self._max_concurrency and self._in_flight >= self._max_concurrency:
+                return
+            wait = max(
+                self._requests.wait_time(1) if self._requests else 0.0,
+                self._tokens.wait_time(tokens) if self._tokens else 0.0,
+            )
+            if wait > 0:
+                self._wakeup = asyncio.get_running_loop().call_later(wait, self._dispatch)
+                return
+            if self._requests:
+                self._requests.consume(1)
+            if self._tokens:
+                self._tokens.consume(tokens)
+            heapq.heappop(self._waiters)
+            # Counted as in flight from the moment it is granted, before the waiter resumes
+            self._in_flight += 1
+            future.set_result(None)
+
+
+class LLMScheduler:
+    """Owns one rate limiter per provider model, configured by ``provider/model`` or ``provider`` keys"""
+
+    def __init__(self, scheduler_configuration: LLMSchedulerConfiguration):
+        self._scheduler_configuration = scheduler_configuration
+        self._limiters = {}
+
+    def limiter(self, provider: str, model_name: str) -> RateLimiter | None:
+        key = f"{provider}/{model_name}"
+        if key not in self._limiters:
+            rate_limits = self._scheduler_configuration.rate_limits
+            limits = rate_limits.get(key) or rate_limits.get(provider)
+            self._limiters[key] = RateLimiter(key, **limits) if limits else None
+        return self._limiters[key]
+
+    def estimate_tokens(self, prompt_tokens: int, max_tokens: int = None) -> int:
+        """Returns the tokens a request is charged, the prompt plus the completion it may produce"""
+        return prompt_tokens + (max_tokens or self._scheduler_configuration.default_max_tokens)
+
+    @asynccontextmanager
+    async def slot(self, provider: str, model_name: str, tokens: int):
+        """Waits until the request fits the budgets of its provider model, yields the time spent queued"""
+        limiter = self.limiter(provider, model_name) if self._scheduler_configuration.enabled else None
+        if limiter is None:
+            yield 0.0
+            return
+
+        request_context = current_request_context()
+        # Helper tasks of a cancelled request do not take the capacity live requests are waiting for
+        request_context.raise_if_cancelled()
+        priority = request_context.priority
+        queued_at = time.monotonic()
+        await limiter.acquire(tokens, priority)
+        queue_seconds = time.monotonic() - queued_at
+        if queue_seconds > 1:
+            Main.logger().info(f"Request to {limiter.name} waited {queue_seconds:.2f}s for its rate limit (priority {priority})")
+        try:
+            yield queue_seconds
+        finally:
+            limiter.release()
+
+    def refund(self, provider: str, model_name: str, tokens: int, used_tokens: int) -> None:
+        """Gives back what the estimate of a finished request overcharged, once the provider reported its usage"""
+        limiter = self._limiters.get(f"{provider}/{model_name}")
+        if limiter is not None:
+            limiter.refund(tokens, used_tokens)
+
+    def queued(self) -> int:
+        """Returns the requests waiting for the rate limits of all provider models"""
+        return sum(limiter.queued() for limiter in self._limiters.values() if limiter)
+
+    def stats(self) -> dict:
+        return {
+            key: {"queued": limiter.queued(), "in_flight": limiter.in_flight()}
+            for key, limiter in self._limiters.items() if limiter
+        }
@@ -0,0 +1,172 @@
+"""Implements the mirroring of sampled live LLM calls to alternate stage models"""
+
+import asyncio
+import difflib
+import json
+import random
+from typing import Any, Callable
+
+from common.base import Main
+from common.data_model import RequestPriority, Roles, ShadowTrafficConfiguration
+from common.metrics import MetricsRegistry
+from common.request_context import RequestContext, current_request_context, request_scope
+from LLM.log_sink import LLMLogSink
+from LLM.scheduler import LLMScheduler
+
+SIMILARITY_BUCKETS = (0.1, 0.25, 0.5, 0.75, 0.9, 0.95, 0.99, 1.0)
+
+
+class ShadowTraffic:
+    """Replays the LLM calls of sampled requests on the shadow model of their stage.
+
+    Each shadow call gets the same prompt as the live call once the live call is done, so it never
+    delays or changes the response to the user. It runs in its own request context at the lowest
+    scheduling priority without the response cache, and its latency, token usage and output are
+    compared to those of the live call. Shadow calls are dropped, and the running ones cancelled,
+    as soon as live requests queue up for their rate limits.
+    """
+
+    def __init__(self, shadow_configuration: ShadowTrafficConfiguration, get_service: Callable[..., Any], scheduler: LLMScheduler, log_sink: LLMLogSink, registry: MetricsRegistry):
+        self._shadow_configuration = shadow_configuration
+        self._get_service = get_service
+        self._scheduler = scheduler
+        self._log_sink = log_sink
+        self._services = {}
+        self._tasks = set()
+        self._semaphore = None
+        self._comparisons = {}
+        self._runs = registry.counter("shadow_calls_total", "Shadow calls by stage and outcome", ("stage", "outcome"))
+        self._latency = registry.histogram("shadow_latency_seconds", "Latency of the live and shadow calls, without queueing", ("stage", "model", "run"))
+        self._tokens = registry.counter("shadow_tokens_total", "Tokens of the live and shadow calls", ("stage", "model", "run", "kind"))
+        self._similarity = registry.histogram(
+            "shadow_output_similarity", "Word level similarity of the shadow output to the live output", ("stage", "model"), SIMILARITY_BUCKETS)
+
+    def sample(self, request_context: RequestContext) -> None:
+        """Marks a sampled share of the requests for mirroring"""
+        configuration = self._shadow_configuration
+        if configuration.enabled and configuration.models and random.random() < configuration.sample_rate:
+            request_context.shadow = self
+
+    def mirror(self, stage: str, prompt: str, system_message: str, response_schema: dict | None, kwargs: dict, response: str, llm_call: Any) -> None:
+        """Schedules the shadow call of a finished live call, if its stage has a shadow model and there is room"""
+        shadow_model = self._shadow_configuration.models.get(stage)
+        if shadow_model is None:
+            return
+        if self._overloaded():
+            self._shed()
+            self._runs.inc(stage=stage, outcome="shed")
+            return
+        if len(self._tasks) >= self._shadow_configuration.max_pending:
+            self._runs.inc(stage=stage, outcome="dropped")
+            return
+        request_id = current_request_context().request_id
+        task = asyncio.create_task(self._run(request_id, stage, shadow_model, prompt, system_message, response_schema, kwargs, response, llm_call.summary()))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _overloaded(self) -> bool:
+        return self._scheduler.queued() >= self._shadow_configuration.max_queued_requests
+
+    def _shed(self) -> None:
+        """Cancels the running shadow calls, live requests are waiting for the capacity they use"""
+        for task in list(self._tasks):
+            task.cancel()
+
+    def _service(self, provider: str, model_name: str) -> Any:
+        key = (provider, model_name)
+        if key not in self._services:
+            self._services[key] = self._get_service(llm_provider=provider, model_name=model_name)
+        return self._services[key]
+
+    async def _run(self, request_id: str, stage: str, shadow_model: Any, prompt: str, system_message: str,
+                   response_schema: dict | None, kwargs: dict, live_response: str, live_call: dict) -> None:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._shadow_configuration.max_concurrency)
+        service = self._service(shadow_model.provider, shadow_model.model_name)
+        shadow_context = RequestContext(priority=RequestPriority.shadow.value, request_id=f"{request_id}-shadow")
+        shadow_context.mirrored_request_id = request_id
+        try:
+            async with self._semaphore:
+                with request_scope(shadow_context):
+                    shadow_response = await asyncio.wait_for(
+                        service.completion(prompt, Roles.admin.value, system_message, stage=stage, response_schema=response_schema, **kwargs),
+                        self._shadow_configuration.timeout_seconds)
+        except asyncio.CancelledError:
+            self._runs.inc(stage=stage, outcome="cancelled")
+            return
+        except Exception as e:
+            Main.logger().info(f"Shadow {stage} call to {shadow_model.model_name} failed: {e!r}")
+            self._runs.inc(stage=stage, outcome="error")
+            return
+        shadow_call = shadow_context.llm_calls[-1]
+        similarity, exact_match = await asyncio.to_thread(self._compare, live_response, shadow_response)
+        self._record(request_id, stage, live_call, shadow_call, live_response, shadow_response, similarity, exact_match)
+
+    @staticmethod
+    def _compare(live_response: str, shadow_response: str) -> tuple[float, bool]:
+        """Returns the word level similarity of the outputs, and whether they are equal (as JSON when both parse)"""
+        try:
+            exact_match = json.loads(live_response) == json.loads(shadow_response)
+        except (TypeError, ValueError):
+            exact_match = live_response.strip() == shadow_response.strip()
+        similarity = 1.0 if exact_match else difflib.SequenceMatcher(None, live_response.split(), shadow_response.split(), autojunk=False).ratio()
+        return similarity, exact_match
+
+    def _record(self, request_id: str, stage: str, live_call: dict, shadow_call: dict, live_response: str, shadow_response: str, similarity: float, exact_match: bool) -> None:
+        self._runs.inc(stage=stage, outcome="success")
+        for run, call in (("live", live_call), ("shadow", shadow_call)):
+            labels = {"stage": stage, "model": call["model"], "run": run}
+            self._latency.observe(call["latency_seconds"] - call["queue_seconds"], **labels)
+            self._tokens.inc(call["prompt_tokens"] or 0, kind="prompt", **labels)
+            self._tokens.inc(call["completion_tokens"] or 0, kind="completion", **labels)
+        self._similarity.observe(similarity, stage=stage, model=shadow_call["model"])
+
+        comparison = self._comparisons.setdefault((stage, live_call["model"], shadow_call["model"]), {
+            "calls": 0, "exact_matches": 0, "similarity": 0.0, "live_seconds": 0.0, "shadow_seconds": 0.0,
+            "live_completion_tokens": 0, "shadow_completion_tokens": 0,
+        })
+        comparison["calls"] += 1
+        comparison["exact_matches"] += exact_match
+        comparison["similarity"] += similarity
+        comparison["live_seconds"] += live_call["latency_seconds"] - live_call["queue_seconds"]
+        comparison["shadow_seconds"] += shadow_call["latency_seconds"] - shadow_call["queue_seconds"]
+        comparison["live_completion_tokens"] += live_call["completion_tokens"] or 0
+        comparison["shadow_completion_tokens"] += shadow_call["completion_tokens"] or 0
+
+        record = {
+            "request_id": request_id,
+            "kind": "shadow",
+            "stage": stage,
+            "model": shadow_call["model"],
+            # Tokens of the shadow call, the log sink would count them otherwise
+            "prompt_tokens": shadow_call["prompt_tokens"] or 0,
+            "completion_tokens": shadow_call["completion_tokens"] or 0,
+            "live": live_call,
+            "shadow": shadow_call,
+            "similarity": round(similarity, 4),
+            "exact_match": exact_match,
+        }
+        if self._shadow_configuration.log_responses:
+            record.update(live_response=live_response, shadow_response=shadow_response)
+        self._log_sink.submit(record)
+
+    def stats(self) -> dict:
+        """Returns the mean latency, completion tokens and output similarity of the live and shadow calls per stage and models"""
+        return {
+            f"{stage}: {live_model} -> {shadow_model}": {
+                "calls": comparison["calls"],
+                "exact_match_rate": round(comparison["exact_matches"] / comparison["calls"], 3),
+                "mean_similarity": round(comparison["similarity"] / comparison["calls"], 3),
+                "mean_live_seconds": round(comparison["live_seconds"] / comparison["calls"], 3),
+                "mean_shadow_seconds": round(comparison["shadow_seconds"] / comparison["calls"], 3),
+                "mean_live_completion_tokens": round(comparison["live_completion_tokens"] / comparison["calls"], 1),
+                "mean_shadow_completion_tokens": round(comparison["shadow_completion_tokens"] / comparison["calls"], 1),
+            }
+            for (stage, live_model, shadow_model), comparison in self._comparisons.items()
+        }
+
+    async def aclose(self) -> None:
+        """Cancels the shadow calls still running, used on shutdown"""
+        tasks = list(self._tasks)
+        self._shed()
+        await asyncio.gather(*tasks, return_exceptions=True)
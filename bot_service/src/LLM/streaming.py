@@ -0,0 +1,134 @@
+"""Implements the coalescing adapter between provider token streams and stream_response callbacks"""
+
+import asyncio
+import time
+from typing import Any
+
+from common.data_model import LLMStreamingConfiguration
+
+
+class StreamingStats:
+    """Counts streamed tokens and frames and the time spent in stream_response callbacks"""
+
+    def __init__(self):
+        self.streams = 0
+        self.tokens = 0
+        self.frames = 0
+        self.callback_seconds = 0.0
+
+    def summary(self) -> dict:
+        return {
+            "streams": self.streams,
+            "tokens": self.tokens,
+            "frames": self.frames,
+            "tokens_per_frame": round(self.tokens / self.frames, 2) if self.frames else None,
+            "callback_seconds": round(self.callback_seconds, 3),
+            "callback_ms_per_token": round(self.callback_seconds * 1000 / self.tokens, 4) if self.tokens else None,
+            "callback_ms_per_frame": round(self.callback_seconds * 1000 / self.frames, 4) if self.frames else None,
+        }
+
+
+class CoalescedStream:
+    """Buffers the tokens of one completion and sends them to the callback as frames.
+
+    The first token is sent at once, later tokens are joined into one frame per interval or once the
+    frame is large enough. Frames are sent by a separate task, so while the callback is slow tokens keep
+    joining the next frame; once the buffer is full ``push`` waits, which stops reading the provider.
+    """
+
+    def __init__(self, stream_response: Any, streaming_configuration: LLMStreamingConfiguration, stats: StreamingStats):
+        self._stream_response = stream_response
+        self._streaming_configuration = streaming_configuration
+        self._stats = stats
+        self._buffer = []
+        self._buffered_chars = 0
+        self._has_tokens = asyncio.Event()
+        self._flush_now = asyncio.Event()
+        self._drained = asyncio.Event()
+        self._closing = False
+        self._last_frame = None
+        self._sender = None
+
+    async def __aenter__(self):
+        self._stats.streams += 1
+        if self._streaming_configuration.coalesce_enabled:
+            self._sender = asyncio.create_task(self._send_frames())
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        if self._sender is None:
+            return
+        if exc_type is not None:
+            self._sender.cancel()
+            return
+        self._closing = True
+        self._flush_now.set()
+        self._has_tokens.set()
+        await self._sender
+
+    async def push(self, token: str) -> None:
+        """Adds a token to the stream, waits while the buffer is full"""
+        self._stats.tokens += 1
+        if self._sender is None:
+            await self._send(token)
+            return
+
+        self._buffer.append(token)
+        self._buffered_chars += len(token)
+        self._has_tokens.set()
+        if self._buffered_chars >= self._streaming_configuration.frame_max_chars:
+            self._flush_now.set()
+        if self._buffered_chars >= self._streaming_configuration.max_buffered_chars:
+            self._drained.clear()
+            await self._drained.wait()
+        if self._sender.done():
+            # Surfaces a failing callback, e.g. a closed websocket, to the provider stream
+            self._sender.result()
+
+    async def _send_frames(self):
+        loop = asyncio.get_running_loop()
+        interval = self._streaming_configuration.frame_interval_ms / 1000
+        try:
+            while True:
+                await self._has_tokens.wait()
+                if self._last_frame is not None and not self._flush_now.is_set():
+                    delay = self._last_frame + interval - loop.time()
+                    if delay > 0:
+                        try:
+                            await asyncio.wait_for(self._flush_now.wait(), delay)
+                        except asyncio.TimeoutError:
+                            pass
+
+                frame = "".join(self._buffer)
+                self._buffer, self._buffered_chars = [], 0
+                self._has_tokens.clear()
+                self._flush_now.clear()
+                self._drained.set()
+                if frame:
+                    await self._send(frame)
+                    self._last_frame = loop.time()
+                if self._closing and not self._buffer:
+                    return
+        finally:
+            self._drained.set()
+
+    async def _send(self, frame: str):
+        started = time.perf_counter()
+        await self._stream_response(frame)
+        self._stats.callback_seconds += time.perf_counter() - started
+        self._stats.frames += 1
+
+
+class TokenStreamer:
+    """Creates the coalesced streams of the LLM services and keeps their shared counters"""
+
+    def __init__(self, streaming_configuration: LLMStreamingConfiguration):
+        self._streaming_configuration = streaming_configuration
+        self._stats = StreamingStats()
+
+    def stream(self, stream_response: Any) -> CoalescedStream:
+        return CoalescedStream(stream_response, self._streaming_configuration, self._stats)
+
+    def stats(self) -> dict:
+        """Returns the token and frame counters and the callback overhead per token and per frame"""
+        return self._stats.summary()
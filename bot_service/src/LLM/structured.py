@@ -0,0 +1,40 @@
+"""Implements the schema constrained output of the LLM services through forced tool calls"""
+
+import json
+
+
+class ResponseTool:
+    """A tool the model is forced to call, whose arguments follow the response schema.
+
+    Tool arguments must be a JSON object, so other schemas (the endpoint generator responds with an
+    array) are wrapped in a "response" property and unwrapped again. The response is returned as the
+    JSON text the callers already parse.
+    """
+
+    NAME = "respond"
+
+    def __init__(self, response_schema: dict):
+        schema = {key: value for key, value in response_schema.items() if key not in ("$schema", "description")}
+        self.description = response_schema.get("description", "Responds in the required format")
+        self.wrapped = schema.get("type") != "object"
+        self.parameters = {"type": "object", "properties": {"response": schema}, "required": ["response"]} if self.wrapped else schema
+
+    def openai_kwargs(self) -> dict:
+        return {
+            "tools": [{"type": "function", "function": {"name": self.NAME, "description": self.description, "parameters": self.parameters}}],
+            "tool_choice": {"type": "function", "function": {"name": self.NAME}},
+        }
+
+    def anthropic_kwargs(self) -> dict:
+        return {
+            "tools": [{"name": self.NAME, "description": self.description, "input_schema": self.parameters}],
+            "tool_choice": {"type": "tool", "name": self.NAME},
+        }
+
+    def response(self, arguments: str | dict) -> str:
+        """Returns the JSON text of the response from the tool call arguments"""
+        if isinstance(arguments, str):
+            if not self.wrapped:
+                return arguments.strip()
+            arguments = json.loads(arguments)
+        return json.dumps(arguments["response"] if self.wrapped else arguments)
@@ -0,0 +1,160 @@
+"""Implements the per-call telemetry of the LLM services"""
+
+import asyncio
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from common.base import Main
+from common.data_model import LLMTokenUsage, RequestLedgerConfiguration
+from common.ledger import llm_cost, llm_price
+from common.metrics import MetricsRegistry
+from common.request_context import current_request_context
+
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 20, 40, 60, 80, 120, 200, 400)
+TOKEN_BUCKETS = (100, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000)
+
+
+class LLMCall:
+    """Timings, token usage and outcome of one provider call"""
+
+    def __init__(self, provider: str, model_name: str, stage: str, streaming: bool):
+        self.provider = provider
+        self.model_name = model_name
+        self.stage = stage
+        self.streaming = streaming
+        self.started = time.monotonic()
+        self.first_token_at = None
+        self.finished_at = None
+        self.queue_seconds = 0.0
+        self.cached = False
+        self.outcome = "success"
+        self.usage: LLMTokenUsage | None = None
+        # Tokenizer estimates, used when the provider does not report usage
+        self.estimated_prompt_tokens = None
+        self.estimated_completion_tokens = None
+
+    def token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+
+    def latency(self) -> float:
+        return (self.finished_at or time.monotonic()) - self.started
+
+    def time_to_first_token(self) -> float:
+        return (self.first_token_at or self.finished_at or time.monotonic()) - self.started
+
+    def prompt_tokens(self) -> int | None:
+        return self.usage.input_tokens if self.usage else self.estimated_prompt_tokens
+
+    def completion_tokens(self) -> int | None:
+        return self.usage.output_tokens if self.usage else self.estimated_completion_tokens
+
+    def tokens_per_second(self) -> float | None:
+        """Output tokens per second after the first token, the generation speed of the model"""
+        completion_tokens = self.completion_tokens()
+        generation_seconds = (self.finished_at or time.monotonic()) - (self.first_token_at or self.started)
+        if not completion_tokens or generation_seconds <= 0:
+            return None
+        return completion_tokens / generation_seconds
+
+    def summary(self) -> dict:
+        tokens_per_second = self.tokens_per_second()
+        return {
+            "provider": self.provider,
+            "model": self.model_name,
+            "stage": self.stage,
+            "outcome": self.outcome,
+            "cached": self.cached,
+            "queue_seconds": round(self.queue_seconds, 3),
+            "ttft_seconds": round(self.time_to_first_token(), 3),
+            "latency_seconds": round(self.latency(), 3),
+            "prompt_tokens": self.prompt_tokens(),
+            "completion_tokens": self.completion_tokens(),
+            "tokens_per_second": round(tokens_per_second, 1) if tokens_per_second else None,
+            "usage_source": "provider" if self.usage else "tokenizer",
+        }
+
+
+_current_call: ContextVar[LLMCall | None] = ContextVar("llm_call", default=None)
+
+
+def current_llm_call() -> LLMCall | None:
+    """Returns the provider call being made by the current task, if any"""
+    return _current_call.get()
+
+
+class LLMTelemetry:
+    """Records every LLM call into the metrics registry and the trace of the request it belongs to"""
+
+    def __init__(self, ledger_configuration: RequestLedgerConfiguration, registry: MetricsRegistry):
+        self._ledger_configuration = ledger_configuration
+        labels = ("provider", "model", "stage")
+        self._calls = registry.counter("llm_calls_total", "LLM calls by outcome", (*labels, "outcome"))
+        self._cache_hits = registry.counter("llm_response_cache_hits_total", "LLM calls served by the response cache", labels)
+        self._tokens = registry.counter("llm_tokens_total", "LLM tokens by kind", (*labels, "kind"))
+        self._queue_seconds = registry.histogram("llm_queue_seconds", "Time spent waiting for the rate limit", labels)
+        self._ttft_seconds = registry.histogram("llm_time_to_first_token_seconds", "Time to the first streamed token", labels)
+        self._latency_seconds = registry.histogram("llm_latency_seconds", "Total latency of a call", labels)
+        self._tokens_per_second = registry.histogram(
+            "llm_output_tokens_per_second", "Output tokens per second after the first token", labels, TOKENS_PER_SECOND_BUCKETS)
+        self._prompt_tokens = registry.histogram("llm_prompt_tokens", "Prompt tokens per call", labels, TOKEN_BUCKETS)
+        self._cost = registry.counter("llm_cost_usd_total", "Estimated cost of the LLM calls in USD", labels)
+
+    @contextmanager
+    def call(self, provider: str, model_name: str, stage: str, streaming: bool):
+        """Measures the provider call made in the block, the LLM service fills in tokens and usage"""
+        llm_call = LLMCall(provider, model_name, stage, streaming)
+        token = _current_call.set(llm_call)
+        try:
+            yield llm_call
+        except asyncio.CancelledError:
+            llm_call.outcome = "cancelled"
+            raise
+        except Exception as e:
+            llm_call.outcome = type(e).__name__
+            raise
+        finally:
+            _current_call.reset(token)
+            llm_call.finished_at = time.monotonic()
+            self._record(llm_call)
+
+    def cost(self, llm_call: LLMCall) -> float | None:
+        """Returns the estimated cost in USD of the call, None when its model has no price"""
+        price = llm_price(self._ledger_configuration.prices, llm_call.provider, llm_call.model_name)
+        if price is None:
+            return None
+        usage = llm_call.usage or LLMTokenUsage()
+        return llm_cost(price, llm_call.prompt_tokens() or 0, llm_call.completion_tokens() or 0, usage.cache_read_tokens, usage.cache_write_tokens)
+
+    def _record(self, llm_call: LLMCall) -> None:
+        labels = {"provider": llm_call.provider, "model": llm_call.model_name, "stage": llm_call.stage}
+        outcome = llm_call.outcome if llm_call.outcome in ("success", "cancelled") else "error"
+        self._calls.inc(outcome=outcome, **labels)
+        request_context = current_request_context()
+        request_context.llm_calls.append(llm_call.summary())
+        # Failed and cancelled calls are charged too, an aborted stream is billed for the tokens it produced
+        cost = self.cost(llm_call)
+        request_context.ledger.record_llm_call(
+            llm_call.provider, llm_call.model_name, llm_call.stage, llm_call.prompt_tokens() or 0, llm_call.completion_tokens() or 0,
+            cost, llm_call.latency(), cached=llm_call.cached)
+        if cost and not llm_call.cached:
+            self._cost.inc(cost, **labels)
+        if llm_call.outcome != "success":
+            Main.logger().info(f"LLM call to {llm_call.provider}/{llm_call.model_name} ended with {llm_call.outcome} after {llm_call.latency():.2f}s")
+            return
+        if llm_call.cached:
+            self._cache_hits.inc(**labels)
+            return
+
+        self._queue_seconds.observe(llm_call.queue_seconds, **labels)
+        self._latency_seconds.observe(llm_call.latency(), **labels)
+        if llm_call.streaming:
+            self._ttft_seconds.observe(llm_call.time_to_first_token(), **labels)
+        self._tokens_per_second.observe(llm_call.tokens_per_second(), **labels)
+        self._prompt_tokens.observe(llm_call.prompt_tokens(), **labels)
+        self._tokens.inc(llm_call.prompt_tokens() or 0, kind="prompt", **labels)
+        self._tokens.inc(llm_call.completion_tokens() or 0, kind="completion", **labels)
+        if llm_call.usage:
+            self._tokens.inc(llm_call.usage.cache_read_tokens, kind="cache_read", **labels)
+            self._tokens.inc(llm_call.usage.cache_write_tokens, kind="cache_write", **labels)
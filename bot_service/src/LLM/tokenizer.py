@@ -0,0 +1,143 @@
+"""Implements the tokenizer service used to count and estimate prompt tokens"""
+
+import asyncio
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import tiktoken
+
+from common.base import Main
+from common.data_model import TokenizerConfiguration
+
+
+class TokenizerService:
+    """Counts tokens per model with cached encoders, large texts are encoded in a worker pool.
+
+    OpenAI models use their own tiktoken encoding. Claude and the Llama based Perplexity models have
+    no public tiktoken encoding, so they are counted with ``cl100k_base`` and scaled to their tokenizer.
+    """
+
+    DEFAULT_ENCODING = "cl100k_base"
+    PRELOADED_ENCODINGS = ("cl100k_base", "o200k_base")
+
+    # model name prefix -> (encoding name, scale applied to the count, characters per token estimate)
+    MODEL_FAMILIES = {
+        "claude": ("cl100k_base", 1.15, 3.5),
+        "llama": ("cl100k_base", 1.0, 4.0),
+        "sonar": ("cl100k_base", 1.0, 4.0),
+        "mixtral": ("cl100k_base", 1.1, 3.7),
+    }
+
+    def __init__(self, tokenizer_configuration: TokenizerConfiguration):
+        self._tokenizer_configuration = tokenizer_configuration
+        # tiktoken reads and writes its BPE files here instead of fetching them on every start
+        os.environ.setdefault("TIKTOKEN_CACHE_DIR", tokenizer_configuration.cache_dir)
+        self._encodings = {}
+        self._model_encodings = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=tokenizer_configuration.max_workers, thread_name_prefix="tokenizer")
+
+    async def prepare(self):
+        """Loads the common encodings in the worker pool so the first count does not pay for it"""
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(self._executor, self._encoding, encoding_name)
+            for encoding_name in self.PRELOADED_ENCODINGS
+        ])
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    async def count(self, text: str, model_name: str) -> int:
+        """Returns the number of tokens of the text for the model"""
+        encoding_name, scale, _ = self._model_encoding(model_name)
+        if len(text) < self._tokenizer_configuration.offload_threshold_chars:
+            tokens = self._encode_length(encoding_name, text)
+        else:
+            tokens = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._encode_length, encoding_name, text)
+        if tokens is None:
+            return self.estimate(text, model_name)
+        return math.ceil(tokens * scale)
+
+    def count_sync(self, text: str, model_name: str) -> int:
+        """Returns the number of tokens of the text for the model, for callers already off the event loop"""
+        encoding_name, scale, _ = self._model_encoding(model_name)
+        tokens = self._encode_length(encoding_name, text)
+        if tokens is None:
+            return self.estimate(text, model_name)
+        return math.ceil(tokens * scale)
+
+    async def truncate(self, text: str, max_tokens: int, model_name: str, keep: str = "head") -> str:
+        """Returns the head (or tail) of the text that fits in max_tokens of the model"""
+        if max_tokens <= 0:
+            return ""
+        encoding_name, scale, chars_per_token = self._model_encoding(model_name)
+        if self._encoding(encoding_name) is None:
+            max_chars = int(max_tokens * chars_per_token)
+            if len(text) <= max_chars:
+                return text
+            return text[:max_chars] if keep == "head" else text[-max_chars:]
+        if len(text) < self._tokenizer_configuration.offload_threshold_chars:
+            return self._truncate(encoding_name, text, int(max_tokens / scale), keep)
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._truncate, encoding_name, text, int(max_tokens / scale), keep)
+
+    async def split(self, text: str, max_tokens: int, model_name: str) -> list[str]:
+        """Splits the text into consecutive pieces of at most max_tokens of the model"""
+        encoding_name, scale, chars_per_token = self._model_encoding(model_name)
+        if self._encoding(encoding_name) is None:
+            max_chars = max(1, int(max_tokens * chars_per_token))
+            return [text[start:start + max_chars] for start in range(0, len(text), max_chars)]
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, self._split, encoding_name, text, max(1, int(max_tokens / scale)))
+
+    def estimate(self, text: str, model_name: str) -> int:
+        """Returns a cheap character based estimate of the number of tokens, for guarding budgets"""
+        _, _, chars_per_token = self._model_encoding(model_name)
+        return math.ceil(len(text) / chars_per_token)
+
+    def _model_encoding(self, model_name: str) -> tuple[str, float, float]:
+        model_name = model_name or ""
+        if model_name not in self._model_encodings:
+            self._model_encodings[model_name] = self._resolve_model_encoding(model_name)
+        return self._model_encodings[model_name]
+
+    def _resolve_model_encoding(self, model_name: str) -> tuple[str, float, float]:
+        for prefix, family in self.MODEL_FAMILIES.items():
+            if prefix in model_name.lower():
+                return family
+        try:
+            return tiktoken.encoding_name_for_model(model_name), 1.0, 4.0
+        except KeyError:
+            Main.logger().info(f"No tokenizer known for model {model_name}, counting with {self.DEFAULT_ENCODING}")
+            return self.DEFAULT_ENCODING, 1.0, 4.0
+
+    def _encoding(self, encoding_name: str) -> tiktoken.Encoding | None:
+        if encoding_name not in self._encodings:
+            try:
+                self._encodings[encoding_name] = tiktoken.get_encoding(encoding_name)
+            except Exception as e:
+                # Offline without the BPE file in the cache directory, callers fall back to estimates
+                Main.logger().warning(f"Could not load the {encoding_name} encoding, estimating tokens instead: {e}")
+                self._encodings[encoding_name] = None
+        return self._encodings[encoding_name]
+
+    def _truncate(self, encoding_name: str, text: str, max_tokens: int, keep: str) -> str:
+        encoding = self._encoding(encoding_name)
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:max_tokens] if keep == "head" else tokens[-max_tokens:])
+
+    def _split(self, encoding_name: str, text: str, max_tokens: int) -> list[str]:
+        encoding = self._encoding(encoding_name)
+        tokens = encoding.encode(text, disallowed_special=())
+        return [encoding.decode(tokens[start:start + max_tokens]) for start in range(0, len(tokens), max_tokens)]
+
+    def _encode_length(self, encoding_name: str, text: str) -> int | None:
+        encoding = self._encoding(encoding_name)
+        if encoding is None:
+            return None
+        return len(encoding.encode(text, disallowed_special=()))
@@ -0,0 +1,24 @@
+"""Implements the tracker of provider reported token usage"""
+
+from common.data_model import LLMTokenUsage
+
+
+class UsageTracker:
+    """Sums the token usage reported by the providers per provider model, including prompt cache reads and writes"""
+
+    def __init__(self):
+        self._usage = {}
+
+    def record(self, provider: str, model_name: str, usage: LLMTokenUsage) -> None:
+        key = f"{provider}/{model_name}"
+        totals = self._usage.setdefault(key, {"calls": 0, **{field: 0 for field in LLMTokenUsage.__fields__}})
+        totals["calls"] += 1
+        for field, value in usage.dict().items():
+            totals[field] += value
+
+    def stats(self) -> dict:
+        """Returns the summed usage and the share of input tokens read from the prompt cache"""
+        return {
+            key: {**totals, "cache_read_ratio": round(totals["cache_read_tokens"] / totals["input_tokens"], 3) if totals["input_tokens"] else 0.0}
+            for key, totals in self._usage.items()
+        }
@@ -1,9 +1,12 @@
 from common.service_management import ServiceManager
 from common.base import Main
+from common.request_context import current_request_context
+from common.retry import TRANSIENT_STATUSES, retry_policy
 from pathlib import Path
 
 import json
 import requests
+import time
 import traceback
 
 from apify_client import ApifyClient
@@ -169,18 +172,20 @@ class APIHandlerServiceManager(ServiceManager):
 
     async def executer(self,endpoints: list[dict]) -> list[dict]:
         
+        list_of_responses, list_of_endpoint_urls = [], []
         try:
             if self._access_token is None:
                 Main.logger().debug('Access token was not found')
                 return
             
-            list_of_responses, list_of_endpoint_urls = [], []
             headers = {
                 'Content-Type': 'application/json'
             }
 
-            response_text, response_json = None, None
+            response_text = None
             for endpoint in endpoints:
+                # A cancelled request starts no more actor runs, the one in flight is aborted with its task
+                current_request_context().raise_if_cancelled()
 
                 http_method, endpoint_url = endpoint.get('method'), endpoint.get('url')
                 endpoint_params, payload, server = endpoint.get('data') , {}, None
@@ -214,12 +219,13 @@ class APIHandlerServiceManager(ServiceManager):
 
                 list_of_endpoint_urls.append(endpoint_url)
                 # payload.setdefault('token',self._access_token)
-                async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(600)) as session:
-                    async with session.request(method=http_method, url=endpoint_url, 
-                                               params={"token":self._access_token},
-                                               json=payload,headers=headers)as response:
-                        response_text = await response.text()
-                        response_json = await response.json()
+                try:
+                    response_ok, response_text = await retry_policy("api").call(self.request, http_method, endpoint_url, payload, headers)
+                except Exception as e:
+                    # Once the retry policy gives up, reported like any failed call so the endpoint generator can try another one
+                    Main.logger().warning(f'Calling "{endpoint_url}" failed: {e!r}')
+                    list_of_responses.append({endpoint_url: f"Error calling the API: {e!r}"})
+                    continue
                 # response = requests.request(http_method,url=endpoint_url, params={"token":self._access_token},json=payload,headers=headers)
 
                 Main.logger().info(f"Response from API execution :  {(str(response_text))[:200]} , writing to file..")
@@ -235,9 +241,9 @@ class APIHandlerServiceManager(ServiceManager):
                 #     headers = {'Authorization': f'Bearer {self._access_token}'}
                 #     response = requests.request(http_method,url=server_url+endpoint_url,headers=headers,params=payload)
 
-                if response.ok:
+                if response_ok:
                     try:
-                        list_of_responses.append({endpoint_url: response_json})
+                        list_of_responses.append({endpoint_url: json.loads(response_text)})
                     except json.JSONDecodeError as e:
                         Main.logger().debug(f'Could not parse json for endpoint with url : "{endpoint_url}"',exc_info=1)
                         list_of_responses.append({endpoint_url:'Parsing json failed !'})
@@ -247,5 +253,27 @@ class APIHandlerServiceManager(ServiceManager):
                     list_of_responses.append({endpoint_url:response_text})
             return list_of_responses, list_of_endpoint_urls
 
-        except BaseException as e:
-            Main.logger().debug(f'Something went unexpected while calling the API.. {e}..{traceback.format_exc()}',exc_info=1)
\ No newline at end of file
+        except Exception as e:
+            Main.logger().error(f'Something went unexpected while calling the API.. {e}..{traceback.format_exc()}')
+            list_of_responses.append({"executer": f"Error calling the API: {e!r}"})
+            return list_of_responses, list_of_endpoint_urls
+
+    async def request(self, http_method: str, endpoint_url: str, payload: dict, headers: dict) -> tuple[bool, str]:
+        """Calls the endpoint, returns whether it succeeded and the response text, raises on transient failures"""
+        started = time.perf_counter()
+        response_ok, response_bytes = False, 0
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(600)) as session:
+                async with session.request(method=http_method, url=endpoint_url,
+                                           params={"token":self._access_token},
+                                           json=payload,headers=headers) as response:
+                    response_text = await response.text()
+                    response_ok, response_bytes = response.ok, len(response_text.encode())
+                    if response.status in TRANSIENT_STATUSES:
+                        # Raised for the API retry policy, which honors the Retry-After header
+                        raise aiohttp.ClientResponseError(
+                            response.request_info, response.history, status=response.status, message=response_text[:200], headers=response.headers)
+                    return response.ok, response_text
+        finally:
+            # Every attempt is an actor run, the retried ones included
+            current_request_context().ledger.record_api_call(endpoint_url, time.perf_counter() - started, response_bytes, response_ok)
\ No newline at end of file
@@ -4,8 +4,9 @@ from chainlit import config
 from main import ApplicationMain
 from conversation.manager import ConversationServiceManager
 from common.base import Main
-from common.data_model import Roles
+from common.data_model import Roles, RequestPriority
 from api_handler.manager import APIHandlerServiceManager
+from LLM.manager import LLMServiceManager
 from typing import Any
 from common.data_model import QueryContext
 import json
@@ -53,6 +54,9 @@ async def start():
 
     cl.user_session.set("context", ConversationBufferWindowMemory(k=10))
     conversation_service_manager = await ApplicationMain.service_manager(ConversationServiceManager.__name__)
+    # the provider connections are opened on the Chainlit loop, the first chat warms them up
+    llm_service_manager = await ApplicationMain.service_manager(LLMServiceManager.__name__)
+    await llm_service_manager.warm_up()
     # api_handler_service_manager = await ApplicationMain.service_manager(APIHandlerServiceManager.__name__)
     Main.logger().info("Initialized Chainlit Application")
     cl.user_session.set("conversation_service_manager",
@@ -145,6 +149,36 @@ async def stream_response(msg: Any, response: Any) -> None:
         await msg.stream_token(str(response))
 
 
+async def replace_message(msg: Any, response: Any) -> None:
+    """Replaces the streamed draft answer with the refined one"""
+    msg.content = str(response)
+    msg.author = config.ui.name
+    # The draft message is only sent by its first streamed token, the refined answer may come before it
+    if msg.streaming:
+        await msg.update()
+    else:
+        await msg.send()
+
+
+def cancel_requests(reason: str) -> None:
+    """Cancels the requests of the session still being handled"""
+    conversation_service_manager = cl.user_session.get("conversation_service_manager")
+    for request_id in cl.user_session.get("request_ids") or []:
+        conversation_service_manager.cancel(request_id, reason)
+
+
+@cl.on_stop
+async def on_stop():
+    """Cancels the running requests when the user stops them"""
+    cancel_requests("stopped")
+
+
+@cl.on_chat_end
+async def on_chat_end():
+    """Cancels the running requests when the user closes the chat, nobody is left to read their answers"""
+    cancel_requests("client_disconnected")
+
+
 @cl.on_message
 async def main(message: str):
     """On Message handler"""
@@ -160,16 +194,27 @@ async def main(message: str):
             list_of_queries_dict = json.load(file)
             list_of_queries = list_of_queries_dict.get("queries")
 
-            for query in list_of_queries:
-                Main.logger().info(f"Message Received from user: {message.content}")
-                msg = cl.Message(
-                    content="Running test mode..", language="markdown")
-                id = await msg.send()
-                query_context = QueryContext(
-                    query=query, role=role, stream_response=lambda response: stream_response(msg, response))
-                query_context.conversation_context = cl.user_session.get("context")
-                conv_response = await conversation_service_manager.converse(query_context)
-                id = await msg.send()
+        Main.logger().info(f"Message Received from user: {message.content}, running {len(list_of_queries)} test queries")
+        messages, query_contexts = [], []
+        for query in list_of_queries:
+            msg = cl.Message(
+                content="Running test mode..", language="markdown")
+            id = await msg.send()
+            messages.append(msg)
+            # Test runs are queued behind interactive users when the providers are rate limited. The queries
+            # are independent of each other, so each gets its own conversation memory
+            query_contexts.append(QueryContext(
+                query=query, role=role, stream_response=lambda response, msg=msg: stream_response(msg, response),
+                conversation_context=ConversationBufferWindowMemory(k=10),
+                priority=RequestPriority.batch.value, request_id=str(uuid.uuid4())))
+
+        cl.user_session.set("request_ids", [query_context.request_id for query_context in query_contexts])
+
+        conv_responses = await conversation_service_manager.converse_batch(query_contexts, step_functions, role=role)
+        for msg, conv_response in zip(messages, conv_responses):
+            if isinstance(conv_response, BaseException):
+                await msg.stream_token(f"\n\nTest query failed: {conv_response!r}")
+            id = await msg.send()
         await cl.Message(content=str("Running test mode finished.."), language="markdown").send()
 
     else:
@@ -183,13 +228,19 @@ async def main(message: str):
         id = await msg.send()
         await create_chat_step("I've received your message and will shortly come up with a plan",)
 
+        # The draft answer is shown as soon as it streams in and replaced by the refined answer, which is not streamed
+        draft_msg = cl.Message(content="", author="Draft answer")
         query_context = QueryContext(
-            query=message.content, role=role, stream_response=lambda response: stream_response(msg, response))
+            query=message.content, role=role, stream_response=lambda response: stream_response(msg, response),
+            stream_draft=lambda response: draft_msg.stream_token(str(response)),
+            replace_draft=lambda response: replace_message(draft_msg, response),
+            request_id=str(uuid.uuid4()))
         
         empty_query_context = query_context.copy()
 
         cl.user_session.set("query_context", query_context)
         query_context.conversation_context = cl.user_session.get("context")
+        cl.user_session.set("request_ids", [query_context.request_id])
         
         conv_response = await conversation_service_manager.converse(query_context, step_functions)
         
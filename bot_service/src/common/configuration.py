@@ -1,6 +1,7 @@
 """Implements the default configuration"""
 
 import os
+import json
 from common.data_model import Configuration as ConfigurationModel
 
 
@@ -19,7 +20,8 @@ class Configuration:
             },
             "openai_configuration": {
                 "api_key": os.environ.get("OPENAI_API_KEY"),
-                "model_name":os.environ.get("OPENAI_MODEL_NAME")
+                "model_name":os.environ.get("OPENAI_MODEL_NAME"),
+                "api_keys": json.loads(os.environ.get("OPENAI_API_KEYS", "[]")),
 
             },
             "azureai_configuration":{
@@ -29,7 +31,8 @@ class Configuration:
                 "version":os.environ.get("AZURE_API_VERSION"),
                 "deployment_name":os.environ.get("AZURE_DEPLOYMENT_NAME"),
                 "embedding_deployment_name":os.environ.get("AZURE_EMBEDDING_DEPLOYMENT_NAME"),
-                "model_name":os.environ.get("AZURE_MODEL_NAME")
+                "model_name":os.environ.get("AZURE_MODEL_NAME"),
+                "deployments": json.loads(os.environ.get("AZURE_DEPLOYMENTS", "[]")),
                 
             },
             "perplexityai_configuration": {
@@ -42,6 +45,154 @@ class Configuration:
                 "api_key": os.environ.get("ANTHROPIC_API_KEY"),
                 "model_name":os.environ.get("ANTHROPIC_MODEL_NAME"),
             },
+            "llm_client_pool_configuration": {
+                "max_connections": os.environ.get("LLM_POOL_MAX_CONNECTIONS", 100),
+                "max_keepalive_connections": os.environ.get("LLM_POOL_MAX_KEEPALIVE_CONNECTIONS", 20),
+                "keepalive_expiry": os.environ.get("LLM_POOL_KEEPALIVE_EXPIRY", 60.0),
+                "connect_timeout": os.environ.get("LLM_POOL_CONNECT_TIMEOUT", 10.0),
+                "read_timeout": os.environ.get("LLM_POOL_READ_TIMEOUT", 600.0),
+                "prewarm": os.environ.get("LLM_POOL_PREWARM", True),
+            },
+            "retry_configuration": {
+                "enabled": os.environ.get("RETRY_ENABLED", True),
+                "max_attempts": json.loads(os.environ.get("RETRY_MAX_ATTEMPTS", '{"llm": 3, "search": 3, "api": 3}')),
+                "default_max_attempts": os.environ.get("RETRY_DEFAULT_MAX_ATTEMPTS", 3),
+                "non_idempotent_policies": json.loads(os.environ.get("RETRY_NON_IDEMPOTENT_POLICIES", '["api"]')),
+                "base_delay_seconds": os.environ.get("RETRY_BASE_DELAY_SECONDS", 0.5),
+                "max_delay_seconds": os.environ.get("RETRY_MAX_DELAY_SECONDS", 20.0),
+                "request_budget": os.environ.get("RETRY_REQUEST_BUDGET", 10),
+                "budget_ratio": os.environ.get("RETRY_BUDGET_RATIO", 0.2),
+                "budget_min_retries_per_second": os.environ.get("RETRY_BUDGET_MIN_RETRIES_PER_SECOND", 1.0),
+                "budget_window_seconds": os.environ.get("RETRY_BUDGET_WINDOW_SECONDS", 10.0),
+            },
+            "llm_endpoint_pool_configuration": {
+                "enabled": os.environ.get("LLM_ENDPOINT_POOL_ENABLED", True),
+                "selection": os.environ.get("LLM_ENDPOINT_SELECTION", "least_outstanding"),
+                "failure_threshold": os.environ.get("LLM_ENDPOINT_FAILURE_THRESHOLD", 3),
+                "ejection_seconds": os.environ.get("LLM_ENDPOINT_EJECTION_SECONDS", 30.0),
+                "max_ejection_seconds": os.environ.get("LLM_ENDPOINT_MAX_EJECTION_SECONDS", 300.0),
+            },
+            "llm_response_cache_configuration": {
+                "enabled": os.environ.get("LLM_CACHE_ENABLED", True),
+                "max_entries": os.environ.get("LLM_CACHE_MAX_ENTRIES", 512),
+                "ttl_seconds": os.environ.get("LLM_CACHE_TTL_SECONDS", 3600),
+                "semantic_enabled": os.environ.get("LLM_SEMANTIC_CACHE_ENABLED", False),
+                "semantic_threshold": os.environ.get("LLM_SEMANTIC_CACHE_THRESHOLD", 0.98),
+                "semantic_max_prompt_chars": os.environ.get("LLM_SEMANTIC_CACHE_MAX_PROMPT_CHARS", 8000),
+            },
+            "llm_router_configuration": {
+                "failover_routes": json.loads(os.environ.get("LLM_FAILOVER_ROUTES", '{"openai": ["azure_openai"], "azure_openai": ["openai"]}')),
+                "hedging_enabled": os.environ.get("LLM_HEDGING_ENABLED", False),
+                "hedge_min_delay_seconds": os.environ.get("LLM_HEDGE_MIN_DELAY_SECONDS", 2.0),
+                "window_size": os.environ.get("LLM_ROUTER_WINDOW_SIZE", 50),
+                "min_samples": os.environ.get("LLM_ROUTER_MIN_SAMPLES", 10),
+                "error_rate_threshold": os.environ.get("LLM_ROUTER_ERROR_RATE_THRESHOLD", 0.5),
+                "latency_failover_ratio": os.environ.get("LLM_ROUTER_LATENCY_FAILOVER_RATIO", 2.0),
+            },
+            "llm_scheduler_configuration": {
+                "enabled": os.environ.get("LLM_SCHEDULER_ENABLED", True),
+                "rate_limits": json.loads(os.environ.get("LLM_RATE_LIMITS", "{}")),
+                "default_max_tokens": os.environ.get("LLM_SCHEDULER_DEFAULT_MAX_TOKENS", 1024),
+            },
+            "fake_llm_configuration": {
+                "replace_providers": os.environ.get("FAKE_LLM_REPLACE_PROVIDERS", False),
+                "model_name": os.environ.get("FAKE_LLM_MODEL_NAME", "fake-llm"),
+                "ttft_seconds": os.environ.get("FAKE_LLM_TTFT_SECONDS", 0.4),
+                "tokens_per_second": os.environ.get("FAKE_LLM_TOKENS_PER_SECOND", 50),
+                "jitter_ratio": os.environ.get("FAKE_LLM_JITTER_RATIO", 0.2),
+                "error_rate": os.environ.get("FAKE_LLM_ERROR_RATE", 0.0),
+                "seed": os.environ.get("FAKE_LLM_SEED", 42),
+                "summary_tokens": os.environ.get("FAKE_LLM_SUMMARY_TOKENS", 250),
+                "embedding_dimensions": os.environ.get("FAKE_LLM_EMBEDDING_DIMENSIONS", 384),
+                "responses_file": os.environ.get("FAKE_LLM_RESPONSES_FILE"),
+            },
+            "llm_batch_configuration": {
+                "max_concurrency": os.environ.get("LLM_BATCH_MAX_CONCURRENCY", 8),
+                "provider_batch_enabled": os.environ.get("LLM_PROVIDER_BATCH_ENABLED", True),
+                "provider_batch_min_requests": os.environ.get("LLM_PROVIDER_BATCH_MIN_REQUESTS", 5),
+                "poll_interval_seconds": os.environ.get("LLM_PROVIDER_BATCH_POLL_INTERVAL_SECONDS", 30),
+                "provider_batch_timeout_seconds": os.environ.get("LLM_PROVIDER_BATCH_TIMEOUT_SECONDS", 3600),
+            },
+            "llm_prompt_cache_configuration": {
+                "enabled": os.environ.get("LLM_PROMPT_CACHING_ENABLED", True),
+            },
+            "llm_structured_output_configuration": {
+                "enabled": os.environ.get("LLM_STRUCTURED_OUTPUT_ENABLED", True),
+                "early_abort_enabled": os.environ.get("LLM_STREAM_EARLY_ABORT_ENABLED", True),
+            },
+            "llm_cascade_configuration": {
+                "enabled": os.environ.get("LLM_CASCADE_ENABLED", True),
+                "cascades": json.loads(os.environ.get("LLM_CASCADES", '{"generator": [{"provider": "openai", "model_name": "gpt-4o-mini", "attempts": 1}, {"provider": "openai", "model_name": "gpt-4-turbo", "attempts": 1}]}')),
+            },
+            "shadow_traffic_configuration": {
+                "enabled": os.environ.get("SHADOW_TRAFFIC_ENABLED", False),
+                "sample_rate": os.environ.get("SHADOW_TRAFFIC_SAMPLE_RATE", 0.05),
+                "models": json.loads(os.environ.get("SHADOW_TRAFFIC_MODELS", '{"planner": {"provider": "openai", "model_name": "gpt-4o-mini"}}')),
+                "max_concurrency": os.environ.get("SHADOW_TRAFFIC_MAX_CONCURRENCY", 2),
+                "max_pending": os.environ.get("SHADOW_TRAFFIC_MAX_PENDING", 16),
+                "max_queued_requests": os.environ.get("SHADOW_TRAFFIC_MAX_QUEUED_REQUESTS", 4),
+                "timeout_seconds": os.environ.get("SHADOW_TRAFFIC_TIMEOUT_SECONDS", 120.0),
+                "log_responses": os.environ.get("SHADOW_TRAFFIC_LOG_RESPONSES", True),
+            },
+            "llm_log_sink_configuration": {
+                "max_queue_size": os.environ.get("LLM_LOG_MAX_QUEUE_SIZE", 10000),
+                "batch_size": os.environ.get("LLM_LOG_BATCH_SIZE", 100),
+                "flush_interval_seconds": os.environ.get("LLM_LOG_FLUSH_INTERVAL_SECONDS", 1.0),
+                "max_file_bytes": os.environ.get("LLM_LOG_MAX_FILE_BYTES", 50 * 1024 * 1024),
+            },
+            "llm_streaming_configuration": {
+                "coalesce_enabled": os.environ.get("LLM_STREAM_COALESCE_ENABLED", True),
+                "frame_interval_ms": os.environ.get("LLM_STREAM_FRAME_INTERVAL_MS", 40),
+                "frame_max_chars": os.environ.get("LLM_STREAM_FRAME_MAX_CHARS", 1024),
+                "max_buffered_chars": os.environ.get("LLM_STREAM_MAX_BUFFERED_CHARS", 16384),
+            },
+            "prompt_budget_configuration": {
+                "context_windows": json.loads(os.environ.get("LLM_CONTEXT_WINDOWS", '{"gpt-4-turbo": 128000, "gpt-4o": 128000, "gpt-4-32k": 32768, "gpt-4": 8192, "gpt-3.5-turbo": 16385, "claude-3": 200000, "llama-3.1-sonar": 127072}')),
+                "default_context_window": os.environ.get("LLM_DEFAULT_CONTEXT_WINDOW", 128000),
+                "default_reserved_output_tokens": os.environ.get("LLM_DEFAULT_RESERVED_OUTPUT_TOKENS", 4096),
+                "safety_margin_tokens": os.environ.get("LLM_PROMPT_SAFETY_MARGIN_TOKENS", 512),
+            },
+            "planner_router_configuration": {
+                "enabled": os.environ.get("PLANNER_ROUTER_ENABLED", True),
+                "simple_provider": os.environ.get("PLANNER_ROUTER_SIMPLE_PROVIDER", "anthropic_ai"),
+                "simple_model_name": os.environ.get("PLANNER_ROUTER_SIMPLE_MODEL_NAME", "claude-3-haiku-20240307"),
+                "simple_max_tokens": os.environ.get("PLANNER_ROUTER_SIMPLE_MAX_TOKENS", 1024),
+                "complexity_threshold": os.environ.get("PLANNER_ROUTER_COMPLEXITY_THRESHOLD", 1),
+                "short_query_words": os.environ.get("PLANNER_ROUTER_SHORT_QUERY_WORDS", 8),
+                "long_query_words": os.environ.get("PLANNER_ROUTER_LONG_QUERY_WORDS", 20),
+                "knowledge_distance_threshold": os.environ.get("PLANNER_ROUTER_KNOWLEDGE_DISTANCE_THRESHOLD", 0.5),
+            },
+            "summarization_configuration": {
+                "map_reduce_enabled": os.environ.get("SUMMARIZATION_MAP_REDUCE_ENABLED", True),
+                "map_provider": os.environ.get("SUMMARIZATION_MAP_PROVIDER", "anthropic_ai"),
+                "map_model_name": os.environ.get("SUMMARIZATION_MAP_MODEL_NAME", "claude-3-haiku-20240307"),
+                "chunk_tokens": os.environ.get("SUMMARIZATION_CHUNK_TOKENS", 12000),
+                "max_concurrency": os.environ.get("SUMMARIZATION_MAX_CONCURRENCY", 4),
+                "map_max_tokens": os.environ.get("SUMMARIZATION_MAP_MAX_TOKENS", 1024),
+                "max_rounds": os.environ.get("SUMMARIZATION_MAX_ROUNDS", 2),
+                "draft_enabled": os.environ.get("SUMMARIZATION_DRAFT_ENABLED", False),
+                "draft_provider": os.environ.get("SUMMARIZATION_DRAFT_PROVIDER", "anthropic_ai"),
+                "draft_model_name": os.environ.get("SUMMARIZATION_DRAFT_MODEL_NAME", "claude-3-haiku-20240307"),
+                "draft_max_tokens": os.environ.get("SUMMARIZATION_DRAFT_MAX_TOKENS", 1024),
+            },
+            "tokenizer_configuration": {
+                "cache_dir": os.environ.get("TIKTOKEN_CACHE_DIR", "./store/tiktoken_cache"),
+                "offload_threshold_chars": os.environ.get("TOKENIZER_OFFLOAD_THRESHOLD_CHARS", 20000),
+                "max_workers": os.environ.get("TOKENIZER_MAX_WORKERS", 2),
+            },
+            "event_loop_monitor_configuration": {
+                "enabled": os.environ.get("EVENT_LOOP_MONITOR_ENABLED", True),
+                "threshold_seconds": os.environ.get("EVENT_LOOP_BLOCK_THRESHOLD_SECONDS", 0.25),
+                "interval_seconds": os.environ.get("EVENT_LOOP_MONITOR_INTERVAL_SECONDS", 0.05),
+            },
+            "request_cancellation_configuration": {
+                "enabled": os.environ.get("REQUEST_CANCELLATION_ENABLED", True),
+                "disconnect_poll_seconds": os.environ.get("REQUEST_DISCONNECT_POLL_SECONDS", 0.5),
+            },
+            "request_ledger_configuration": {
+                "enabled": os.environ.get("REQUEST_LEDGER_ENABLED", True),
+                "prices": json.loads(os.environ.get("REQUEST_LEDGER_PRICES", '{"gpt-4o": {"input": 2.5, "output": 10.0, "cache_read": 1.25}, "gpt-4o-mini": {"input": 0.15, "output": 0.6, "cache_read": 0.075}, "gpt-4-turbo": {"input": 10.0, "output": 30.0}, "claude-3-opus-20240229": {"input": 15.0, "output": 75.0, "cache_read": 1.5, "cache_write": 18.75}, "llama-3.1-sonar-large-128k-online": {"input": 1.0, "output": 1.0, "request": 0.005}, "claude-3-haiku-20240307": {"input": 0.25, "output": 1.25, "cache_read": 0.03, "cache_write": 0.3}, "claude-3-5-sonnet-20240620": {"input": 3.0, "output": 15.0, "cache_read": 0.3, "cache_write": 3.75}}')),
+            },
             "vectorDB_configuration": {
                 "database_directory":os.environ.get("DATABSE_DIRECTORY"),
                 "embeddings_json_file": os.environ.get('EMBEDDINGS_JSON_FILE'),
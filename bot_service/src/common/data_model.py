@@ -32,6 +32,15 @@ class OpenAIConfiguration(BaseModel):
     """Represents the OpenAI configuration"""
     api_key: str
     model_name: str
+    # More keys (of other organizations or projects) the calls are balanced across
+    api_keys: list[str] = []
+
+class AzureDeployment(BaseModel):
+    """Represents one more Azure OpenAI deployment of the model, unset settings are those of the configured one"""
+    api_key: Optional[str] = None
+    base: Optional[str] = None
+    version: Optional[str] = None
+    deployment_name: Optional[str] = None
 
 class AzureAIConfiguration(BaseModel):
     """Represents the AzureAI configuration"""
@@ -42,6 +51,8 @@ class AzureAIConfiguration(BaseModel):
     deployment_name: str
     embedding_deployment_name: str
     model_name: str
+    # More deployments of the same model the calls are balanced across
+    deployments: list[AzureDeployment] = []
 
 class PerplexityAIConfiguration(BaseModel):
     """Represents the Perplexity configuration"""
@@ -54,6 +65,240 @@ class AnthropicAIConfiguration(BaseModel):
     api_key: str
     model_name: str
 
+class FakeLLMConfiguration(BaseModel):
+    """Represents the offline fake LLM provider configuration"""
+    # Serves every get_service call with the fake provider
+    replace_providers: bool = False
+    model_name: str = "fake-llm"
+    ttft_seconds: float = 0.4
+    tokens_per_second: float = 50.0
+    jitter_ratio: float = 0.2
+    error_rate: float = 0.0
+    seed: int = 42
+    summary_tokens: int = 250
+    embedding_dimensions: int = 384
+    # JSON list of {"match": "prompt substring", "response": "..."}
+    responses_file: Optional[str] = None
+
+class LLMClientPoolConfiguration(BaseModel):
+    """Represents the pooled LLM HTTP client configuration"""
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 60.0
+    connect_timeout: float = 10.0
+    read_timeout: float = 600.0
+    prewarm: bool = True
+
+class RetryConfiguration(BaseModel):
+    """Represents the retry policies of the LLM, search and API calls"""
+    enabled: bool = True
+    # Attempts of a call including the first one, by policy name
+    max_attempts: dict[str, int] = {"llm": 3, "search": 3, "api": 3}
+    default_max_attempts: int = 3
+    # Policies of calls that are not idempotent, only retried when they were never sent or turned away (425, 429)
+    non_idempotent_policies: list[str] = ["api"]
+    base_delay_seconds: float = 0.5
+    max_delay_seconds: float = 20.0
+    # Retries one request may make over all of its calls
+    request_budget: int = 10
+    # Retries of a policy are capped to this fraction of its calls over the window, or the floor per second
+    budget_ratio: float = 0.2
+    budget_min_retries_per_second: float = 1.0
+    budget_window_seconds: float = 10.0
+
+class LLMEndpointPoolConfiguration(BaseModel):
+    """Represents the load balancing configuration of the pooled provider endpoints"""
+    enabled: bool = True
+    # "least_outstanding" or "remaining_quota"
+    selection: str = "least_outstanding"
+    failure_threshold: int = 3
+    ejection_seconds: float = 30.0
+    max_ejection_seconds: float = 300.0
+
+class LLMResponseCacheConfiguration(BaseModel):
+    """Represents the LLM response cache configuration"""
+    enabled: bool = True
+    max_entries: int = 512
+    ttl_seconds: float = 3600.0
+    semantic_enabled: bool = False
+    semantic_threshold: float = 0.98
+    semantic_max_prompt_chars: int = 8000
+
+class LLMRouterConfiguration(BaseModel):
+    """Represents the LLM provider routing configuration"""
+    failover_routes: dict[str, list[str]] = {}
+    hedging_enabled: bool = False
+    hedge_min_delay_seconds: float = 2.0
+    window_size: int = 50
+    min_samples: int = 10
+    error_rate_threshold: float = 0.5
+    latency_failover_ratio: float = 2.0
+
+class LLMSchedulerConfiguration(BaseModel):
+    """Represents the LLM rate scheduler configuration"""
+    enabled: bool = True
+    # "provider/model" or "provider" -> {"rpm": .., "tpm": .., "max_concurrency": ..}
+    rate_limits: dict[str, dict[str, int]] = {}
+    default_max_tokens: int = 1024
+
+class LLMStreamingConfiguration(BaseModel):
+    """Represents the token streaming configuration"""
+    coalesce_enabled: bool = True
+    frame_interval_ms: int = 40
+    frame_max_chars: int = 1024
+    max_buffered_chars: int = 16384
+
+class LLMBatchConfiguration(BaseModel):
+    """Represents the LLM batch execution configuration"""
+    max_concurrency: int = 8
+    provider_batch_enabled: bool = True
+    provider_batch_min_requests: int = 5
+    poll_interval_seconds: float = 30.0
+    # Requests the provider has not finished by then run through the local queue
+    provider_batch_timeout_seconds: float = 3600.0
+
+class LLMPromptCacheConfiguration(BaseModel):
+    """Represents the provider side prompt caching configuration"""
+    enabled: bool = True
+
+class LLMCascadeTier(BaseModel):
+    """Represents one model of a cascade and the attempts it gets before the next one"""
+    provider: str
+    model_name: str
+    attempts: int = 1
+
+class ShadowModel(BaseModel):
+    """Represents the model the calls of a stage are mirrored to"""
+    provider: str
+    model_name: str
+
+class ShadowTrafficConfiguration(BaseModel):
+    """Represents the mirroring of sampled live requests to alternate stage models"""
+    enabled: bool = False
+    sample_rate: float = 0.05
+    # LLM stage -> shadow model
+    models: dict[str, ShadowModel] = {
+        "planner": ShadowModel(provider="openai", model_name="gpt-4o-mini"),
+    }
+    max_concurrency: int = 2
+    max_pending: int = 16
+    # Live requests queued for their rate limits from which shadow calls are shed
+    max_queued_requests: int = 4
+    timeout_seconds: float = 120.0
+    log_responses: bool = True
+
+class LLMCascadeConfiguration(BaseModel):
+    """Represents the model cascades of the retried stages"""
+    enabled: bool = True
+    # stage -> tiers from the fastest to the strongest model, the last tier takes the remaining attempts
+    cascades: dict[str, list[LLMCascadeTier]] = {
+        "generator": [
+            LLMCascadeTier(provider="openai", model_name="gpt-4o-mini", attempts=1),
+            LLMCascadeTier(provider="openai", model_name="gpt-4-turbo", attempts=1),
+        ],
+    }
+
+class LLMStructuredOutputConfiguration(BaseModel):
+    """Represents the schema constrained output configuration"""
+    enabled: bool = True
+    early_abort_enabled: bool = True
+
+class LLMLogSinkConfiguration(BaseModel):
+    """Represents the LLM prompt/response log sink configuration"""
+    max_queue_size: int = 10000
+    batch_size: int = 100
+    flush_interval_seconds: float = 1.0
+    max_file_bytes: int = 50 * 1024 * 1024
+
+class PlannerRouterConfiguration(BaseModel):
+    """Represents the query complexity routing of the planner stage"""
+    enabled: bool = True
+    # Planner model of the queries classified as simple, complex ones keep the configured planner model
+    simple_provider: str = "anthropic_ai"
+    simple_model_name: str = "claude-3-haiku-20240307"
+    simple_max_tokens: int = 1024
+    # Queries scoring at or above the threshold are complex
+    complexity_threshold: int = 1
+    short_query_words: int = 8
+    long_query_words: int = 20
+    # Knowledge base matches closer than this make a definition lookup
+    knowledge_distance_threshold: float = 0.5
+
+class SummarizationConfiguration(BaseModel):
+    """Represents the summarization configuration"""
+    # Task results over the summarizer budget are summarized chunk by chunk on the map model first,
+    # a fast model of the summarizer provider so the results are not sent to another provider
+    map_reduce_enabled: bool = True
+    map_provider: str = "anthropic_ai"
+    map_model_name: str = "claude-3-haiku-20240307"
+    chunk_tokens: int = 12000
+    max_concurrency: int = 4
+    map_max_tokens: int = 1024
+    # Rounds of map summaries of map summaries before the rest is trimmed to the budget
+    max_rounds: int = 2
+    # A draft answer is streamed from the draft model while the summarizer model refines it
+    draft_enabled: bool = False
+    draft_provider: str = "anthropic_ai"
+    draft_model_name: str = "claude-3-haiku-20240307"
+    draft_max_tokens: int = 1024
+
+class PromptBudgetConfiguration(BaseModel):
+    """Represents the prompt token budget configuration"""
+    # model name prefix -> context window in tokens, the longest matching prefix wins
+    context_windows: dict[str, int] = {
+        "gpt-4-turbo": 128000,
+        "gpt-4o": 128000,
+        "gpt-4-32k": 32768,
+        "gpt-4": 8192,
+        "gpt-3.5-turbo": 16385,
+        "claude-3": 200000,
+        "llama-3.1-sonar": 127072,
+    }
+    default_context_window: int = 128000
+    default_reserved_output_tokens: int = 4096
+    # Headroom for tokenizer estimates of models counted with a foreign encoding
+    safety_margin_tokens: int = 512
+
+class TokenizerConfiguration(BaseModel):
+    """Represents the tokenizer configuration"""
+    cache_dir: str = "./store/tiktoken_cache"
+    offload_threshold_chars: int = 20000
+    max_workers: int = 2
+
+class EventLoopMonitorConfiguration(BaseModel):
+    """Represents the blocking call monitor configuration"""
+    enabled: bool = True
+    threshold_seconds: float = 0.25
+    interval_seconds: float = 0.05
+
+class LLMPrice(BaseModel):
+    """Represents the price of a model in USD per million tokens, prompt cache tokens default to the input price"""
+    input: float
+    output: float
+    cache_read: Optional[float] = None
+    cache_write: Optional[float] = None
+    # USD per call on top of the tokens, as the online search models charge
+    request: float = 0.0
+
+class RequestLedgerConfiguration(BaseModel):
+    """Represents the per request ledger of tokens, cost, API calls and retries"""
+    enabled: bool = True
+    # "provider/model" or model (or Azure deployment) name -> price
+    prices: dict[str, LLMPrice] = {
+        "gpt-4o": LLMPrice(input=2.5, output=10.0, cache_read=1.25),
+        "gpt-4o-mini": LLMPrice(input=0.15, output=0.6, cache_read=0.075),
+        "gpt-4-turbo": LLMPrice(input=10.0, output=30.0),
+        "claude-3-opus-20240229": LLMPrice(input=15.0, output=75.0, cache_read=1.5, cache_write=18.75),
+        "llama-3.1-sonar-large-128k-online": LLMPrice(input=1.0, output=1.0, request=0.005),
+        "claude-3-haiku-20240307": LLMPrice(input=0.25, output=1.25, cache_read=0.03, cache_write=0.3),
+        "claude-3-5-sonnet-20240620": LLMPrice(input=3.0, output=15.0, cache_read=0.3, cache_write=3.75),
+    }
+
+class RequestCancellationConfiguration(BaseModel):
+    """Represents the cancellation of the requests whose client stopped them or went away"""
+    enabled: bool = True
+    disconnect_poll_seconds: float = 0.5
+
 class VectorDBConfiguration(BaseModel):
     """Represents vectorDB configuration"""
     database_directory: str
@@ -112,6 +357,27 @@ class Configuration(BaseModel):
     azureai_configuration: AzureAIConfiguration
     perplexityai_configuration :PerplexityAIConfiguration
     anthropicai_configuration :AnthropicAIConfiguration
+    llm_client_pool_configuration: LLMClientPoolConfiguration
+    llm_endpoint_pool_configuration: LLMEndpointPoolConfiguration
+    retry_configuration: RetryConfiguration
+    llm_response_cache_configuration: LLMResponseCacheConfiguration
+    llm_router_configuration: LLMRouterConfiguration
+    llm_scheduler_configuration: LLMSchedulerConfiguration
+    llm_log_sink_configuration: LLMLogSinkConfiguration
+    llm_streaming_configuration: LLMStreamingConfiguration
+    llm_prompt_cache_configuration: LLMPromptCacheConfiguration
+    llm_structured_output_configuration: LLMStructuredOutputConfiguration
+    llm_cascade_configuration: LLMCascadeConfiguration
+    shadow_traffic_configuration: ShadowTrafficConfiguration
+    fake_llm_configuration: FakeLLMConfiguration
+    llm_batch_configuration: LLMBatchConfiguration
+    prompt_budget_configuration: PromptBudgetConfiguration
+    summarization_configuration: SummarizationConfiguration
+    planner_router_configuration: PlannerRouterConfiguration
+    tokenizer_configuration: TokenizerConfiguration
+    event_loop_monitor_configuration: EventLoopMonitorConfiguration
+    request_cancellation_configuration: RequestCancellationConfiguration
+    request_ledger_configuration: RequestLedgerConfiguration
     vectorDB_configuration: VectorDBConfiguration
     api_handler_configuration: APIHandlerConfiguration
     common_configuration:  CommonConfiguration
@@ -128,10 +394,78 @@ class QueryContext(BaseModel):
     role: str
     stream_response: Any
     conversation_context: Optional[ConversationBufferWindowMemory] = None
+    priority: int = 0
+    # Consumers that can show a draft answer stream it here and have it replaced by the refined answer
+    stream_draft: Any = None
+    replace_draft: Any = None
+    # Id the request can be cancelled by while it runs, a new one is made when not set
+    request_id: Optional[str] = None
+    # Summary of the tokens, cost, API calls and retries of the request, set once it finishes
+    ledger: Optional[dict] = None
 
 
 # region Constants
 
+class LLMTokenUsage(BaseModel):
+    """Token usage of one LLM call as reported by the provider, input tokens include the cached ones"""
+    input_tokens: int = 0
+    output_tokens: int = 0
+    cache_read_tokens: int = 0
+    cache_write_tokens: int = 0
+
+class LLMBatchRequest(BaseModel):
+    """Represents one prompt of an LLM batch"""
+    custom_id: str
+    prompt: str
+    system_message: Optional[str] = None
+    params: dict[str, Any] = {}
+
+class LLMBatchResult(BaseModel):
+    """Represents the response, or the error, of one prompt of an LLM batch"""
+    custom_id: str
+    response: Optional[str] = None
+    error: Optional[str] = None
+
+class PromptSlot(BaseModel):
+    """Represents one value of a prompt template, trimmed to the token budget by priority"""
+    name: str
+    text: str
+    # Slots of the lowest priority are trimmed first
+    priority: int = 0
+    # Required slots are never trimmed
+    required: bool = False
+    # Upper bound on the tokens of the slot even when the context window has room
+    max_tokens: Optional[int] = None
+    # "head" keeps the start of the text when trimming, "tail" keeps the end
+    keep: str = "head"
+
+class PromptAllocation(BaseModel):
+    """Represents the slot values of a prompt fitted to the token budget, and what was trimmed from them"""
+    values: dict[str, str]
+    budget_tokens: int
+    prompt_tokens: int
+    # slot name -> tokens trimmed from it
+    dropped: dict[str, int] = {}
+    fits: bool = True
+
+class LLMStage(ExtendedEnum):
+    planner = "planner"
+    generator = "generator"
+    search = "search"
+    summarizer = "summarizer"
+    other = "other"
+
+class QueryComplexity(ExtendedEnum):
+    simple = "simple"
+    complex = "complex"
+
+class PlannerRoute(BaseModel):
+    """Represents the planner model chosen for a query, and why"""
+    complexity: str
+    score: int
+    reasons: list[str] = []
+    max_tokens: int
+
 class Roles(ExtendedEnum):
     "Represents roles"
     admin: str = "Admin"
@@ -144,6 +478,17 @@ class LLMProvider(ExtendedEnum):
     azure_openai: str = "azure_openai"
     perplexity_ai: str = "perplexity_ai"
     anthropic_ai: str = "anthropic_ai"
+    fake: str = "fake"
+
+class LLMEndpointSelection(ExtendedEnum):
+    least_outstanding = "least_outstanding"
+    remaining_quota = "remaining_quota"
+
+class RequestPriority(ExtendedEnum):
+    "Represents the scheduling priority of a request, lower is served first"
+    interactive: int = 0
+    batch: int = 10
+    shadow: int = 20
 
 class PlannerEnum(ExtendedEnum):
     "Represents different planner prompts"
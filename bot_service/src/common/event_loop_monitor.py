@@ -0,0 +1,89 @@
+"""Implements a watchdog that detects and reports calls blocking the event loop"""
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+from common.base import Main
+from common.data_model import EventLoopMonitorConfiguration
+
+
+class EventLoopMonitor:
+    """Reports every time the serving event loop is blocked for longer than the configured threshold.
+
+    A heartbeat task on the loop records when it last ran, and a watchdog thread captures the
+    loop thread's stack as soon as the heartbeat goes stale, which points at the blocking call.
+    The monitor attaches to the loop it is first watched from, as services are initialized on
+    a different loop than the one serving requests.
+    """
+
+    def __init__(self, monitor_configuration: EventLoopMonitorConfiguration):
+        self._monitor_configuration = monitor_configuration
+        self._loop = None
+        self._loop_thread_id = None
+        self._heartbeat_task = None
+        self._watchdog = None
+        self._stopped = threading.Event()
+        self._last_heartbeat = time.monotonic()
+        self._reported_heartbeat = None
+        self._blocked_count = 0
+        self._max_blocked_seconds = 0.0
+
+    def watch(self) -> None:
+        """Starts watching the running event loop, does nothing if it is already watched"""
+        if not self._monitor_configuration.enabled:
+            return
+        loop = asyncio.get_running_loop()
+        if loop is self._loop and not self._heartbeat_task.done():
+            return
+
+        self._stop_heartbeat()
+        self._loop = loop
+        self._loop_thread_id = threading.get_ident()
+        self._last_heartbeat = time.monotonic()
+        self._heartbeat_task = loop.create_task(self._heartbeat())
+        if self._watchdog is None or not self._watchdog.is_alive():
+            self._stopped.clear()
+            self._watchdog = threading.Thread(target=self._watch_heartbeat, name="event-loop-monitor", daemon=True)
+            self._watchdog.start()
+        Main.logger().info(f"Watching event loop for calls blocking longer than {self._monitor_configuration.threshold_seconds}s")
+
+    def stop(self) -> None:
+        """Stops the heartbeat and the watchdog thread"""
+        self._stopped.set()
+        self._stop_heartbeat()
+
+    def stats(self) -> dict:
+        """Returns the number of blocking episodes and the longest one seen so far"""
+        return {"blocked_count": self._blocked_count, "max_blocked_seconds": round(self._max_blocked_seconds, 3)}
+
+    def _stop_heartbeat(self):
+        if self._heartbeat_task and not self._heartbeat_task.done() and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._heartbeat_task.cancel)
+
+    async def _heartbeat(self):
+        interval = self._monitor_configuration.interval_seconds
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(interval)
+            self._last_heartbeat = time.monotonic()
+            blocked_seconds = self._last_heartbeat - before - interval
+            if blocked_seconds > self._monitor_configuration.threshold_seconds:
+                self._blocked_count += 1
+                self._max_blocked_seconds = max(self._max_blocked_seconds, blocked_seconds)
+                Main.logger().warning(f"Event loop was blocked for {blocked_seconds:.3f}s")
+
+    def _watch_heartbeat(self):
+        threshold = self._monitor_configuration.threshold_seconds
+        while not self._stopped.wait(self._monitor_configuration.interval_seconds):
+            last_heartbeat = self._last_heartbeat
+            if time.monotonic() - last_heartbeat <= threshold or self._reported_heartbeat == last_heartbeat:
+                continue
+            # Report each stale heartbeat once, with the stack the loop thread is stuck in
+            self._reported_heartbeat = last_heartbeat
+            frame = sys._current_frames().get(self._loop_thread_id)  # pylint: disable=protected-access
+            if frame is not None:
+                stack = "".join(traceback.format_stack(frame))
+                Main.logger().warning(f"Blocking call detected on the event loop (> {threshold}s):\n{stack}")
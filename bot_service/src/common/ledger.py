@@ -0,0 +1,104 @@
+"""Implements the ledger of the tokens, cost, API calls and retries of a conversation turn"""
+
+from common.data_model import LLMPrice
+
+TOKENS_PER_PRICE_UNIT = 1_000_000
+
+
+def llm_price(prices: dict[str, LLMPrice], provider: str, model_name: str) -> LLMPrice | None:
+    """Returns the price of the provider model, keyed by "provider/model" or by the model (or deployment) name"""
+    return prices.get(f"{provider}/{model_name}") or prices.get(model_name)
+
+
+def llm_cost(price: LLMPrice, prompt_tokens: int, completion_tokens: int, cache_read_tokens: int = 0, cache_write_tokens: int = 0) -> float:
+    """Returns the estimated cost in USD of a call with its fee, the prompt tokens include the prompt cache reads and writes"""
+    cache_read_price = price.input if price.cache_read is None else price.cache_read
+    cache_write_price = price.input if price.cache_write is None else price.cache_write
+    uncached_tokens = max(0, prompt_tokens - cache_read_tokens - cache_write_tokens)
+    return (
+        uncached_tokens * price.input
+        + cache_read_tokens * cache_read_price
+        + cache_write_tokens * cache_write_price
+        + completion_tokens * price.output
+    ) / TOKENS_PER_PRICE_UNIT + price.request
+
+
+class RequestLedger:
+    """Sums what one conversation turn spent: the tokens and estimated cost of its LLM calls by model and stage,
+    the duration and response size of its API calls, and its retries by policy.
+
+    Calls served by the response cache cost nothing and are only counted. Calls to models without a price
+    are counted with their tokens but no cost, and listed as unpriced.
+    """
+
+    def __init__(self):
+        self._llm_by_model = {}
+        self._llm_by_stage = {}
+        self._unpriced_models = set()
+        self._api_by_endpoint = {}
+        self._retries = {}
+
+    def record_llm_call(self, provider: str, model_name: str, stage: str, prompt_tokens: int, completion_tokens: int,
+                        cost: float | None, seconds: float, cached: bool = False) -> None:
+        if cost is None and not cached:
+            self._unpriced_models.add(f"{provider}/{model_name}")
+        for totals in (self._llm_totals(self._llm_by_model, f"{provider}/{model_name}"), self._llm_totals(self._llm_by_stage, stage)):
+            totals["calls"] += 1
+            if cached:
+                totals["cached_calls"] += 1
+                continue
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["cost_usd"] += cost or 0.0
+            totals["seconds"] += seconds
+
+    @staticmethod
+    def _llm_totals(totals_by_key: dict, key: str) -> dict:
+        return totals_by_key.setdefault(key, {"calls": 0, "cached_calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0, "seconds": 0.0})
+
+    def record_api_call(self, endpoint_url: str, seconds: float, response_bytes: int, ok: bool) -> None:
+        totals = self._api_by_endpoint.setdefault(endpoint_url, {"calls": 0, "failed_calls": 0, "seconds": 0.0, "response_bytes": 0})
+        totals["calls"] += 1
+        totals["failed_calls"] += not ok
+        totals["seconds"] += seconds
+        totals["response_bytes"] += response_bytes
+
+    def record_retry(self, policy: str) -> None:
+        self._retries[policy] = self._retries.get(policy, 0) + 1
+
+    def cost(self) -> float:
+        """Returns the estimated cost in USD spent so far, for the budgets of the request"""
+        return sum(totals["cost_usd"] for totals in self._llm_by_model.values())
+
+    def summary(self) -> dict:
+        """Returns the totals of the turn with their breakdowns, as stored with the conversation thread"""
+        llm_totals = self._llm_by_model.values()
+        api_totals = self._api_by_endpoint.values()
+        return {
+            "cost_usd": round(self.cost(), 6),
+            "llm": {
+                "calls": sum(totals["calls"] for totals in llm_totals),
+                "cached_calls": sum(totals["cached_calls"] for totals in llm_totals),
+                "prompt_tokens": sum(totals["prompt_tokens"] for totals in llm_totals),
+                "completion_tokens": sum(totals["completion_tokens"] for totals in llm_totals),
+                "seconds": round(sum(totals["seconds"] for totals in llm_totals), 3),
+                "by_model": self._rounded(self._llm_by_model),
+                "by_stage": self._rounded(self._llm_by_stage),
+                "unpriced_models": sorted(self._unpriced_models),
+            },
+            "api": {
+                "calls": sum(totals["calls"] for totals in api_totals),
+                "failed_calls": sum(totals["failed_calls"] for totals in api_totals),
+                "seconds": round(sum(totals["seconds"] for totals in api_totals), 3),
+                "response_bytes": sum(totals["response_bytes"] for totals in api_totals),
+                "by_endpoint": self._rounded(self._api_by_endpoint),
+            },
+            "retries": {"total": sum(self._retries.values()), **self._retries},
+        }
+
+    @staticmethod
+    def _rounded(totals_by_key: dict) -> dict:
+        return {
+            key: {name: round(value, 6 if name == "cost_usd" else 3) if isinstance(value, float) else value for name, value in totals.items()}
+            for key, totals in totals_by_key.items()
+        }
@@ -0,0 +1,122 @@
+"""Implements the in-process counters and histograms exposed on the metrics endpoint"""
+
+import bisect
+import math
+
+# Seconds, from a fast cache hit to a long summarization
+DEFAULT_SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160)
+
+
+class Counter:
+    """Monotonic counter per label values"""
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...]):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(str(labels.get(label_name, "")) for label_name in self.label_names)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self) -> dict:
+        return {"/".join(key): value for key, value in self._values.items()}
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        for key, value in self._values.items():
+            lines.append(f"{self.name}{_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Histogram:
+    """Cumulative bucket histogram per label values"""
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...], buckets: tuple[float, ...] = DEFAULT_SECONDS_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [bucket counts..., +Inf count], sum
+        self._values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        if value is None or math.isnan(value):
+            return
+        key = tuple(str(labels.get(label_name, "")) for label_name in self.label_names)
+        counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._values[key] = (counts, total + value)
+
+    def snapshot(self) -> dict:
+        return {
+            "/".join(key): {
+                "count": sum(counts),
+                "sum": round(total, 4),
+                "p50": self._quantile(counts, 0.5),
+                "p95": self._quantile(counts, 0.95),
+            }
+            for key, (counts, total) in self._values.items()
+        }
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels((*self.label_names, 'le'), (*key, str(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, key)} {total}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, key)} {cumulative}")
+        return lines
+
+    def _quantile(self, counts: list[int], quantile: float) -> float | None:
+        """Returns the upper bound of the bucket holding the quantile"""
+        total = sum(counts)
+        if not total:
+            return None
+        cumulative = 0
+        for bound, count in zip((*self.buckets, math.inf), counts):
+            cumulative += count
+            if cumulative >= quantile * total:
+                return bound
+        return math.inf
+
+
+class MetricsRegistry:
+    """Holds the metrics of the process, renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def counter(self, name: str, description: str, label_names: tuple[str, ...] = ()) -> Counter:
+        if name not in self._metrics:
+            self._metrics[name] = Counter(name, description, label_names)
+        return self._metrics[name]
+
+    def histogram(self, name: str, description: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = DEFAULT_SECONDS_BUCKETS) -> Histogram:
+        if name not in self._metrics:
+            self._metrics[name] = Histogram(name, description, label_names, buckets)
+        return self._metrics[name]
+
+    def snapshot(self) -> dict:
+        return {name: metric.snapshot() for name, metric in self._metrics.items()}
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics.values() for line in metric.render()) + "\n"
+
+
+def _labels(label_names: tuple[str, ...], label_values: tuple[str, ...]) -> str:
+    if not label_names:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in label_values)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(label_names, escaped)) + "}"
+
+
+_registry = MetricsRegistry()
+
+
+def metrics_registry() -> MetricsRegistry:
+    """Returns the registry shared by the whole process"""
+    return _registry
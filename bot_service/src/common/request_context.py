@@ -0,0 +1,108 @@
+"""Implements the request scoped context read by the services below the conversation layer"""
+
+import asyncio
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from common.data_model import RequestPriority
+from common.ledger import RequestLedger
+
+
+class RequestContext:
+    """Holds the state of one conversation turn that the LLM layer needs without threading it through every call.
+
+    It is bound to the task handling the request, so every coroutine and task it starts sees the same context.
+    """
+
+    def __init__(self, priority: int = RequestPriority.interactive.value, request_id: str = None):
+        self.priority = priority
+        self.request_id = request_id or str(uuid.uuid4())
+        # Telemetry of the LLM calls made for the request, bounded as the default context lives forever
+        self.llm_calls = deque(maxlen=200)
+        # Retries made for the request, charged against its retry budget
+        self.retries = 0
+        # Tokens, cost, API calls and retries of the request
+        self.ledger = RequestLedger()
+        # Set on the sampled requests whose LLM calls are mirrored to the shadow models
+        self.shadow = None
+        # Set on the contexts of the shadow calls, the id of the live request they mirror
+        self.mirrored_request_id = None
+        # Why the request was cancelled, set once its client stopped it or went away
+        self.cancel_reason = None
+        # The tasks that bound the context, cancelled with the request
+        self._tasks = set()
+
+    def attach(self, task: asyncio.Task) -> None:
+        self._tasks.add(task)
+
+    def detach(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+
+    def cancel(self, reason: str) -> bool:
+        """Cancels the tasks handling the request, False when it was already cancelled.
+
+        The tasks they started, as the router attempts and the summary drafts, are cancelled by them in turn,
+        and helper tasks that see the context stop at their next cancellation check.
+        """
+        if self.cancel_reason is not None:
+            return False
+        self.cancel_reason = reason
+        for task in list(self._tasks):
+            task.cancel(reason)
+        return True
+
+    def cancelled(self) -> bool:
+        return self.cancel_reason is not None
+
+    def raise_if_cancelled(self) -> None:
+        """Raises CancelledError once the request is cancelled, checked before starting costly work"""
+        if self.cancel_reason is not None:
+            raise asyncio.CancelledError(self.cancel_reason)
+
+
+_request_context: ContextVar[RequestContext | None] = ContextVar("request_context", default=None)
+_default_request_context = RequestContext(request_id="background")
+
+
+def current_request_context() -> RequestContext:
+    """Returns the context of the request being handled, or a default one outside of a request"""
+    return _request_context.get() or _default_request_context
+
+
+def in_request_scope() -> bool:
+    """Returns whether a request context is bound, rather than the default one in use"""
+    return _request_context.get() is not None
+
+
+def bind_request_context(request_context: RequestContext):
+    """Binds the context to the current task, returns the token to reset it with"""
+    return _request_context.set(request_context)
+
+
+def reset_request_context(token) -> None:
+    _request_context.reset(token)
+
+
+def _current_task() -> asyncio.Task | None:
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        # No running event loop
+        return None
+
+
+@contextmanager
+def request_scope(request_context: RequestContext):
+    """Binds the context for the duration of the block, cancelling the request cancels the task running it"""
+    token = bind_request_context(request_context)
+    task = _current_task()
+    if task is not None:
+        request_context.attach(task)
+    try:
+        yield request_context
+    finally:
+        if task is not None:
+            request_context.detach(task)
+        reset_request_context(token)
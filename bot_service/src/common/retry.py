@@ -0,0 +1,183 @@
+"""Implements the retry policies shared by the LLM, search and API calls"""
+
+import asyncio
+import email.utils
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+import httpx
+
+from common.base import Main
+from common.data_model import RetryConfiguration
+from common.metrics import MetricsRegistry, metrics_registry
+from common.request_context import current_request_context, in_request_scope
+
+# Statuses worth retrying as is, any other failed request fails the same way again
+TRANSIENT_STATUSES = (408, 425, 429, 500, 502, 503, 504, 529)
+# Statuses of requests the server turned away before processing them, the only ones a call that is not idempotent retries
+UNPROCESSED_STATUSES = (425, 429)
+# Connection failures of the provider SDKs and aiohttp, which do not derive from the transport errors
+TRANSIENT_ERROR_NAMES = ("APIConnectionError", "APITimeoutError", "ClientConnectionError")
+# Failures to connect (httpx, aiohttp), the request was never sent
+CONNECT_ERROR_NAMES = ("ConnectError", "ConnectTimeout", "ClientConnectorError", "ConnectionRefusedError")
+
+
+def is_transient(error: BaseException, idempotent: bool = True) -> bool:
+    """Returns whether the failed call may succeed when made again.
+
+    A call that is not idempotent, as an actor run, may have taken effect when it timed out, lost its
+    connection or failed with a server error, so it is only retried when it was never sent or turned away.
+    """
+    error_names = [cls.__name__ for cls in type(error).__mro__]
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if isinstance(status, int):
+        return status in (TRANSIENT_STATUSES if idempotent else UNPROCESSED_STATUSES)
+    if not idempotent:
+        return any(name in CONNECT_ERROR_NAMES for name in error_names)
+    if isinstance(error, (asyncio.TimeoutError, httpx.TimeoutException, ConnectionError, httpx.TransportError)):
+        return True
+    return any(name in TRANSIENT_ERROR_NAMES for name in error_names)
+
+
+def retry_after(error: BaseException) -> float | None:
+    """Returns the seconds the server asked to wait before retrying, from the Retry-After headers of the error"""
+    response = getattr(error, "response", None)
+    headers = getattr(error, "headers", None) or getattr(response, "headers", None)
+    if not headers:
+        return None
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryBudget:
+    """Caps the retries to a fraction of the calls made over a sliding window, above a floor per second.
+
+    A provider brownout fails most calls at once, retrying every one of them would multiply the load
+    on it right when it can take the least.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, window_seconds: float):
+        self._ratio = ratio
+        self._min_per_second = min_per_second
+        self._window_seconds = window_seconds
+        self._calls = deque()
+        self._retries = deque()
+
+    def _expire(self, now: float) -> None:
+        for events in (self._calls, self._retries):
+            while events and events[0] < now - self._window_seconds:
+                events.popleft()
+
+    def record_call(self) -> None:
+        self._calls.append(time.monotonic())
+
+    def try_spend(self) -> bool:
+        """Spends a retry, False once the window has none left"""
+        now = time.monotonic()
+        self._expire(now)
+        allowed = max(self._ratio * len(self._calls), self._min_per_second * self._window_seconds)
+        if len(self._retries) >= allowed:
+            return False
+        self._retries.append(now)
+        return True
+
+
+class RetryPolicy:
+    """Retries transient failures with exponential backoff and full jitter, or as long as the server asks.
+
+    Every retry is charged to the retry budget of the request being handled and to the budget of the
+    policy shared by all requests, a retry that either has no budget left for is not made. A server
+    asking to wait longer than the longest backoff is not retried either, failing over is faster.
+    """
+
+    def __init__(self, name: str, retry_configuration: RetryConfiguration, registry: MetricsRegistry):
+        self.name = name
+        self._retry_configuration = retry_configuration
+        self.max_attempts = retry_configuration.max_attempts.get(name, retry_configuration.default_max_attempts)
+        self.idempotent = name not in retry_configuration.non_idempotent_policies
+        self._budget = RetryBudget(
+            retry_configuration.budget_ratio, retry_configuration.budget_min_retries_per_second, retry_configuration.budget_window_seconds)
+        self._retries = registry.counter("retries_total", "Retries by policy and outcome", ("policy", "outcome"))
+
+    async def call(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """Awaits ``func(*args, **kwargs)``, retrying it on transient failures"""
+        self.record_call()
+        attempt = 1
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                delay = self.retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                Main.logger().info(f"Retrying {self.name} call in {delay:.2f}s after attempt {attempt} failed with {e!r}")
+                await asyncio.sleep(delay)
+                attempt += 1
+                current_request_context().raise_if_cancelled()
+
+    def record_call(self) -> None:
+        """Records a call, it earns the policy its share of retries"""
+        self._budget.record_call()
+
+    def retry_delay(self, error: BaseException, attempt: int) -> float | None:
+        """Returns the seconds to wait before retrying the failed attempt, counted from 1, None when it is not retried"""
+        configuration = self._retry_configuration
+        if not configuration.enabled or not is_transient(error, self.idempotent) or attempt >= self.max_attempts:
+            return None
+        server_delay = retry_after(error)
+        if server_delay is not None and server_delay > configuration.max_delay_seconds:
+            self._retries.inc(policy=self.name, outcome="retry_after_too_long")
+            return None
+        if not self.allow_retry():
+            return None
+        return server_delay if server_delay is not None else self.backoff(attempt)
+
+    def backoff(self, attempt: int) -> float:
+        """Returns the jittered exponential backoff after the failed attempt, counted from 1"""
+        configuration = self._retry_configuration
+        if not configuration.enabled:
+            return 0.0
+        return random.uniform(0, min(configuration.max_delay_seconds, configuration.base_delay_seconds * 2 ** (attempt - 1)))
+
+    def allow_retry(self) -> bool:
+        """Spends a retry of the request and policy budgets, False when either has none left"""
+        if not self._retry_configuration.enabled:
+            return True
+        request_context = current_request_context()
+        # Work outside of a request, as the embeddings at startup, is only capped by the policy budget
+        if in_request_scope() and request_context.retries >= self._retry_configuration.request_budget:
+            self._retries.inc(policy=self.name, outcome="request_budget_exhausted")
+            return False
+        if not self._budget.try_spend():
+            self._retries.inc(policy=self.name, outcome="budget_exhausted")
+            return False
+        request_context.retries += 1
+        request_context.ledger.record_retry(self.name)
+        self._retries.inc(policy=self.name, outcome="retried")
+        return True
+
+
+_policies = {}
+
+
+def retry_policy(name: str) -> RetryPolicy:
+    """Returns the retry policy of the kind of call ("llm", "search", "api", "generator"), shared by the whole process"""
+    if name not in _policies:
+        _policies[name] = RetryPolicy(name, Main.configuration().retry_configuration, metrics_registry())
+    return _policies[name]
@@ -1,6 +1,7 @@
 ## Only put resusable functions here
 
 from common.base import Main
+from common.metrics import metrics_registry
 
 from functools import wraps
 import time
@@ -19,13 +20,21 @@ _ = load_dotenv(find_dotenv())
 
 
 def timeit(func):
+    """Records the duration of the decorated coroutine in the stage duration histogram"""
+    stage_seconds = metrics_registry().histogram("stage_duration_seconds", "Duration of a pipeline stage", ("function", "outcome"))
+
     @wraps(func)
     async def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = await func(*args, **kwargs)  # Await the async function
-        end_time = time.time()
-        Main.logger().critical('\x1b[6;30;42m' + f"Time taken by {func.__name__}: {end_time - start_time} seconds" + '\x1b[0m')
-        return result
+        start_time = time.perf_counter()
+        outcome = "error"
+        try:
+            result = await func(*args, **kwargs)  # Await the async function
+            outcome = "success"
+            return result
+        finally:
+            elapsed = time.perf_counter() - start_time
+            stage_seconds.observe(elapsed, function=func.__name__, outcome=outcome)
+            Main.logger().info(f"Time taken by {func.__name__}: {elapsed:.3f} seconds ({outcome})")
     return wrapper
 
 
@@ -1,15 +1,17 @@
 """Conversation REST controller module"""
 from common.controller import RestController
 from common.base import Main
-from common.data_model import QueryContext, Roles
+from common.data_model import QueryContext, Roles, RequestPriority
 from conversation.manager import ConversationServiceManager
 from conversation.db_models import ConversationModelService
 
 from conversation.model import  ConversationResponse, ConversationRequest
-from fastapi import APIRouter, Depends, status, HTTPException
+from fastapi import APIRouter, Depends, Request, status, HTTPException
 from fastapi.security import HTTPBasicCredentials, HTTPBasic
 from typing import Annotated
+import asyncio
 import secrets
+import uuid
 from time import perf_counter
 import json
 
@@ -71,6 +73,13 @@ class ConversationRestController(RestController):
         
         return conversation_msgs
     
+    async def cancel_on_disconnect(self, request: Request, request_id: str) -> None:
+        """Cancels the conversation request once its client disconnects"""
+        poll_seconds = Main.configuration().request_cancellation_configuration.disconnect_poll_seconds
+        while not await request.is_disconnected():
+            await asyncio.sleep(poll_seconds)
+        self._conversation_service_manager.cancel(request_id, "client_disconnected")
+
     @staticmethod
     def get_conversation_base():
         return Main.storage().get_base()
@@ -83,7 +92,7 @@ class ConversationRestController(RestController):
         # db_models.Base.metadata.create_all(bind=postgres_db_service.engine)
 
         @app.post("/converse", response_model=ConversationResponse, status_code=status.HTTP_200_OK, tags=["converse"])
-        async def converse(username: Annotated[str, Depends(self.get_current_username)], converse_request: ConversationRequest = Depends()):
+        async def converse(request: Request, username: Annotated[str, Depends(self.get_current_username)], converse_request: ConversationRequest = Depends()):
             try:
                 """Returns the converse response"""
                 conversation_context = ConversationBufferWindowMemory(k=10)
@@ -105,7 +114,9 @@ class ConversationRestController(RestController):
                     query=converse_request.query,
                     role=converse_request.user_role.value,
                     stream_response=lambda response: dummy_stream_response(converse_request.query),
-                    conversation_context=conversation_context
+                    conversation_context=conversation_context,
+                    priority=RequestPriority(converse_request.priority).value,
+                    request_id=str(uuid.uuid4()),
                 )
 
                 step_functions = {
@@ -118,7 +129,16 @@ class ConversationRestController(RestController):
                 }
                 
                 start_time = perf_counter()
-                converse_response =  await self._conversation_service_manager.converse_api(query_context, step_functions, planner=converse_request.planner.value)
+                # Runs in its own task, so a disconnect cancels the conversation and not the request handler
+                conversation = asyncio.create_task(
+                    self._conversation_service_manager.converse_api(query_context, step_functions, planner=converse_request.planner.value))
+                disconnect_watcher = asyncio.create_task(self.cancel_on_disconnect(request, query_context.request_id))
+                try:
+                    converse_response = await conversation
+                finally:
+                    disconnect_watcher.cancel()
+                    # Stops the conversation when the handler itself is cancelled
+                    conversation.cancel()
                 end_time = perf_counter()
                 
                 Main.logger().info(f"The conversation response for thread id {converse_request.context_id} & user {username} : {converse_response}")
@@ -130,15 +150,32 @@ class ConversationRestController(RestController):
                         thread_context=(converse_request.query, converse_response),
                         username=username,
                     )
+                    if query_context.ledger is not None:
+                        self.conversation_db_model_service.insert_turn_ledger(
+                            db=self.conversation_db_model_service.database_manager.postgres_db_service().get_db_session(),
+                            thread_id=db_thread,
+                            request_id=query_context.request_id,
+                            query=converse_request.query,
+                            ledger=query_context.ledger,
+                            username=username,
+                        )
                 except (PsycopgOperationalError, SQLAlchemyOperationalError, AttributeError) as e:
                     Main.logger().critical(f"Saving the thread to db failed due to ..{e}, cannot generate thread id !")
 
                 return ConversationResponse(
                     response=converse_response,
                     context_id=db_thread,
-                    response_time_in_seconds=f"{end_time - start_time:.4}"
+                    response_time_in_seconds=f"{end_time - start_time:.4}",
+                    ledger=query_context.ledger if converse_request.include_ledger else None,
                 )
             
+            except asyncio.CancelledError:
+                if asyncio.current_task().cancelling():
+                    # The handler itself is cancelled, as on shutdown
+                    raise
+                Main.logger().info(f"Conversation request {query_context.request_id} of user {username} was cancelled")
+                # Non standard "client closed request" status, nobody is left to read it
+                raise HTTPException(status_code=499, detail="The conversation request was cancelled")
             except BaseException as e:
                 Main.logger().error(f"Failed while conversing with error .. {e}", exc_info=1)
                 raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Failed while conversing with error .. {e}")
\ No newline at end of file
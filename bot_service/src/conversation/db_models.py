@@ -1,4 +1,4 @@
-from sqlalchemy import inspect,Boolean, Column, ForeignKey, Integer, String, JSON, DateTime
+from sqlalchemy import inspect,Boolean, Column, ForeignKey, Integer, String, JSON, DateTime, Float
 from sqlalchemy.orm import relationship, Session
 from sqlalchemy.sql import func
 from sqlalchemy.ext.declarative import declarative_base
@@ -51,6 +51,25 @@ class Thread(Base):
             for c in inspect(obj).mapper.column_attrs
         }
 
+class TurnLedger(Base):
+    """Tokens, estimated cost, API calls and retries of one conversation turn of a thread"""
+    __tablename__ = "converse_turn_ledgers"
+
+    id = Column(Integer, primary_key=True)
+    thread_id = Column(Integer, ForeignKey('converse_threads.id'), index=True)
+    user_id = Column(Integer, ForeignKey('converse_users.id'), index=True)
+    request_id = Column(String, index=True)
+    query = Column(String)
+    cost_usd = Column(Float)
+    ledger = Column(JSON, default=lambda: {})
+    created_at = Column(DateTime, server_default=func.now())
+
+    def object_as_dict(obj):
+        return {
+            c.key: getattr(obj, c.key)
+            for c in inspect(obj).mapper.column_attrs
+        }
+
 class ConversationModelService(Service):
 
     def __init__(self, database_service_manager: DatabaseServiceManager) -> None:
@@ -100,6 +119,24 @@ class ConversationModelService(Service):
                     c.key: getattr(obj, c.key)
                     for c in inspect(obj).mapper.column_attrs
                 }
+
+        class TurnLedger(Base):
+            __tablename__ = "converse_turn_ledgers"
+
+            id = Column(Integer, primary_key=True)
+            thread_id = Column(Integer, ForeignKey('converse_threads.id'), index=True)
+            user_id = Column(Integer, ForeignKey('converse_users.id'), index=True)
+            request_id = Column(String, index=True)
+            query = Column(String)
+            cost_usd = Column(Float)
+            ledger = Column(JSON, default=lambda: {})
+            created_at = Column(DateTime, server_default=func.now())
+
+            def object_as_dict(obj):
+                return {
+                    c.key: getattr(obj, c.key)
+                    for c in inspect(obj).mapper.column_attrs
+                }
         
         try:
             if base:
@@ -136,6 +173,15 @@ class ConversationModelService(Service):
         return db_thread.id
         
 
+    def insert_turn_ledger(self, db: Session, thread_id: int, request_id: str, query: str, ledger: dict, username: str = None) -> int:
+        """Stores the ledger of a conversation turn next to its thread"""
+        db_user = self.get_user(db, username=username)
+        db_ledger = TurnLedger(thread_id=thread_id, user_id=db_user.id if db_user else None, request_id=request_id,
+                               query=query, cost_usd=ledger.get("cost_usd"), ledger=ledger)
+        db.add(db_ledger)
+        db.commit()
+        return db_ledger.id
+
     def get_converse_thread(self, db: Session, thread_id: int) -> Thread | None:
         return db.query(Thread).filter(Thread.id == thread_id).first()
         
\ No newline at end of file
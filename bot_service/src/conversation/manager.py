@@ -1,3 +1,7 @@
+import asyncio
+from contextlib import contextmanager
+from typing import Iterator
+
 from common.service_management import ServiceManager
 from search.manager import SearchServiceManager
 from common.base import Main
@@ -5,7 +9,10 @@ from common.utils import timeit
 from planner.manager import PlannerServiceManager
 from LLM.manager import LLMServiceManager
 from langchain.memory import ConversationBufferWindowMemory
-from common.data_model import QueryContext
+from common.data_model import QueryContext, RequestPriority
+from common.event_loop_monitor import EventLoopMonitor
+from common.metrics import metrics_registry
+from common.request_context import RequestContext, request_scope
 
 
 class ConversationServiceManager(ServiceManager):
@@ -15,6 +22,47 @@ class ConversationServiceManager(ServiceManager):
         self._planner_service_manager = planner_service_manager
         self._llm_service_manager = llm_service_manager
         self._context = ConversationBufferWindowMemory(k=10)
+        self._event_loop_monitor = EventLoopMonitor(Main.configuration().event_loop_monitor_configuration)
+        # The requests being handled by id, for the clients that stop them or go away
+        self._requests = {}
+        self._cancellations = metrics_registry().counter("conversation_cancellations_total", "Conversation requests cancelled before finishing, by reason", ("reason",))
+
+    async def stop(self):
+        """Stops the blocking call monitor"""
+        self._event_loop_monitor.stop()
+
+    def event_loop_monitor(self) -> EventLoopMonitor:
+        return self._event_loop_monitor
+
+    def cancel(self, request_id: str, reason: str) -> bool:
+        """Cancels the request being handled, its streams and HTTP calls are aborted and their permits released.
+
+        Returns False when the request is not running anymore or cancellation is disabled
+        """
+        request_context = self._requests.get(request_id)
+        if request_context is None or not Main.configuration().request_cancellation_configuration.enabled:
+            return False
+        if request_context.cancel(reason):
+            Main.logger().info(f"Cancelling request {request_id}: {reason}")
+        return True
+
+    @contextmanager
+    def _request_scope(self, query_context: QueryContext) -> Iterator[RequestContext]:
+        """Binds the context of a conversation turn, which can be cancelled by its id until it finishes"""
+        request_context = RequestContext(priority=query_context.priority, request_id=query_context.request_id)
+        with request_scope(request_context):
+            self._llm_service_manager.shadow_traffic().sample(request_context)
+            self._requests[request_context.request_id] = request_context
+            try:
+                yield request_context
+            except asyncio.CancelledError:
+                # Cancelled by its client through cancel, or directly through its task as Chainlit stops do
+                self._cancellations.inc(reason=request_context.cancel_reason or "stopped")
+                raise
+            finally:
+                self._requests.pop(request_context.request_id, None)
+                self.log_request_trace(request_context)
+                self.record_ledger(query_context, request_context)
 
     @timeit
     async def converse(self, query_context: QueryContext, create_step) -> str:
@@ -22,15 +70,17 @@ class ConversationServiceManager(ServiceManager):
         query = query_context.query
         stream_response = query_context.stream_response
         role = query_context.role
-        Main.logger().info(f"Query Context {query_context}")
-        planner_response = await self._planner_service_manager.planner(query_context, role=role)
-        Main.logger().info(f"\n\n Planner Response is {planner_response}")
-        if planner_response:
-            # self._context.save_context({"inputs": query}, {"outputs": planner_response})
-            query_context.conversation_context.save_context({"inputs": query}, {"outputs": planner_response})
-        # Main.logger().info(f"Saved context after planner response is {self._context.load_memory_variables({})}")
-        awaitable_response = await self._planner_service_manager.execute_tasks(planner_response, query_context, create_step)
-        return awaitable_response
+        self._event_loop_monitor.watch()
+        with self._request_scope(query_context):
+            Main.logger().info(f"Query Context {query_context}")
+            planner_response = await self._planner_service_manager.planner(query_context, role=role)
+            Main.logger().info(f"\n\n Planner Response is {planner_response}")
+            if planner_response:
+                # self._context.save_context({"inputs": query}, {"outputs": planner_response})
+                query_context.conversation_context.save_context({"inputs": query}, {"outputs": planner_response})
+            # Main.logger().info(f"Saved context after planner response is {self._context.load_memory_variables({})}")
+            awaitable_response = await self._planner_service_manager.execute_tasks(planner_response, query_context, create_step)
+            return awaitable_response
         
         # await cl.Message(content=f"Generated final response: \n{response}",).send()
 
@@ -39,19 +89,75 @@ class ConversationServiceManager(ServiceManager):
         query = query_context.query
         stream_response = query_context.stream_response
         role = query_context.role
-        # query_context.conversation_context = self._context
-        Main.logger().info(f"Query Context {query_context}")
-        # planner_response = await self._planner_service_manager.planner2(query)
-        # direct_response = await self._search_service_manager.search(query)
-        # self._context.save_context(query)
-        # Main.logger().info(f"Saved context is {self._context.load_memory_variables({})}")
-        planner_response = await self._planner_service_manager.planner(query_context, role=role, planner_name=planner)
-        Main.logger().info(f"Planner Response is : {planner_response}")
-
-        # await stream_response(f"Generated thought process: \n{planner_response}")
-        if planner_response:
-            # self._context.save_context({"inputs": query}, {"outputs": planner_response})
-            query_context.conversation_context.save_context({"inputs": query}, {"outputs": planner_response})
-        # Main.logger().info(f"Saved context after planner response is {self._context.load_memory_variables({})}")
-        awaitable_response = await self._planner_service_manager.execute_tasks(planner_response, query_context, create_step)
-        return awaitable_response
\ No newline at end of file
+        self._event_loop_monitor.watch()
+        with self._request_scope(query_context):
+            # query_context.conversation_context = self._context
+            Main.logger().info(f"Query Context {query_context}")
+            # planner_response = await self._planner_service_manager.planner2(query)
+            # direct_response = await self._search_service_manager.search(query)
+            # self._context.save_context(query)
+            # Main.logger().info(f"Saved context is {self._context.load_memory_variables({})}")
+            planner_response = await self._planner_service_manager.planner(query_context, role=role, planner_name=planner)
+            Main.logger().info(f"Planner Response is : {planner_response}")
+
+            # await stream_response(f"Generated thought process: \n{planner_response}")
+            if planner_response:
+                # self._context.save_context({"inputs": query}, {"outputs": planner_response})
+                query_context.conversation_context.save_context({"inputs": query}, {"outputs": planner_response})
+            # Main.logger().info(f"Saved context after planner response is {self._context.load_memory_variables({})}")
+            awaitable_response = await self._planner_service_manager.execute_tasks(planner_response, query_context, create_step)
+            return awaitable_response
+
+    @timeit
+    async def converse_batch(self, query_contexts: list[QueryContext], create_step, role: str) -> list:
+        """Converses over independent queries, planning them in one LLM batch and executing their tasks concurrently.
+
+        Returns the response of each query, or the exception it failed with.
+        """
+        self._event_loop_monitor.watch()
+        with request_scope(RequestContext(priority=RequestPriority.batch.value)):
+            planner_responses = await self._planner_service_manager.planner_batch(query_contexts, role=role)
+        semaphore = asyncio.Semaphore(Main.configuration().llm_batch_configuration.max_concurrency)
+
+        async def execute(query_context: QueryContext, planner_response: str | None) -> str:
+            async with semaphore:
+                with self._request_scope(query_context):
+                    Main.logger().info(f"Planner Response for {query_context.query} is : {planner_response}")
+                    if planner_response is None:
+                        raise ValueError(f"No plan could be made for {query_context.query}")
+                    query_context.conversation_context.save_context({"inputs": query_context.query}, {"outputs": planner_response})
+                    return await self._planner_service_manager.execute_tasks(planner_response, query_context, create_step)
+
+        return await asyncio.gather(
+            *(execute(query_context, planner_response) for query_context, planner_response in zip(query_contexts, planner_responses)),
+            return_exceptions=True,
+        )
+
+    def record_ledger(self, query_context: QueryContext, request_context: RequestContext) -> None:
+        """Hands the ledger of the finished request to its caller and writes it to the LLM logs"""
+        if not Main.configuration().request_ledger_configuration.enabled:
+            return
+        ledger = request_context.ledger.summary()
+        query_context.ledger = ledger
+        self._llm_service_manager.log_sink().submit({
+            "request_id": request_context.request_id,
+            "kind": "ledger",
+            "query": query_context.query,
+            "role": query_context.role,
+            "priority": query_context.priority,
+            "cancel_reason": request_context.cancel_reason,
+            # Totals of the request, the log sink would count them otherwise
+            "prompt_tokens": ledger["llm"]["prompt_tokens"],
+            "completion_tokens": ledger["llm"]["completion_tokens"],
+            "ledger": ledger,
+        })
+
+    @staticmethod
+    def log_request_trace(request_context: RequestContext) -> None:
+        """Logs the telemetry of the LLM calls made for the request"""
+        llm_calls = list(request_context.llm_calls)
+        Main.logger().info(
+            f"Request {request_context.request_id} made {len(llm_calls)} LLM calls, "
+            f"{sum(llm_call['latency_seconds'] for llm_call in llm_calls):.2f}s in total, "
+            f"estimated cost ${request_context.ledger.cost():.4f}: {llm_calls}"
+        )
@@ -1,4 +1,4 @@
-from common.data_model import Roles, PlannerEnum
+from common.data_model import Roles, PlannerEnum, RequestPriority
 # from common.data_model import BaseModel
 
 # NOTE: Overiding to use pydantic v2 with latest fastapi
@@ -23,9 +23,13 @@ class ConversationRequest(BaseModel):
     user_role: Roles = Roles.admin.value
     context_id: str | None = None
     planner: PlannerEnum = PlannerEnum.planner_with_apis.value
+    priority: RequestPriority = RequestPriority.interactive.value
+    include_ledger: bool = False
 
 class ConversationResponse(BaseModel):
     """Represents the conversation response request"""
     context_id: int
     response: str
-    response_time_in_seconds: float 
\ No newline at end of file
+    response_time_in_seconds: float
+    # Tokens, estimated cost, API calls and retries of the turn, when requested
+    ledger: dict | None = None 
\ No newline at end of file
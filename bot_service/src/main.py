@@ -11,6 +11,7 @@ from database.manager import DatabaseServiceManager
 from health.manager import HealthServiceManager
 from health.controller import HealthRestController
 from conversation.controller import ConversationRestController
+from metrics.controller import MetricsRestController
 from conversation.db_models import ConversationModelService
 
 from fastapi import APIRouter
@@ -117,6 +118,12 @@ class ApplicationMain:
         conversation_rest_controller = ConversationRestController(conversation_service_manager, conversation_model_service_manager)
         conversation_rest_controller.prepare(application)
 
+        llm_service_manager = ApplicationMain._impl.service_manager(LLMServiceManager.__name__)
+        metrics_rest_controller = MetricsRestController(llm_service_manager, conversation_rest_controller.get_current_username)
+        metrics_rest_controller.prepare(application)
+        # the provider connections are opened on the serving loop, warm them up once it starts
+        application.add_event_handler("startup", llm_service_manager.warm_up)
+
 
     @staticmethod
     async def service_manager(name: str) -> ServiceManager:
@@ -139,7 +146,7 @@ class ApplicationMain:
         await ApplicationMain._impl.stop_service_managers()
         await ApplicationMain._impl.destroy_service_managers()
         ApplicationMain._impl = None
-        await Main.finalize()
+        Main.finalize()
 
     @staticmethod
     def serve() -> None:
@@ -0,0 +1,39 @@
+"""Metrics REST controller module"""
+from common.controller import RestController
+from common.metrics import metrics_registry
+from LLM.manager import LLMServiceManager
+from fastapi import APIRouter, Depends
+from fastapi.responses import PlainTextResponse
+
+
+class MetricsRestController(RestController):
+    """Implements the metrics REST controller"""
+
+    def __init__(self, llm_service_manager: LLMServiceManager, authenticate) -> None:
+        super().__init__()
+        self._llm_service_manager = llm_service_manager
+        # The metrics expose usage and routing details, they need the credentials of the REST API
+        self._authenticate = authenticate
+
+    def prepare(self, app: APIRouter) -> None:
+        """Prepares the service"""
+
+        @app.get("/metrics", response_class=PlainTextResponse, tags=["metrics"], dependencies=[Depends(self._authenticate)])
+        async def metrics() -> str:
+            """Returns the counters and histograms in the Prometheus text format"""
+            return metrics_registry().render()
+
+        @app.get("/metrics/llm", tags=["metrics"], dependencies=[Depends(self._authenticate)])
+        async def llm_metrics() -> dict:
+            """Returns a summary of the metrics and the state of the LLM layer"""
+            return {
+                "metrics": metrics_registry().snapshot(),
+                "usage": self._llm_service_manager.usage_stats(),
+                "response_cache": self._llm_service_manager.cache_stats(),
+                "streaming": self._llm_service_manager.streaming_stats(),
+                "scheduler": self._llm_service_manager.scheduler().stats(),
+                "router": self._llm_service_manager.router().stats(),
+                "endpoints": self._llm_service_manager.balancer().stats(),
+                "cascades": self._llm_service_manager.cascade_stats(),
+                "shadow": self._llm_service_manager.shadow_traffic().stats(),
+            }
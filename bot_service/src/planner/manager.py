@@ -1,16 +1,23 @@
 import ast
+import asyncio
 import datetime
 import json
+import time
 
 import asyncify
 import pandas as pd
 from api_handler.manager import APIHandlerServiceManager
 from common.base import Main
-from common.data_model import LLMProvider, QueryContext
+from common.data_model import LLMBatchRequest, LLMProvider, LLMStage, PromptAllocation, PromptSlot, QueryComplexity, QueryContext
+from common.metrics import metrics_registry
+from common.request_context import current_request_context
+from common.retry import retry_policy
 from common.service_management import ServiceManager
 from common.utils import timeit
 from database.manager import DatabaseServiceManager
+from LLM.json_stream import JSONStreamError
 from LLM.manager import LLMServiceManager
+from planner.router import PlannerRouter
 from search.manager import SearchServiceManager
 from store.prompts import PromptStore
 from transformer.manager import TransformerServiceManager
@@ -27,6 +34,15 @@ class PlannerServiceManager(ServiceManager):
         self.llm = _llm_service_manager.get_service(llm_provider =  LLMProvider.openai.value, model_name = "gpt-4-turbo")
         self.llm_search = _llm_service_manager.get_service(llm_provider =  LLMProvider.perplexity_ai.value, model_name = "llama-3.1-sonar-large-128k-online")
         self.llm_summerizer= _llm_service_manager.get_service(llm_provider =  LLMProvider.anthropic_ai.value, model_name = "claude-3-opus-20240229")
+        # Fast planner model of the queries the planner router classifies as simple
+        planner_router_configuration = Main.configuration().planner_router_configuration
+        self.planner_router = PlannerRouter(planner_router_configuration, metrics_registry())
+        self.llm_fast_planner = _llm_service_manager.get_service(llm_provider = planner_router_configuration.simple_provider, model_name = planner_router_configuration.simple_model_name)
+        # Fast model summarizing the chunks of task results too large for the summarizer
+        summarization_configuration = Main.configuration().summarization_configuration
+        self.llm_map_summerizer = _llm_service_manager.get_service(llm_provider = summarization_configuration.map_provider, model_name = summarization_configuration.map_model_name)
+        # Fast model streaming the draft answer while the summarizer model refines it
+        self.llm_draft_summerizer = _llm_service_manager.get_service(llm_provider = summarization_configuration.draft_provider, model_name = summarization_configuration.draft_model_name)
 
 
         # self.llm = _llm_service_manager.get_service(llm_provider =  LLMProvider.azure_openai.value, model_name = Main.configuration().azureai_configuration.model_name,
@@ -44,9 +60,13 @@ class PlannerServiceManager(ServiceManager):
         self.transformer_manager = _transformer_service_manager
         self.database_manager = _database_service_manager.mongo_db_service()
         self.llm_manager = _llm_service_manager
+        # Endpoint generation starts on a fast model and escalates after failed attempts
+        self.generator_cascade = _llm_service_manager.cascade(LLMStage.generator.value, self.llm)
+        self.prompt_budget = _llm_service_manager.prompt_budget()
         #Need to indent the JSON for higher prompt performance
         with open(Main.configuration().llm_response_format_configuration.planner_schema,"r") as f:
-            self.planner_schema = json.dumps(json.load(f),indent=3)
+            self.planner_response_schema = json.load(f)
+            self.planner_schema = json.dumps(self.planner_response_schema,indent=3)
             
         with open(Main.configuration().llm_response_format_configuration.api_generator_schema,"r") as f:
             self.api_generator_schema = json.load(f) 
@@ -54,48 +74,108 @@ class PlannerServiceManager(ServiceManager):
     @timeit
     async def planner(self, query_context: QueryContext,role: str, planner_name: str = "planner_withAPIs") -> str:
         """Creates step-by-step tasks to be executed for the input query. Response is in JSON mode"""
-        knowledge_base_search = await self.search_manager.search(query_context.query,"knowledgebase")
-        Main.logger().info(f"\n\n\n Knowledge base search result: {knowledge_base_search}")
         stream_response = query_context.stream_response
-        prompt = self.prompts.prompt(planner_name).get("text")
-        query = query_context.query
-        context = query_context.conversation_context
-        final_prompt = prompt.format(query=query, context=context, datetime=datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M:%S"), knowledge = knowledge_base_search, response_schema = self.planner_schema)
+        knowledge_base_search, knowledge_distance = await self.search_manager.search_with_distance(query_context.query,"knowledgebase")
+        # Simple queries are planned on the fast model, the planner is on the critical path of every request
+        route = self.planner_router.route(query_context.query, knowledge_distance)
+        llm = self.llm_fast_planner if route.complexity == QueryComplexity.simple.value else self.llm_summerizer
+        final_prompt = await self.planner_prompt(query_context, planner_name, knowledge_base_search, llm)
         #Getting the response in JSON mode
         # Main.logger().info(f"\n\n\n\n Final Planner prompt {final_prompt} ")
         #response = await self.llm.acompletion(final_prompt,stream_response, role=role, response_format={ "type": "json_object" })
-        response = await self.llm_summerizer.acompletion(final_prompt,stream_response, role=role, max_tokens = 4096)
+        started = time.monotonic()
+        response = await llm.acompletion(final_prompt,stream_response, role=role, stage=LLMStage.planner.value, response_schema=self.planner_response_schema, max_tokens = route.max_tokens)
+        self.planner_router.record(route, llm.request_model(), time.monotonic() - started)
         return response
 
+    async def planner_prompt(self, query_context: QueryContext, planner_name: str, knowledge_base_search: any, llm: any) -> str:
+        """Returns the planner prompt for the query, with the knowledge base search result, fitted to the planner model"""
+        Main.logger().info(f"\n\n\n Knowledge base search result: {knowledge_base_search}")
+        query = query_context.query
+        context = query_context.conversation_context
+        # The knowledge base results are trimmed before the conversation history, keeping its latest turns
+        allocation = await self.fit_prompt(planner_name, llm, [
+            PromptSlot(name="response_schema", text=self.planner_schema, required=True),
+            PromptSlot(name="datetime", text=datetime.datetime.now(datetime.UTC).strftime("%Y-%m-%d %H:%M:%S"), required=True),
+            PromptSlot(name="query", text=query, required=True),
+            PromptSlot(name="context", text=str(context), priority=2, keep="tail"),
+            PromptSlot(name="knowledge", text=str(knowledge_base_search), priority=1),
+        ], reserved_output_tokens=4096)
+        # The instructions and schema form a static prefix that the provider can cache across queries
+        return self.prompts.segmented(planner_name, **allocation.values)
+
+    async def fit_prompt(self, prompt_name: str, llm: any, slots: list[PromptSlot], reserved_output_tokens: int = None) -> PromptAllocation:
+        """Trims the values of the prompt to the token budget of the model the LLM service calls"""
+        template = self.prompts.prompt(prompt_name).get("text")
+        return await self.prompt_budget.allocate(template, slots, llm.request_model(), reserved_output_tokens, prompt_name)
+
+    @timeit
+    async def planner_batch(self, query_contexts: list[QueryContext], role: str, planner_name: str = "planner_withAPIs") -> list[str | None]:
+        """Creates the plans of independent queries in one LLM batch, None for the queries that failed.
+
+        Batches are not latency sensitive, so every query is planned on the configured planner model.
+        """
+        async def batch_prompt(query_context: QueryContext) -> str:
+            knowledge_base_search = await self.search_manager.search(query_context.query, "knowledgebase")
+            return await self.planner_prompt(query_context, planner_name, knowledge_base_search, self.llm_summerizer)
+
+        final_prompts = await asyncio.gather(*(batch_prompt(query_context) for query_context in query_contexts))
+        requests = [
+            LLMBatchRequest(custom_id=f"plan-{index}", prompt=final_prompt, params={"max_tokens": 4096})
+            for index, final_prompt in enumerate(final_prompts)
+        ]
+        results = await self.llm_manager.batch_executor().run(self.llm_summerizer, requests, role=role, stage=LLMStage.planner.value)
+        return [results[request.custom_id].response for request in requests]
+
 
     @timeit
     async def global_search(self, task: str, role: str, search_information: str) :
         Main.logger().info(f"Length of search information is {len(search_information)} and type {type(search_information)}")
         
         prompt = self.prompts.prompt("global_search").get("text")
-        final_prompt = prompt.format(task=task, search_information = search_information)
-
-        response = await self.llm_search.completion(final_prompt, role=role)
+        # Search information only guides the search, a few thousand tokens of it keep the search fast
+        allocation = await self.fit_prompt("global_search", self.llm_search, [
+            PromptSlot(name="task", text=task, required=True),
+            PromptSlot(name="search_information", text=search_information, max_tokens=2500),
+        ])
+        final_prompt = prompt.format(**allocation.values)
+
+        # Online search results go stale, they are always searched again
+        response = await self.llm_search.completion(final_prompt, role=role, stage=LLMStage.search.value, use_cache=False)
         return response
 
     @timeit
-    async def summarizer(self, object: any, task: str, stream_response: any, role: str) -> str:
-        """Summarizes the end result for the user"""
+    async def summarizer(self, object: any, task: str, stream_response: any, role: str, stream_draft: any = None, replace_draft: any = None) -> str:
+        """Summarizes the end result for the user. With a draft consumer, a fast draft is streamed while the answer is refined"""
         Main.logger().info("Entered Summarizer Task")
 
         # Get custom client with custom model
         #self.llm = self.llm_manager.get_service(llm_provider =  LLMProvider.openai.value, model_name = "gpt-3.5-turbo")
 
         prompt = self.prompts.prompt("summarizer").get("text") 
-        final_prompt = prompt.format(transformation_prompt=task, object=object)
+        allocation = await self.fit_prompt("summarizer", self.llm_summerizer, [
+            PromptSlot(name="transformation_prompt", text=task, required=True),
+            PromptSlot(name="object", text=str(object)),
+        ], reserved_output_tokens=4096)
+        if allocation.fits and "object" in allocation.dropped and Main.configuration().summarization_configuration.map_reduce_enabled:
+            # Summarize the task results in chunks instead of cutting them, the summaries then fit the budget
+            object_budget = allocation.budget_tokens - await self.llm_summerizer.token_counter(task)
+            partial_summaries = await self.map_summaries(object, task, stream_response, role, object_budget)
+            allocation = await self.fit_prompt("summarizer", self.llm_summerizer, [
+                PromptSlot(name="transformation_prompt", text=task, required=True),
+                PromptSlot(name="object", text=partial_summaries),
+            ], reserved_output_tokens=4096)
+        final_prompt = prompt.format(**allocation.values)
         
         Main.logger().info(f"\n\n Final Summarization Prompt is {final_prompt}")
         # Main.logger().info(f"Final prompt in summariser {final_prompt}")
-        tokens = await self.llm.token_counter(str(final_prompt))
         response = 'Cannot process the response right now as it contains too many tokens !'
 
-        if tokens < 128000:
-            response = await self.llm_summerizer.acompletion(final_prompt, stream_response, role=role, max_tokens = 4096)
+        if allocation.fits and stream_draft and replace_draft and Main.configuration().summarization_configuration.draft_enabled:
+            response = await self.draft_and_refine(allocation.values, final_prompt, role, stream_draft, replace_draft)
+
+        elif allocation.fits:
+            response = await self.llm_summerizer.acompletion(final_prompt, stream_response, role=role, stage=LLMStage.summarizer.value, max_tokens = 4096)
 
         else:
             Main.logger().debug(response)
@@ -105,13 +185,119 @@ class PlannerServiceManager(ServiceManager):
         return response
     
 
-    async def endpoint_generator(self, search_result: str, question: str, context: any,generated_endpoints: list, role:str):
+    async def draft_and_refine(self, values: dict, final_prompt: str, role: str, stream_draft: any, replace_draft: any) -> str:
+        """Streams a draft answer from the draft model while the summarizer model refines it silently, then replaces the draft.
+
+        The answer is only streamed once, as the draft. The draft is the answer when the refinement fails,
+        a refined answer that comes first cancels the draft and takes its place.
+        """
+        summarization_configuration = Main.configuration().summarization_configuration
+
+        async def draft() -> str | None:
+            try:
+                allocation = await self.fit_prompt("summarizer", self.llm_draft_summerizer, [
+                    PromptSlot(name="transformation_prompt", text=values["transformation_prompt"], required=True),
+                    PromptSlot(name="object", text=values["object"]),
+                ], reserved_output_tokens=summarization_configuration.draft_max_tokens)
+                return await self.llm_draft_summerizer.acompletion(
+                    self.prompts.prompt("summarizer").get("text").format(**allocation.values), stream_draft, role=role,
+                    stage=LLMStage.summarizer.value, max_tokens=summarization_configuration.draft_max_tokens)
+            except Exception as e:
+                Main.logger().warning(f"Draft summary failed, waiting for the refined summary: {e!r}")
+                return None
+
+        draft_task = asyncio.create_task(draft())
+        try:
+            response = await self.llm_summerizer.completion(final_prompt, role=role, stage=LLMStage.summarizer.value, max_tokens = 4096)
+        except Exception as e:
+            draft_response = await draft_task
+            if draft_response is None:
+                raise
+            Main.logger().warning(f"Refined summary failed, keeping the draft: {e!r}")
+            return draft_response
+        finally:
+            draft_task.cancel()
+        await replace_draft(response)
+        return response
+
+    @timeit
+    async def map_summaries(self, task_responses: any, task: str, stream_response: any, role: str, budget_tokens: int) -> str:
+        """Summarizes the task results chunk by chunk and concurrently on the map model, until the summaries fit the budget"""
+        summarization_configuration = Main.configuration().summarization_configuration
+        texts = [str(task_response) for task_response in task_responses] if isinstance(task_responses, list) else [str(task_responses)]
+        semaphore = asyncio.Semaphore(summarization_configuration.max_concurrency)
+
+        async def map_chunk(chunk: str, part: int, parts: int) -> str:
+            async with semaphore:
+                try:
+                    return await self.llm_map_summerizer.completion(
+                        self.prompts.segmented("map_summarizer", transformation_prompt=task, object=chunk, part=part, parts=parts),
+                        role=role, stage=LLMStage.summarizer.value, max_tokens=summarization_configuration.map_max_tokens)
+                except Exception as e:
+                    # Keep the start of the chunk rather than losing its data
+                    Main.logger().warning(f"Map summarization of part {part} of {parts} failed, keeping it trimmed: {e!r}")
+                    return await self.llm_map_summerizer.tokenizer.truncate(
+                        chunk, summarization_configuration.map_max_tokens, self.llm_map_summerizer.request_model())
+
+        summaries = "\n\n".join(texts)
+        for summary_round in range(summarization_configuration.max_rounds):
+            chunks = await self.result_chunks(texts, summarization_configuration.chunk_tokens)
+            await stream_response(f"\n\n - Summarizing {len(chunks)} parts of the collected data \n")
+            texts = await asyncio.gather(*(map_chunk(chunk, part, len(chunks)) for part, chunk in enumerate(chunks, start=1)))
+            summaries = "\n\n".join(f"Part {part}:\n{text}" for part, text in enumerate(texts, start=1))
+            if len(chunks) == 1 or await self.llm_summerizer.token_counter(summaries) <= budget_tokens:
+                break
+        return summaries
+
+    async def result_chunks(self, texts: list[str], chunk_tokens: int) -> list[str]:
+        """Packs the texts into chunks of at most chunk_tokens of the map model, splitting texts larger than a chunk"""
+        model_name = self.llm_map_summerizer.request_model()
+        tokenizer = self.llm_map_summerizer.tokenizer
+        chunks, chunk, chunk_size = [], [], 0
+        for text in texts:
+            tokens = await tokenizer.count(text, model_name)
+            pieces = await tokenizer.split(text, chunk_tokens, model_name) if tokens > chunk_tokens else [text]
+            for piece in pieces:
+                piece_tokens = tokens if len(pieces) == 1 else await tokenizer.count(piece, model_name)
+                if chunk and chunk_size + piece_tokens > chunk_tokens:
+                    chunks.append("\n\n".join(chunk))
+                    chunk, chunk_size = [], 0
+                chunk.append(piece)
+                chunk_size += piece_tokens
+        if chunk:
+            chunks.append("\n\n".join(chunk))
+        return chunks
+
+    async def endpoint_generator(self, search_result: str, question: str, context: any,generated_endpoints: list, role:str, llm: any = None, use_cache: bool = True):
         """Generates an endpoint given an OpenAPI spec and a user question"""
-        prompt = self.prompts.prompt("generator").get("text")
-        final_prompt = prompt.format(question=question, open_api_spec=search_result, context=context, previous_generations=generated_endpoints, response_schema = self.api_generator_schema)
+        llm = llm or self.llm
+        # The previous failed generations are trimmed first, keeping the latest, then the previous task context
+        allocation = await self.fit_prompt("generator", llm, [
+            PromptSlot(name="response_schema", text=str(self.api_generator_schema), required=True),
+            PromptSlot(name="question", text=question, required=True),
+            PromptSlot(name="open_api_spec", text=str(search_result), priority=3),
+            PromptSlot(name="context", text=str(context), priority=2),
+            PromptSlot(name="previous_generations", text=str(generated_endpoints), priority=1, keep="tail"),
+        ])
+        # Retries only change the previous generations, which come after the cacheable spec and instructions
+        final_prompt = self.prompts.segmented("generator", **allocation.values)
         #Main.logger().info(f"\n\n **** API generator Prompt is {final_prompt} ***** \n\n")
-        response = await self.llm.completion(final_prompt, role=role)
+        response = await llm.completion(final_prompt, role=role, stage=LLMStage.generator.value, response_schema=self.api_generator_schema, use_cache=use_cache)
         return response
+
+    def endpoint_schema_errors(self, generated_endpoint: list) -> list[str]:
+        """Returns how the generated endpoints break the required fields and enums of the generator response schema"""
+        item_schema = self.api_generator_schema.get("items", {})
+        errors = []
+        for endpoint in generated_endpoint:
+            if not isinstance(endpoint, dict):
+                errors.append(f"{endpoint} is not an object")
+                continue
+            errors += [f"{field} is missing" for field in item_schema.get("required", []) if not endpoint.get(field)]
+            for field, field_schema in item_schema.get("properties", {}).items():
+                if "enum" in field_schema and field in endpoint and endpoint[field] not in field_schema["enum"]:
+                    errors.append(f"{field} must be one of {field_schema['enum']}")
+        return errors
     
     @timeit
     async def retry_generator_using_response(self,search_result: list[dict], task:str, task_context: str, role: str):
@@ -120,24 +306,49 @@ class PlannerServiceManager(ServiceManager):
 
         # TODO:loop over generated endpoint & retry for each of them if fails in case of multiple endpoints
         GENERATOR_MAX_RETRIES = Main.configuration().common_configuration.max_retries
+        # Every retry generates again, so it is charged to the retry budgets like the retried LLM calls
+        generator_retries = retry_policy("generator")
+        generator_retries.record_call()
         for retry in range(GENERATOR_MAX_RETRIES):
-            generated_endpoint = await self.endpoint_generator(search_result, task, task_context,generated_endpoints, role)
+            if retry and not generator_retries.allow_retry():
+                Main.logger().info("Retry budget exhausted, not generating the endpoint again")
+                break
+            # Failed attempts escalate to the stronger models of the cascade
+            llm = self.generator_cascade.service(retry)
+            try:
+                # A retry may send the same prompt again, as after a parse error, the cached response is the one that failed
+                generated_endpoint = await self.endpoint_generator(search_result, task, task_context,generated_endpoints, role, llm, use_cache=retry == 0)
+            except JSONStreamError as e:
+                Main.logger().info(f"Generated Endpoint was aborted while streaming: {e}, retrying..")
+                self.generator_cascade.record(llm, "parse_error")
+                continue
             Main.logger().info(f"Generated Endpoint is {generated_endpoint}")
             # generated_endpoint = ast.literal_eval(generated_endpoint)
+            # Schema constrained responses always parse, this retry is left for when structured output is disabled
             try:
                 generated_endpoint = json.loads(generated_endpoint)
             except json.JSONDecodeError as e:
                 Main.logger().info("Generated Endpoint was not a valid json object, retrying..")
+                self.generator_cascade.record(llm, "parse_error")
                 continue
 
             if not isinstance(generated_endpoint, list):
                 generated_endpoint = [generated_endpoint]
+
+            schema_errors = self.endpoint_schema_errors(generated_endpoint)
+            if schema_errors:
+                Main.logger().info(f"Generated Endpoint does not follow the response schema: {schema_errors}, retrying..")
+                self.generator_cascade.record(llm, "invalid")
+                generated_endpoints.append(str(generated_endpoint) + " does not follow the response_schema: " + "; ".join(schema_errors))
+                continue
              
             # Execute API against generated endpoint
             response, endpoint_urls = await self.api_handler.executer(generated_endpoint)
 
             if 'error' not in str(response).lower() and (list(response[0].values()))[0]:
+                self.generator_cascade.record(llm, "success")
                 return response, endpoint_urls
+            self.generator_cascade.record(llm, "api_error")
 
             if len(generated_endpoint) == 1:
                 # TODO Reflection prompt - add to prompts.py and let LLM correct API endpoints
@@ -145,6 +356,9 @@ class PlannerServiceManager(ServiceManager):
                 # Only add reflection prompt when the API response is not correct the first time.
                 generated_endpoints.append((str(generated_endpoint)) + " resulted in error as " + str(response) + "\n" + reflection)
             Main.logger().info(f"Retrying({retry}) generating endpoint with..\n")
+            if retry + 1 < GENERATOR_MAX_RETRIES:
+                # The API is called again right after the next generation, give it room when it is failing
+                await asyncio.sleep(generator_retries.backoff(retry + 1))
             
         return response, endpoint_urls
 
@@ -171,6 +385,8 @@ class PlannerServiceManager(ServiceManager):
         COLLECTION_NAME="AGENT_RESPONSE"
         # task_responses.append(query_context.conversation_context)
         for index, task in enumerate(split_tasks):
+            # The search calls run in threads and finish after their request is cancelled, the next task must not start
+            current_request_context().raise_if_cancelled()
             await stream_response(f"\n\n - Executing task # {index+1} \n")
             
             if '[API]' in task:
@@ -189,7 +405,7 @@ class PlannerServiceManager(ServiceManager):
                 try:
                     if len(endpoint_urls) > 0:
                         await stream_response(f"\n ## Executed {len(endpoint_urls)} with response size of {len(str(response))//4} tokens")
-                except BaseException as e:
+                except Exception as e:
                         Main.logger().info(f" API Generator failed with exception {e}")
                         response = []
                         endpoint_urls = ["/apiurl"]
@@ -210,7 +426,6 @@ class PlannerServiceManager(ServiceManager):
                     #Only add search information if there is a previous response
                     
                     search_information = str(task_responses[index - 1])
-                    search_information = search_information[:10000]
                     
                 
                 response =  await self.global_search(task=task,role=role, search_information = search_information)
@@ -230,7 +445,8 @@ class PlannerServiceManager(ServiceManager):
                 
                 
                 # TODO: Global search will need all tasks for perplexity
-                response = await self.summarizer(task_responses, persona_task, stream_response, role=role)
+                response = await self.summarizer(task_responses, persona_task, stream_response, role=role,
+                                                 stream_draft=query_context.stream_draft, replace_draft=query_context.replace_draft)
 
                 if response:
                     query_context.conversation_context.save_context({"inputs": task}, {"outputs": response})
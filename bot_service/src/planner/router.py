@@ -0,0 +1,86 @@
+"""Implements the query complexity routing of the planner stage"""
+
+import re
+
+from common.base import Main
+from common.data_model import PlannerRoute, PlannerRouterConfiguration, QueryComplexity
+from common.metrics import MetricsRegistry
+
+
+class PlannerRouter:
+    """Classifies queries as simple or complex with local heuristics, no LLM call is made.
+
+    Definition lookups that hit the knowledge base and short single-step questions are simple and
+    planned on the fast model. Comparisons, aggregations and multi-part questions are complex and
+    keep the configured planner model. The planner latency of both routes is tracked to estimate
+    the time saved by every simple route.
+    """
+
+    # Questions that take more than a lookup to answer
+    ANALYTICAL_TERMS = (
+        "compare", "comparison", "versus", " vs", "trend", "breakup", "breakdown", "average", "percentage",
+        "ratio", "correlat", "forecast", "market share", "group", "analy", "impact", "why", "worst", "best",
+        "rank", "top ", "distribution", "growth",
+    )
+    MULTI_STEP_MARKERS = (" and ", " then ", ";", " as well as ", " per ", " each ")
+    LOOKUP_PREFIXES = ("what is", "what's", "what does", "what are", "define", "meaning of", "who is", "explain")
+    # Weight of the latest planner latency in the moving averages
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, router_configuration: PlannerRouterConfiguration, registry: MetricsRegistry):
+        self._router_configuration = router_configuration
+        self._latency = {}
+        self._routes = registry.counter("planner_routes_total", "Planner routing decisions by query complexity", ("complexity",))
+        self._saved_seconds = registry.counter(
+            "planner_latency_saved_seconds_total", "Estimated planner latency saved by routing simple queries to the fast model")
+
+    def route(self, query: str, knowledge_distance: float | None) -> PlannerRoute:
+        """Returns the route of the query, knowledge_distance is that of the best knowledge base match"""
+        configuration = self._router_configuration
+        text = f" {query.lower().strip()} "
+        words = len(re.findall(r"\w+", query))
+        score, reasons = 0, []
+
+        analytical_terms = [term.strip() for term in self.ANALYTICAL_TERMS if term in text]
+        if analytical_terms:
+            score += min(len(analytical_terms), 2)
+            reasons.append(f"analytical terms {analytical_terms}")
+        if any(marker in text for marker in self.MULTI_STEP_MARKERS):
+            score += 1
+            reasons.append("several parts")
+        if query.count("?") > 1:
+            score += 1
+            reasons.append("several questions")
+        if words > configuration.long_query_words:
+            score += 1
+            reasons.append(f"{words} words")
+        elif words <= configuration.short_query_words:
+            score -= 1
+            reasons.append(f"only {words} words")
+        if (knowledge_distance is not None and knowledge_distance <= configuration.knowledge_distance_threshold
+                and text.strip().startswith(self.LOOKUP_PREFIXES)):
+            score -= 2
+            reasons.append(f"definition lookup with knowledge base distance {knowledge_distance:.2f}")
+
+        if not configuration.enabled or score >= configuration.complexity_threshold:
+            return PlannerRoute(complexity=QueryComplexity.complex.value, score=score, reasons=reasons, max_tokens=4096)
+        return PlannerRoute(
+            complexity=QueryComplexity.simple.value, score=score, reasons=reasons, max_tokens=configuration.simple_max_tokens)
+
+    def record(self, route: PlannerRoute, model_name: str, seconds: float) -> None:
+        """Records the planner latency of the route, logging the decision and the estimated time saved"""
+        previous = self._latency.get(route.complexity)
+        self._latency[route.complexity] = seconds if previous is None else (
+            self.LATENCY_SMOOTHING * seconds + (1 - self.LATENCY_SMOOTHING) * previous)
+        self._routes.inc(complexity=route.complexity)
+
+        complex_latency = self._latency.get(QueryComplexity.complex.value)
+        if route.complexity == QueryComplexity.simple.value and complex_latency is not None:
+            saved_seconds = max(0.0, complex_latency - seconds)
+            self._saved_seconds.inc(saved_seconds)
+            Main.logger().info(
+                f"Planned {route.complexity} query (score {route.score}: {', '.join(route.reasons) or 'no signals'}) on {model_name} "
+                f"in {seconds:.2f}s, about {saved_seconds:.2f}s faster than the complex planner")
+        else:
+            Main.logger().info(
+                f"Planned {route.complexity} query (score {route.score}: {', '.join(route.reasons) or 'no signals'}) on {model_name} in {seconds:.2f}s")
@@ -2,6 +2,7 @@ from common.service_management import ServiceManager
 from LLM.manager import LLMServiceManager
 from langchain.document_loaders.csv_loader import CSVLoader
 from common.base import Main
+from common.retry import retry_policy
 import os
 import json
 import traceback
@@ -29,7 +30,8 @@ class SearchServiceManager(ServiceManager):
 
     async def prepare(self) -> None:
         """Prepares the service manager"""
-        self.embedding_function =  await self.llm.get_embeddings(chunk_size=16)
+        # The search retry policy retries failed query embeddings
+        self.embedding_function =  await self.llm.get_embeddings(chunk_size=16, max_retries=0)
         await self.setup_search_database_if_not_exists()
 
     async def calculate_checksum(self, docs_to_embed: list[str]):
@@ -83,13 +85,25 @@ class SearchServiceManager(ServiceManager):
         ids=[str(uuid.uuid5(uuid.NAMESPACE_DNS, txt.page_content)) for txt in doc]
         metadatas = [txt.metadata for txt in doc]
         documents = [txt.page_content for txt in doc]
-        embeddings = [self.embedding_function.embed_query(txt.page_content) for txt in doc]
+        embeddings = [await retry_policy("search").call(self._embed_query, txt.page_content) for txt in doc]
         collection.upsert(ids=ids, metadatas=metadatas, documents=documents, embeddings=embeddings)
         
         
 
     @asyncify
-    def search(self, query: str, collection_name: str) -> list[dict]:
+    def _embed_query(self, text: str) -> list[float]:
+        return self.embedding_function.embed_query(text)
+
+    async def search(self, query: str, collection_name: str) -> list[dict]:
+        """Searches for API functions based on the given query, retrying when the query embedding fails"""
+        return await retry_policy("search").call(self._search, query, collection_name)
+
+    async def search_with_distance(self, query: str, collection_name: str) -> tuple[list, float | None]:
+        """Searches like search, also returning the embedding distance of the best match, None without a match"""
+        return await retry_policy("search").call(self._search_with_distance, query, collection_name)
+
+    @asyncify
+    def _search(self, query: str, collection_name: str) -> list[dict]:
         """Searches for API functions based on the given query, it must return the OpenAI function definitions"""
         # TO DO : Change search result to param
         # results = self._database.similarity_search_with_score(query, k=1) 
@@ -99,6 +113,12 @@ class SearchServiceManager(ServiceManager):
         
         return [results]
 
+    @asyncify
+    def _search_with_distance(self, query: str, collection_name: str) -> tuple[list, float | None]:
+        results = self._database.get_collection(collection_name).query(query_embeddings=self.embedding_function.embed_query(query), n_results=1)
+        distances = results.get('distances') or [[]]
+        return [results['documents']], (distances[0][0] if distances[0] else None)
+
     async def setup_search_database_if_not_exists(self) -> None:
         """Sets up the search database if it does not exist"""
         try:
@@ -1,4 +1,16 @@
+class SegmentedPrompt(str):
+    """Prompt text that keeps its static prefix and request specific suffix apart, so providers can cache the prefix"""
+
+    def __new__(cls, prefix: str, suffix: str):
+        prompt = super().__new__(cls, prefix + suffix)
+        prompt.prefix = prefix
+        prompt.suffix = suffix
+        return prompt
+
+
 class PromptStore:
+    # Splits a prompt text into the part that is the same for every request and the part that is not
+    CACHE_BREAKPOINT = "{cache_breakpoint}"
     
     _PROMPTS = {
         "summarizer": {
@@ -20,6 +32,28 @@ class PromptStore:
             "author": "Dhiraj Nambiar",
             "module": "NA"
         },
+        "map_summarizer": {
+            "text": """
+            You are an Expert that condenses one part of the data collected to answer a user's task. The condensed parts of all the data are combined by another step that answers the task.
+
+            Instructions:
+            Extract every fact, figure, name, date and reference in the data below that is relevant to the task, keeping numbers and units exact.
+            Leave out anything irrelevant to the task. Do not answer the task yourself and do not add anything that is not in the data.
+            Respond with a concise list of bullet points.
+{cache_breakpoint}
+            Task:
+            {transformation_prompt}
+
+            Data (part {part} of {parts}):
+            {object}
+            """,
+            "version": "1",
+            "description": "This is the map prompt of the map-reduce summarization of task results too large for the summarizer",
+            "notes": "Runs on a fast model, one call per chunk of the task results",
+            "last_updated": "2026-10-18",
+            "author": "",
+            "module": "planner"
+        },
         "transformer": {
             "text": """You are a very smart AI assistant. Given the "response object" below which provides an API response or a dataframe response with information, perform the following operation as per the "transformation request" below
 
@@ -39,36 +73,34 @@ class PromptStore:
             "module": "Transformer",        },
         "generator": {
             "text": """
-                                "Context"
-                                {context}
-
                     "response_schema": {response_schema}
-                                           
-                    "Previous Generations":
-                    {previous_generations}
-                            
+
                     "OpenAPI spec":
                     {open_api_spec}
-                    
-                    Given the "OpenAPI spec", "Context", "Response examples", "question" above, generate a complete endpoint for consumption by a software. Here are the detailed instructions:
+
+                                "Context"
+                                {context}
+
+                    Given the "OpenAPI spec" and "Context" above and the "Previous Generations" and "question" below, generate a complete endpoint for consumption by a software. Here are the detailed instructions:
                     1. The "OpenAPI spec" contains the OpenAPI specifications and examples of APIs that can be used to answer the "question". Don't use the "Response examples" in your generation
                     2. The "Previous Generations" contains the previous failed generations that you should know about when trying to generate the endpoint. When you see a previous failed generation, you MUST change your output. 
                     3. IMPORTANT: Do not provide any text before and after the response format.
                     4. Always refer to the "OpenAPI spec" to generate the correct endpoint. Do not make up any endpoints, parameters or any data by yourself.
                     5. Always follow the data type of each parameter to eliminate bad endpoints
-                    6  Your response will always be in JSON mode, use the response_schema given below while responding. Do not add ```json in your generations as that is obviously incorrect.
+                    6  Your response will always be in JSON mode, use the response_schema given above while responding. Do not add ```json in your generations as that is obviously incorrect.
                     7. DO NOT ADD ANY COMMENTS to your JSON response. Doing so is a catastrophic failure
                     8. Before you respond, have you made sure that you've followed all the steps? Take a deep breath and check. Are you sure you're not repeating the same mistake again?
-                    
-
+{cache_breakpoint}
+                    "Previous Generations":
+                    {previous_generations}
 
                     "question":
                     {question}
                     Response: 
             """,
-            "version": "2",
+            "version": "3",
             "description": "This prompt is used to provide OpenAI with instructions for generating a complete endpoint.",
-            "notes": "We are trying to force the generator to make use of the vectorDB search result which will get passed in the OpenAPI spec",
+            "notes": "We are trying to force the generator to make use of the vectorDB search result which will get passed in the OpenAPI spec. The spec and instructions come first so retries share a cacheable prefix",
             "last_updated": "2024-04-25",
             "author": "Dhiraj Nambiar",
             "module": "Generator",
@@ -114,7 +146,7 @@ class PromptStore:
 
             
             response_schema: {response_schema}
-
+{cache_breakpoint}
             Definitions related to question (ignore if irrelevant): {knowledge}
             Current date: {datetime}
             Conversation history: {context} 
@@ -142,7 +174,7 @@ class PromptStore:
             1) Every plan you make has exactly 1 step. Use the example query above and structure your plan as a variation of this question. Use the same template every time you create a plan. 
             2) Your response will always be in JSON. No characters before or after the JSON
             response_schema: {response_schema}
-            Definitions related to question (ignore if irrelevant): {knowledge}
+{cache_breakpoint}            Definitions related to question (ignore if irrelevant): {knowledge}
             Current date: {datetime}
             Conversation history: {context} 
             User query: {query}
@@ -192,7 +224,7 @@ class PromptStore:
 
 
             response_schema: {response_schema}
-
+{cache_breakpoint}
             Definitions related to question (ignore if irrelevant): {knowledge}
             Current date: {datetime}
             Conversation history: {context} 
@@ -233,4 +265,12 @@ class PromptStore:
     }
 
     def prompt(self, prompt_name: str) -> str:
-        return self._PROMPTS[prompt_name]
\ No newline at end of file
+        return self._PROMPTS[prompt_name]
+
+    def segmented(self, prompt_name: str, **values) -> SegmentedPrompt:
+        """Formats the prompt with the values, split at its cache breakpoint"""
+        text = self.prompt(prompt_name).get("text")
+        if self.CACHE_BREAKPOINT not in text:
+            return SegmentedPrompt("", text.format(**values))
+        prefix, _, suffix = text.partition(self.CACHE_BREAKPOINT)
+        return SegmentedPrompt(prefix.format(**values), suffix.format(**values))
\ No newline at end of file
@@ -0,0 +1,6 @@
+"""Makes the service packages importable from the tests, as they are when the service runs from src"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
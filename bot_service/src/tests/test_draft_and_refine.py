@@ -0,0 +1,102 @@
+"""Tests that the two-tier summary delivers its answer to the user once"""
+
+import asyncio
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+# The planner imports the search, database and transformer services with all of their dependencies
+planner_manager = pytest.importorskip("planner.manager")
+PlannerServiceManager = planner_manager.PlannerServiceManager
+
+
+class FakeMain:
+    @staticmethod
+    def logger():
+        return logging.getLogger("tests")
+
+    @staticmethod
+    def configuration():
+        return SimpleNamespace(summarization_configuration=SimpleNamespace(draft_max_tokens=256))
+
+
+class FakeLLM:
+    def __init__(self, response: str, delay: float = 0.0, fail: bool = False):
+        self.response = response
+        self.delay = delay
+        self.fail = fail
+
+    async def acompletion(self, prompt, stream_response, **kwargs):
+        for token in self.response.split(" "):
+            await stream_response(token + " ")
+            await asyncio.sleep(self.delay)
+        return self.response
+
+    async def completion(self, prompt, **kwargs):
+        await asyncio.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("refinement failed")
+        return self.response
+
+
+class FakeChat:
+    """Records what the Chainlit messages show through the stream and replace callbacks"""
+
+    def __init__(self):
+        self.draft = ""
+        self.replacements = []
+
+    async def stream_draft(self, token):
+        self.draft += token
+
+    async def replace_draft(self, response):
+        self.replacements.append(response)
+        self.draft = response
+
+
+def planner(draft: FakeLLM, refined: FakeLLM) -> PlannerServiceManager:
+    manager = PlannerServiceManager.__new__(PlannerServiceManager)
+    manager.llm_draft_summerizer = draft
+    manager.llm_summerizer = refined
+    manager.prompts = SimpleNamespace(prompt=lambda name: {"text": "{transformation_prompt} {object}"})
+
+    async def fit_prompt(stage, llm, slots, reserved_output_tokens=None):
+        return SimpleNamespace(values={slot.name: slot.text for slot in slots})
+    manager.fit_prompt = fit_prompt
+    return manager
+
+
+def draft_and_refine(manager: PlannerServiceManager, chat: FakeChat) -> str:
+    values = {"transformation_prompt": "summarize", "object": "data"}
+    return asyncio.run(manager.draft_and_refine(values, "prompt", "admin", chat.stream_draft, chat.replace_draft))
+
+
+def test_refined_answer_replaces_the_draft_once(monkeypatch):
+    monkeypatch.setattr(planner_manager, "Main", FakeMain)
+    chat = FakeChat()
+    response = draft_and_refine(planner(FakeLLM("a quick draft", delay=0.01), FakeLLM("the refined answer", delay=0.05)), chat)
+
+    assert response == "the refined answer"
+    assert chat.replacements == ["the refined answer"]
+    assert chat.draft == "the refined answer"
+
+
+def test_refined_answer_before_the_draft_is_shown_once(monkeypatch):
+    monkeypatch.setattr(planner_manager, "Main", FakeMain)
+    chat = FakeChat()
+    response = draft_and_refine(planner(FakeLLM("a slow draft answer", delay=0.05), FakeLLM("the refined answer")), chat)
+
+    assert response == "the refined answer"
+    assert chat.replacements == ["the refined answer"]
+    assert chat.draft == "the refined answer"
+
+
+def test_draft_is_the_answer_when_refinement_fails(monkeypatch):
+    monkeypatch.setattr(planner_manager, "Main", FakeMain)
+    chat = FakeChat()
+    response = draft_and_refine(planner(FakeLLM("a quick draft"), FakeLLM("", delay=0.01, fail=True)), chat)
+
+    assert response == "a quick draft"
+    assert chat.replacements == []
+    assert chat.draft.strip() == "a quick draft"
@@ -0,0 +1,94 @@
+"""Tests that streamed JSON responses are aborted as soon as they cannot be valid, and only then"""
+
+import json
+
+import pytest
+
+from LLM.json_stream import JSONStreamError, JSONStreamValidator
+
+OBJECT_SCHEMA = {"type": "object"}
+ARRAY_SCHEMA = {"type": "array"}
+
+TRICKY_RESPONSE = json.dumps({
+    "plan": [{"step": 1, "task": "Find {brackets} and [lists] in \"quotes\"", "done": False}],
+    "path": "C:\\temp\\",
+    "score": -1.5e-3,
+    "empty": [[], {}],
+    "note": None,
+    "unicode": "caf\u00e9 \u2014 ok",
+    "confident": True,
+}, indent=2)
+
+
+def stream(validator: JSONStreamValidator, tokens: list[str]) -> str:
+    """Feeds the tokens as the LLM services do, the tokens after the complete JSON are not fed"""
+    streamed = "".join(validator.feed(token) for token in tokens if not validator.complete)
+    validator.finish()
+    return streamed
+
+
+def fed_tokens(validator: JSONStreamValidator, tokens: list[str]) -> int:
+    """Returns how many tokens were fed when the validator aborted the stream"""
+    for count, token in enumerate(tokens, start=1):
+        try:
+            validator.feed(token)
+        except JSONStreamError:
+            return count
+    return len(tokens) + 1
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, len(TRICKY_RESPONSE)])
+def test_valid_json_is_streamed_whole_however_it_is_split(chunk_size):
+    tokens = [TRICKY_RESPONSE[start:start + chunk_size] for start in range(0, len(TRICKY_RESPONSE), chunk_size)]
+    validator = JSONStreamValidator(OBJECT_SCHEMA)
+
+    streamed = stream(validator, tokens)
+
+    assert validator.complete
+    assert json.loads(streamed) == json.loads(TRICKY_RESPONSE)
+
+
+def test_leading_whitespace_and_array_schema_are_accepted():
+    validator = JSONStreamValidator(ARRAY_SCHEMA)
+    assert stream(validator, ["\n  ", "[1, ", "\"a]\", ", "null]"]) == "\n  [1, \"a]\", null]"
+
+
+def test_schema_without_type_accepts_objects_and_arrays():
+    assert stream(JSONStreamValidator({}), ["[true]"]) == "[true]"
+    assert stream(JSONStreamValidator({}), ["{\"a\": false}"]) == "{\"a\": false}"
+
+
+def test_text_after_the_json_is_dropped():
+    validator = JSONStreamValidator(OBJECT_SCHEMA)
+
+    streamed = stream(validator, ["{\"a\": 1}", "\n```\nHope this helps!"])
+
+    assert streamed == "{\"a\": 1}"
+    assert validator.complete
+
+
+@pytest.mark.parametrize("tokens", [
+    ["Sure! Here is the plan: {", "\"a\": 1}"],
+    ["```json\n", "{\"a\": 1}", "\n```"],
+    ["[1, 2]", "{\"a\": 1}"],
+])
+def test_response_not_starting_with_the_schema_type_is_aborted_at_once(tokens):
+    assert fed_tokens(JSONStreamValidator(OBJECT_SCHEMA), tokens) == 1
+
+
+@pytest.mark.parametrize("tokens", [
+    ["{\"a\": [1, 2}", "]}"],
+    ["{\"a\": ", "maybe", "}"],
+    ["{\"a\": 1; ", "\"b\": 2}"],
+    ["{\"a\": \"quoted\" text\"", "}"],
+])
+def test_malformed_json_is_aborted_before_the_end_of_the_stream(tokens):
+    assert fed_tokens(JSONStreamValidator(OBJECT_SCHEMA), tokens) < len(tokens)
+
+
+def test_stream_ending_before_the_json_is_complete_fails():
+    validator = JSONStreamValidator(OBJECT_SCHEMA)
+    validator.feed("{\"plan\": [{\"step\": 1}")
+
+    with pytest.raises(JSONStreamError):
+        validator.finish()
@@ -0,0 +1,64 @@
+"""Tests that the ledger prices every model the planner calls by default"""
+
+import logging
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from common.data_model import (LLMCascadeConfiguration, LLMResponseFormatConfiguration, PlannerRouterConfiguration, RequestLedgerConfiguration,
+                               SummarizationConfiguration)
+from common.ledger import llm_price
+
+# The planner imports the search, database and transformer services with all of their dependencies
+planner_manager = pytest.importorskip("planner.manager")
+PlannerServiceManager = planner_manager.PlannerServiceManager
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class FakeMain:
+    @staticmethod
+    def logger():
+        return logging.getLogger("tests")
+
+    @staticmethod
+    def configuration():
+        return SimpleNamespace(
+            planner_router_configuration=PlannerRouterConfiguration(),
+            summarization_configuration=SummarizationConfiguration(),
+            llm_response_format_configuration=LLMResponseFormatConfiguration(
+                planner_schema=os.path.join(SRC_DIR, "store/response_schemas/planner_response.json"),
+                api_generator_schema=os.path.join(SRC_DIR, "store/response_schemas/api_generator_response.json"),
+            ),
+        )
+
+
+class FakeLLMServiceManager:
+    """Records the provider models the planner builds its services for"""
+
+    def __init__(self):
+        self.models = []
+
+    def get_service(self, llm_provider: str, model_name: str, **kwargs):
+        self.models.append((llm_provider, model_name))
+        return SimpleNamespace(provider=llm_provider, model_name=model_name)
+
+    def cascade(self, stage: str, default_service):
+        for tier in LLMCascadeConfiguration().cascades.get(stage, []):
+            self.models.append((tier.provider, tier.model_name))
+
+    def prompt_budget(self):
+        return None
+
+
+def test_every_planner_model_has_a_default_price(monkeypatch):
+    monkeypatch.setattr(planner_manager, "Main", FakeMain)
+    llm_service_manager = FakeLLMServiceManager()
+    PlannerServiceManager(llm_service_manager, None, None, None, SimpleNamespace(mongo_db_service=lambda: None))
+
+    prices = RequestLedgerConfiguration().prices
+    assert llm_service_manager.models
+    unpriced = [f"{provider}/{model_name}" for provider, model_name in llm_service_manager.models if llm_price(prices, provider, model_name) is None]
+    assert unpriced == []
+
@@ -0,0 +1,158 @@
+"""Tests that the router fails over only while the call can still move, and cancels the losing hedged request"""
+
+import asyncio
+import copy
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+import LLM.router as router_module
+from common.data_model import LLMRouterConfiguration
+from LLM.json_stream import JSONStreamError
+from LLM.router import LLMRouter, RoutedLLMService
+
+
+class FakeMain:
+    @staticmethod
+    def logger():
+        return logging.getLogger("tests")
+
+
+class FakeService:
+    """Answers after a delay, streaming the response word by word, or fails after the tokens it was given"""
+
+    def __init__(self, provider: str, model_name: str = "gpt-4o", response: str = None, delay: float = 0.0,
+                 error: Exception = None, configured: bool = True):
+        self.provider = provider
+        self.model_name = model_name
+        self.response = response or f"answer from {provider}"
+        self.delay = delay
+        self.error = error
+        self.configured = configured
+        self.calls = 0
+        self.cancelled = False
+
+    def request_model(self) -> str:
+        return self.model_name
+
+    def bind(self, model_name: str) -> "FakeService":
+        handle = copy.copy(self)
+        handle.model_name = model_name
+        return handle
+
+    async def call(self, stream_response):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+            if stream_response is not None:
+                for word in self.response.split(" "):
+                    await stream_response(word + " ")
+                    await asyncio.sleep(0)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
+async def call(service: FakeService, stream_response):
+    return await service.call(stream_response)
+
+
+def route(router: LLMRouter, services: list, streamed: list = None) -> str:
+    async def stream_response(token):
+        streamed.append(token)
+    return asyncio.run(router.route(services, call, stream_response if streamed is not None else None))
+
+
+def hedging_router() -> LLMRouter:
+    return LLMRouter(LLMRouterConfiguration(hedging_enabled=True, hedge_min_delay_seconds=0.01, min_samples=1))
+
+
+@pytest.fixture(autouse=True)
+def fake_main(monkeypatch):
+    monkeypatch.setattr(router_module, "Main", FakeMain)
+
+
+def test_failed_call_fails_over_to_the_next_service():
+    primary, fallback = FakeService("openai", error=ConnectionError("reset")), FakeService("azure_openai")
+
+    assert route(LLMRouter(LLMRouterConfiguration()), [primary, fallback]) == "answer from azure_openai"
+    assert primary.calls == 1 and fallback.calls == 1
+
+
+def test_stream_does_not_fail_over_once_tokens_were_sent():
+    primary = FakeService("openai", response="partial answer", error=ConnectionError("reset"))
+    fallback = FakeService("azure_openai")
+    streamed = []
+
+    with pytest.raises(ConnectionError):
+        route(LLMRouter(LLMRouterConfiguration()), [primary, fallback], streamed)
+    assert streamed == ["partial ", "answer "]
+    assert fallback.calls == 0
+
+
+def test_invalid_response_does_not_fail_over():
+    primary, fallback = FakeService("openai", error=JSONStreamError("prose")), FakeService("azure_openai")
+
+    with pytest.raises(JSONStreamError):
+        route(LLMRouter(LLMRouterConfiguration()), [primary, fallback])
+    assert fallback.calls == 0
+
+
+def test_slow_call_is_hedged_and_the_loser_cancelled():
+    router = hedging_router()
+    primary, fallback = FakeService("openai", delay=5), FakeService("azure_openai")
+    router.stats_for(primary, streaming=False).record(0.01, success=True)
+
+    assert route(router, [primary, fallback]) == "answer from azure_openai"
+    assert primary.cancelled
+
+
+def test_first_streamed_token_wins_the_hedge():
+    router = hedging_router()
+    primary = FakeService("openai", response="slow tokens", delay=5)
+    fallback = FakeService("azure_openai", response="fast tokens")
+    router.stats_for(primary, streaming=True).record(0.01, success=True)
+    streamed = []
+
+    assert route(router, [primary, fallback], streamed) == "fast tokens"
+    assert streamed == ["fast ", "tokens "]
+    assert primary.cancelled
+
+
+def test_no_hedge_without_latency_samples():
+    router = hedging_router()
+    primary, fallback = FakeService("openai", delay=0.05), FakeService("azure_openai")
+
+    assert route(router, [primary, fallback]) == "answer from openai"
+    assert fallback.calls == 0
+
+
+def test_routed_service_binds_the_fallbacks_to_its_model_and_skips_unconfigured_ones():
+    primary = FakeService("openai", model_name="gpt-4-turbo")
+    fallback = FakeService("azure_openai", model_name="gpt-4o")
+    unconfigured = FakeService("anthropic_ai", configured=False)
+
+    services = RoutedLLMService(LLMRouter(LLMRouterConfiguration()), primary, [fallback, unconfigured]).services()
+
+    assert [service.provider for service in services] == ["openai", "azure_openai"]
+    assert [service.model_name for service in services] == ["gpt-4-turbo", "gpt-4-turbo"]
+    assert fallback.model_name == "gpt-4o"
+
+
+def test_only_providers_configured_with_the_model_are_fallbacks(monkeypatch):
+    llm_manager = pytest.importorskip("LLM.manager")
+    configuration = SimpleNamespace(llm_router_configuration=LLMRouterConfiguration(
+        failover_routes={"openai": ["azure_openai", "anthropic_ai"]}))
+    monkeypatch.setattr(llm_manager, "Main", SimpleNamespace(configuration=lambda: configuration))
+    manager = llm_manager.LLMServiceManager.__new__(llm_manager.LLMServiceManager)
+    manager._router = LLMRouter(configuration.llm_router_configuration)
+    azure, anthropic = FakeService("azure_openai", model_name="gpt-4-turbo"), FakeService("anthropic_ai", model_name="gpt-4-turbo")
+    manager.services = lambda: [azure, FakeService("openai", model_name="gpt-4o"), anthropic]
+
+    assert [service.provider for service in manager.routed(FakeService("openai", model_name="gpt-4-turbo")).services()] == [
+        "openai", "azure_openai", "anthropic_ai"]
+    assert [service.provider for service in manager.routed(FakeService("openai", model_name="gpt-4o-mini")).services()] == ["openai"]
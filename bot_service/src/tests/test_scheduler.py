@@ -0,0 +1,126 @@
+"""Tests that the scheduler serves requests by priority and refunds what their estimates overcharged"""
+
+import asyncio
+
+from common.data_model import LLMSchedulerConfiguration, RequestPriority
+from common.request_context import RequestContext, request_scope
+from LLM.scheduler import LLMScheduler, RateLimiter
+
+
+async def wait_for_queue(limiter: RateLimiter, queued: int):
+    while limiter.queued() < queued:
+        await asyncio.sleep(0)
+
+
+def test_waiters_are_served_by_priority_then_arrival():
+    async def run():
+        limiter = RateLimiter("openai/gpt-4o", max_concurrency=1)
+        await limiter.acquire(10, RequestPriority.interactive.value)
+        served = []
+
+        async def request(name: str, priority: int):
+            await limiter.acquire(10, priority)
+            served.append(name)
+            limiter.release()
+
+        tasks = []
+        for name, priority in [("batch-1", RequestPriority.batch), ("shadow", RequestPriority.shadow),
+                               ("interactive-1", RequestPriority.interactive), ("batch-2", RequestPriority.batch),
+                               ("interactive-2", RequestPriority.interactive)]:
+            tasks.append(asyncio.create_task(request(name, priority.value)))
+            await wait_for_queue(limiter, len(tasks))
+        limiter.release()
+        await asyncio.gather(*tasks)
+        return served
+
+    assert asyncio.run(run()) == ["interactive-1", "interactive-2", "batch-1", "batch-2", "shadow"]
+
+
+def test_scheduler_queues_by_the_priority_of_the_request():
+    async def run():
+        scheduler = LLMScheduler(LLMSchedulerConfiguration(rate_limits={"openai": {"max_concurrency": 1}}))
+        limiter = scheduler.limiter("openai", "gpt-4o")
+        first_done = asyncio.Event()
+        served = []
+
+        async def request(name: str, priority: int, done: asyncio.Event = None):
+            with request_scope(RequestContext(priority=priority)):
+                async with scheduler.slot("openai", "gpt-4o", 10):
+                    served.append(name)
+                    if done is not None:
+                        await done.wait()
+
+        first = asyncio.create_task(request("first", RequestPriority.batch.value, first_done))
+        while limiter.in_flight() == 0:
+            await asyncio.sleep(0)
+        batch = asyncio.create_task(request("batch", RequestPriority.batch.value))
+        await wait_for_queue(limiter, 1)
+        interactive = asyncio.create_task(request("interactive", RequestPriority.interactive.value))
+        await wait_for_queue(limiter, 2)
+        first_done.set()
+        await asyncio.gather(first, batch, interactive)
+        return served
+
+    assert asyncio.run(run()) == ["first", "interactive", "batch"]
+
+
+def test_cancelled_waiter_does_not_take_the_slot():
+    async def run():
+        limiter = RateLimiter("openai/gpt-4o", max_concurrency=1)
+        await limiter.acquire(10, RequestPriority.interactive.value)
+        cancelled = asyncio.create_task(limiter.acquire(10, RequestPriority.interactive.value))
+        waiting = asyncio.create_task(limiter.acquire(10, RequestPriority.batch.value))
+        await wait_for_queue(limiter, 2)
+        cancelled.cancel()
+        await asyncio.gather(cancelled, return_exceptions=True)
+        limiter.release()
+        await asyncio.wait_for(waiting, timeout=1)
+        return limiter.in_flight(), limiter.queued()
+
+    assert asyncio.run(run()) == (1, 0)
+
+
+def test_refund_lets_the_next_request_through():
+    async def run():
+        # 600 tokens per minute, a request over the 100 left waits tens of seconds for the refill
+        limiter = RateLimiter("openai/gpt-4o", tpm=600)
+        await limiter.acquire(500, RequestPriority.interactive.value)
+        waiting = asyncio.create_task(limiter.acquire(400, RequestPriority.interactive.value))
+        await wait_for_queue(limiter, 1)
+        limiter.release()
+        limiter.refund(500, used_tokens=100)
+        await asyncio.wait_for(waiting, timeout=1)
+
+    asyncio.run(run())
+
+
+def test_refund_is_capped_by_the_charge_and_the_bucket():
+    async def run():
+        limiter = RateLimiter("openai/gpt-4o", tpm=600)
+        # Charged the whole budget (capped from 1000) and used all of it
+        await limiter.acquire(1000, RequestPriority.interactive.value)
+        limiter.release()
+        limiter.refund(1000, used_tokens=600)
+        waiting = asyncio.create_task(limiter.acquire(300, RequestPriority.interactive.value))
+        await asyncio.sleep(0.05)
+        still_waiting = not waiting.done()
+        # Used more than its estimate, nothing is given back nor charged
+        limiter.refund(100, used_tokens=200)
+        await asyncio.sleep(0.05)
+        still_waiting = still_waiting and not waiting.done()
+        waiting.cancel()
+        await asyncio.gather(waiting, return_exceptions=True)
+        return still_waiting
+
+    assert asyncio.run(run())
+
+
+def test_scheduler_refund_without_rate_limits_is_ignored():
+    async def run():
+        scheduler = LLMScheduler(LLMSchedulerConfiguration(rate_limits={}))
+        async with scheduler.slot("openai", "gpt-4o", 100) as queue_seconds:
+            pass
+        scheduler.refund("openai", "gpt-4o", 100, used_tokens=10)
+        return queue_seconds
+
+    assert asyncio.run(run()) == 0.0
@@ -0,0 +1,113 @@
+"""Tests that streamed tokens are coalesced into frames and that a slow consumer holds back the provider stream"""
+
+import asyncio
+
+import pytest
+
+from common.data_model import LLMStreamingConfiguration
+from LLM.streaming import TokenStreamer
+
+
+class FakeConsumer:
+    """Records the frames sent to the stream_response callback, holding each one until released when blocking"""
+
+    def __init__(self, blocking: bool = False, fail: bool = False):
+        self.frames = []
+        self.fail = fail
+        self.released = asyncio.Event()
+        if not blocking:
+            self.released.set()
+
+    async def __call__(self, frame: str):
+        self.frames.append(frame)
+        if self.fail:
+            raise ConnectionError("websocket closed")
+        await self.released.wait()
+
+
+async def settle():
+    for _ in range(10):
+        await asyncio.sleep(0)
+
+
+def test_first_token_is_sent_at_once_and_the_rest_coalesced():
+    async def run():
+        streamer = TokenStreamer(LLMStreamingConfiguration(frame_interval_ms=10000))
+        consumer = FakeConsumer()
+        async with streamer.stream(consumer) as stream:
+            await stream.push("Hello")
+            await settle()
+            first_frames = list(consumer.frames)
+            for token in [" wo", "rld", "!"]:
+                await stream.push(token)
+        return first_frames, consumer.frames, streamer.stats()
+
+    first_frames, frames, stats = asyncio.run(run())
+    assert first_frames == ["Hello"]
+    assert frames == ["Hello", " world!"]
+    assert stats["tokens"] == 4 and stats["frames"] == 2
+
+
+def test_large_frame_is_flushed_before_the_interval():
+    async def run():
+        streamer = TokenStreamer(LLMStreamingConfiguration(frame_interval_ms=10000, frame_max_chars=4))
+        consumer = FakeConsumer()
+        async with streamer.stream(consumer) as stream:
+            await stream.push("a")
+            await settle()
+            await stream.push("bb")
+            await stream.push("cc")
+            await settle()
+            flushed_frames = list(consumer.frames)
+            await stream.push("d")
+        return flushed_frames, consumer.frames
+
+    flushed_frames, frames = asyncio.run(run())
+    assert flushed_frames == ["a", "bbcc"]
+    assert frames == ["a", "bbcc", "d"]
+
+
+def test_full_buffer_waits_for_the_slow_consumer():
+    async def run():
+        streamer = TokenStreamer(LLMStreamingConfiguration(frame_interval_ms=0, max_buffered_chars=4))
+        consumer = FakeConsumer(blocking=True)
+        async with streamer.stream(consumer) as stream:
+            await stream.push("a")
+            await settle()
+            await stream.push("bb")
+            blocked_push = asyncio.create_task(stream.push("cc"))
+            await settle()
+            blocked = not blocked_push.done()
+            # Once the sender takes the buffered frame, the provider stream is read again
+            consumer.released.set()
+            await asyncio.wait_for(blocked_push, timeout=1)
+        return blocked, consumer.frames
+
+    blocked, frames = asyncio.run(run())
+    assert blocked
+    assert frames == ["a", "bbcc"]
+
+
+def test_tokens_are_sent_one_by_one_without_coalescing():
+    async def run():
+        streamer = TokenStreamer(LLMStreamingConfiguration(coalesce_enabled=False))
+        consumer = FakeConsumer()
+        async with streamer.stream(consumer) as stream:
+            for token in ["a", "b", "c"]:
+                await stream.push(token)
+        return consumer.frames
+
+    assert asyncio.run(run()) == ["a", "b", "c"]
+
+
+def test_failing_consumer_stops_the_provider_stream():
+    async def run():
+        streamer = TokenStreamer(LLMStreamingConfiguration(frame_interval_ms=0))
+        consumer = FakeConsumer(fail=True)
+        async with streamer.stream(consumer) as stream:
+            await stream.push("a")
+            await settle()
+            await stream.push("b")
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(run())